@@ -1,4 +1,35 @@
-import requests, json, os, datetime, time
+import requests, json, os, datetime, time, sqlite3, socket, threading, concurrent.futures, csv, queue, asyncio
+import base64, bisect, collections, contextlib, copy, gzip, hashlib, http.server, io, mmap, re, socketserver, sys, tempfile, urllib.parse, zipfile
+
+# optional - faster json decoding and streaming items out of listing pages
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# optional - uploading zstandard compressed v4s
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PUBLISHING_URL = 'https://publishing.ons.gov.uk/'
+
+# every request to publishing goes through this session
+# caching etc are added by mounting adapters on it - see Enable_Response_Cache()
+session = requests.Session()
+
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024 # size of each chunk uploaded to s3
+MIN_CHUNK_SIZE = 5 * 1024 * 1024 # s3 needs every part but the last to be at least 5MB
+MAX_CHUNK_SIZE = 80 * 1024 * 1024
+MAX_NUMBER_OF_CHUNKS = 10000 # s3 limit on number of parts
+BUFFER_POOL_SIZE = 4 # number of chunk buffers each pool can hold
+V4_BLOCK_ROWS = 50000 # rows built at a time when making a v4 from columns
+V4_ESCAPE_CACHE_SIZE = 1000000 # distinct codes/labels remembered per column when making a v4
 
 def Get_Access_Token(credentials): 
     ### getting access_token ###
@@ -15,7 +46,7 @@ def Get_Access_Token(credentials):
     password = credentials_json['password']
     login = {"email":email, "password":password}
     
-    r = requests.post(zebedee_url, json=login, verify=False)
+    r = session.post(zebedee_url, json=login, verify=False)
     if r.status_code == 200:
         access_token = r.text.strip('"')
         return access_token
@@ -23,16 +54,23 @@ def Get_Access_Token(credentials):
         raise Exception('Token not created, returned a {} error'.format(r.status_code))
 
 
-def Get_Recipe_Api(access_token):
-    ''' returns whole recipe api '''
+def Get_Recipe_Api(access_token, projected=False):
+    ''' 
+    returns whole recipe api 
+    projected=True streams the recipes (unless they are cached) and only keeps the fields from Project_Recipe()
+    '''
     
     recipe_api_url = 'https://publishing.ons.gov.uk/recipes'
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(recipe_api_url + '?limit=1000', headers=headers)
+    if projected:
+        recipe_dict = {'items':list(Iterate_Api_Listing(access_token, recipe_api_url, Project_Recipe))}
+        return recipe_dict
+    
+    r = session.get(recipe_api_url + '?limit=1000', headers=headers)
     
     if r.status_code == 200:
-        recipe_dict = r.json()
+        recipe_dict = Decode_Json(r.content)
         return recipe_dict
     else:
         raise Exception('Recipe API returned a {} error'.format(r.status_code))
@@ -91,7 +129,7 @@ def Get_Recipe_Info_From_Recipe_Id(access_token, recipe_id):
     
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(single_recipe_url, headers=headers)
+    r = session.get(single_recipe_url, headers=headers)
     if r.status_code == 200:
         single_recipe_dict = r.json()
         return single_recipe_dict
@@ -118,7 +156,7 @@ def Update_Recipe(access_token, dataset_id, updated_recipe_dict):
     
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.put(single_recipe_url, headers=headers, json=updated_recipe_dict)
+    r = session.put(single_recipe_url, headers=headers, json=updated_recipe_dict)
     
     if r.status_code == 200:
         print('Recipe updated successfully!')
@@ -149,7 +187,7 @@ def Update_Recipe_Editions(access_token, dataset_id, list_of_editions):
     new_editions_dict = {}
     new_editions_dict['editions'] = list_of_editions
     
-    r = requests.put(single_recipe_url, headers=headers, json=new_editions_dict)
+    r = session.put(single_recipe_url, headers=headers, json=new_editions_dict)
     
     if r.status_code == 200:
         print('Editions updated successfully!')
@@ -178,7 +216,7 @@ def Update_Recipe_Codelists(access_token, dataset_id, codelist_changes_dict, cod
     
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.put(single_recipe_url, headers=headers, json=codelist_changes_dict)
+    r = session.put(single_recipe_url, headers=headers, json=codelist_changes_dict)
     
     if r.status_code == 200:
         print('Codelist updated successfully!')
@@ -187,6 +225,136 @@ def Update_Recipe_Codelists(access_token, dataset_id, codelist_changes_dict, cod
     else:
         print('Codelist not updated, returned a {} error'.format(r.status_code))
     
+def Bulk_Update_Recipes(access_token, recipe_changes_dict, max_workers=8):
+    '''
+    Updates many recipes at once
+    Downloads the recipe api once, only sends the PUTs for what has changed,
+    sends them concurrently then checks them all with a single read of the recipe api
+    
+    recipe_changes_dict has the wanted state for each recipe, all keys are optional
+    {
+    dataset_id:
+        {alias:'', 
+        editions:[], 
+        code_lists:{codelist_id:{id:'', name:'', is_hierarchy:'', href:''}}
+        },
+    etc}
+    
+    Returns a dict of results for each dataset_id
+    {dataset_id: {'updated':[], 'failed':[], 'unchanged':bool}}
+    '''
+    assert type(recipe_changes_dict) == dict, 'recipe_changes_dict must be a dict'
+    
+    recipe_dict = Get_Recipe_Api(access_token)
+    recipes_by_dataset_id = {item['output_instances'][0]['dataset_id']:item for item in recipe_dict['items']}
+    
+    results_dict = {}
+    requests_to_send = [] # (dataset_id, description, url, json)
+    for dataset_id in recipe_changes_dict.keys():
+        results_dict[dataset_id] = {'updated':[], 'failed':[], 'unchanged':False}
+        if dataset_id not in recipes_by_dataset_id.keys():
+            results_dict[dataset_id]['failed'].append('Recipe does not exist for {}'.format(dataset_id))
+            continue
+        
+        recipe_requests = Get_Recipe_Changes(recipes_by_dataset_id[dataset_id], recipe_changes_dict[dataset_id])
+        for description, url, changes in recipe_requests:
+            if url is None:
+                # change that can't be made
+                results_dict[dataset_id]['failed'].append(description)
+            else:
+                requests_to_send.append((dataset_id, description, url, changes))
+        if len(recipe_requests) == 0:
+            results_dict[dataset_id]['unchanged'] = True
+    
+    print('{} recipes checked, {} updates to send'.format(len(recipe_changes_dict), len(requests_to_send)))
+    if len(requests_to_send) == 0:
+        return results_dict
+    
+    headers = {'X-Florence-Token':access_token}
+    
+    def put_change(url, changes):
+        r = session.put(url, headers=headers, json=changes)
+        return r.status_code
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(put_change, url, changes):(dataset_id, description) for dataset_id, description, url, changes in requests_to_send}
+        for future in concurrent.futures.as_completed(futures):
+            dataset_id, description = futures[future]
+            try:
+                status_code = future.result()
+            except Exception as e:
+                results_dict[dataset_id]['failed'].append('{} - {}'.format(description, e))
+                continue
+            if status_code == 200:
+                results_dict[dataset_id]['updated'].append(description)
+            else:
+                results_dict[dataset_id]['failed'].append('{} - returned a {} error'.format(description, status_code))
+    
+    # single read to check everything was applied
+    recipe_dict = Get_Recipe_Api(access_token)
+    recipes_by_dataset_id = {item['output_instances'][0]['dataset_id']:item for item in recipe_dict['items']}
+    for dataset_id, description, url, changes in requests_to_send:
+        if description not in results_dict[dataset_id]['updated']:
+            continue
+        if dataset_id not in recipes_by_dataset_id.keys():
+            results_dict[dataset_id]['updated'].remove(description)
+            results_dict[dataset_id]['failed'].append('{} - recipe missing when checked'.format(description))
+            continue
+        remaining_requests = Get_Recipe_Changes(recipes_by_dataset_id[dataset_id], recipe_changes_dict[dataset_id])
+        if description in [item[0] for item in remaining_requests]:
+            results_dict[dataset_id]['updated'].remove(description)
+            results_dict[dataset_id]['failed'].append('{} - not applied'.format(description))
+    
+    for dataset_id in results_dict.keys():
+        for description in results_dict[dataset_id]['failed']:
+            print('{} - {}'.format(dataset_id, description))
+    print('{} recipe updates applied'.format(sum(len(item['updated']) for item in results_dict.values())))
+    
+    return results_dict
+
+
+def Get_Recipe_Changes(recipe, wanted_recipe):
+    '''
+    Compares a recipe from the recipe api to the wanted state of the recipe
+    Returns a list of (description, url, json) for each PUT needed
+    url is None for changes that can't be made
+    Used by Bulk_Update_Recipes()
+    '''
+    recipe_api_url = 'https://publishing.ons.gov.uk/recipes'
+    recipe_id = recipe['id']
+    output_instance = recipe['output_instances'][0]
+    dataset_id = output_instance['dataset_id']
+    
+    recipe_requests = []
+    
+    if 'alias' in wanted_recipe.keys() and wanted_recipe['alias'] != recipe.get('alias'):
+        url = recipe_api_url + '/' + recipe_id
+        recipe_requests.append(('alias', url, {'alias':wanted_recipe['alias']}))
+    
+    if 'editions' in wanted_recipe.keys():
+        if type(wanted_recipe['editions']) != list:
+            raise Exception('editions needs to be a list, not a {}'.format(type(wanted_recipe['editions'])))
+        if wanted_recipe['editions'] != output_instance.get('editions'):
+            url = recipe_api_url + '/' + recipe_id + '/instances/' + dataset_id
+            recipe_requests.append(('editions', url, {'editions':wanted_recipe['editions']}))
+            
+    if 'code_lists' in wanted_recipe.keys():
+        existing_code_lists = {item['id']:item for item in output_instance.get('code_lists', [])}
+        for codelist_id in wanted_recipe['code_lists'].keys():
+            description = 'code list {}'.format(codelist_id)
+            codelist_changes_dict = wanted_recipe['code_lists'][codelist_id]
+            if codelist_id not in existing_code_lists.keys():
+                recipe_requests.append((description + ' is not in recipe', None, None))
+                continue
+            existing_code_list = existing_code_lists[codelist_id]
+            changed = {key:value for key, value in codelist_changes_dict.items() if existing_code_list.get(key) != value}
+            if len(changed) != 0:
+                url = recipe_api_url + '/' + recipe_id + '/instances/' + dataset_id + '/code-lists/' + codelist_id
+                recipe_requests.append((description, url, changed))
+    
+    return recipe_requests
+
+    
 def Post_New_Recipe_In_Api(access_token, recipe_dict):
     '''
     Creates a new recipe in recipe api
@@ -197,7 +365,7 @@ def Post_New_Recipe_In_Api(access_token, recipe_dict):
     
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.post(recipe_api_url, headers=headers, json=recipe_dict)
+    r = session.post(recipe_api_url, headers=headers, json=recipe_dict)
     
     dataset_id = recipe_dict['output_instances'][0]['dataset_id']
     
@@ -311,32 +479,248 @@ def Update_Codelist_Dict_For_Recipe(recipe_dict, code_lists_id_label_dict):
     return recipe_dict
 
 
-def Get_Dataset_Instances_Api(access_token):
+def Get_Codelist_Editions(access_token, codelist_id):
+    '''
+    Returns a list of the editions of a code list
+    '''
+    codelist_url = 'https://publishing.ons.gov.uk/code-lists/{}/editions'.format(codelist_id)
+    headers = {'X-Florence-Token':access_token}
+    
+    r = session.get(codelist_url, headers=headers)
+    if r.status_code == 200:
+        editions = [item['edition'] for item in r.json()['items']]
+        return editions
+    else:
+        raise Exception('/code-lists/{}/editions returned a {} error'.format(codelist_id, r.status_code))
+    
+    
+def Get_Codelist_Codes(access_token, codelist_id, edition):
+    '''
+    Returns a list of the codes in an edition of a code list
+    '''
+    codes_url = 'https://publishing.ons.gov.uk/code-lists/{}/editions/{}/codes'.format(codelist_id, edition)
+    headers = {'X-Florence-Token':access_token}
+    
+    codes = []
+    offset = 0
+    while True:
+        r = session.get(codes_url + '?limit=1000&offset={}'.format(offset), headers=headers)
+        if r.status_code != 200:
+            raise Exception('/code-lists/{}/editions/{}/codes returned a {} error'.format(codelist_id, edition, r.status_code))
+        codes_dict = r.json()
+        for item in codes_dict['items']:
+            codes.append(item.get('code', item.get('id')))
+        offset += len(codes_dict['items'])
+        if len(codes_dict['items']) == 0 or offset >= codes_dict.get('total_count', offset):
+            break
+    return codes
+
+
+def Update_Codelist_Index(access_token, index_dir, codelist_ids, max_age_days=7):
+    '''
+    Keeps a local copy of the codes in each code list, used to check v4 codes without the APIs
+    Each code list is stored as a sorted file of codes in index_dir, index.json records what has been fetched
+    Refresh is incremental - only editions not already in the index are fetched,
+    code lists older than max_age_days are fetched again in full
+    Returns a list of code lists that were updated
+    '''
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    manifest = Read_Codelist_Index_Manifest(index_dir)
+    
+    updated_codelists = []
+    for codelist_id in codelist_ids:
+        entry = manifest.get(codelist_id)
+        if entry is not None and time.time() - entry['fetched'] > max_age_days * 24 * 60 * 60:
+            entry = None # too old, start again
+            
+        editions = Get_Codelist_Editions(access_token, codelist_id)
+        if entry is None:
+            new_editions = editions
+            codes = set()
+        else:
+            new_editions = [edition for edition in editions if edition not in entry['editions']]
+            codes = Load_Codelist_Codes(index_dir, codelist_id)
+            
+        # a code list with no editions still gets an (empty) entry, so Load_Codelist_Index() can load it
+        if len(new_editions) == 0 and entry is not None:
+            continue
+        
+        for edition in new_editions:
+            codes.update(Get_Codelist_Codes(access_token, codelist_id, edition))
+            
+        Write_Codelist_Codes(index_dir, codelist_id, codes)
+        manifest[codelist_id] = {
+                'editions':editions,
+                'fetched':time.time() if entry is None else entry['fetched'],
+                'number_of_codes':len(codes)
+                }
+        updated_codelists.append(codelist_id)
+        print('Code list index updated - {} ({} codes)'.format(codelist_id, len(codes)))
+        
+    Write_Codelist_Index_Manifest(index_dir, manifest)
+    return updated_codelists
+
+
+def Read_Codelist_Index_Manifest(index_dir):
+    '''
+    Returns index.json of a code list index, or an empty dict
+    '''
+    manifest_file = os.path.join(index_dir, 'index.json')
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+    
+    
+def Write_Codelist_Index_Manifest(index_dir, manifest):
+    '''
+    Writes index.json of a code list index
+    Written to a temp file first so the index is never left half written
+    '''
+    manifest_file = os.path.join(index_dir, 'index.json')
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def Write_Codelist_Codes(index_dir, codelist_id, codes):
+    '''
+    Writes the codes of a code list as a sorted file, one code per line
+    '''
+    codes_file = os.path.join(index_dir, codelist_id + '.codes')
+    with open(codes_file + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(sorted(codes)))
+    os.replace(codes_file + '.tmp', codes_file)
+
+
+def Load_Codelist_Codes(index_dir, codelist_id):
+    '''
+    Returns the codes of a code list from the index as a set
+    '''
+    codes_file = os.path.join(index_dir, codelist_id + '.codes')
+    with open(codes_file, 'r', encoding='utf-8') as f:
+        codes = f.read()
+    if codes == '':
+        return set()
+    return set(codes.split('\n'))
+
+
+def Load_Codelist_Index(index_dir, codelist_ids=None):
+    '''
+    Returns a dict of {codelist_id: frozenset of codes} from the index
+    Loads every code list in the index if codelist_ids isn't given
+    '''
+    manifest = Read_Codelist_Index_Manifest(index_dir)
+    if codelist_ids is None:
+        codelist_ids = manifest.keys()
+        
+    codelist_index = {}
+    for codelist_id in codelist_ids:
+        if codelist_id not in manifest.keys():
+            raise Exception('Code list "{}" is not in the index at {}'.format(codelist_id, index_dir))
+        codelist_index[codelist_id] = frozenset(Load_Codelist_Codes(index_dir, codelist_id))
+    return codelist_index
+
+
+MALFORMED_ROWS = 'malformed_rows' # key in the result of Validate_V4_Codes()
+MAX_REPORTED_EXAMPLES = 100 # unknown codes (per code list) & malformed rows kept by Validate_V4_Codes(), the rest are only counted
+OTHER_UNKNOWN_CODES = '(other codes)' # rows with unknown codes after the first MAX_REPORTED_EXAMPLES
+
+def Validate_V4_Codes(v4, codelist_index):
+    '''
+    Streams through a v4 checking every dimension code against the code list index
+    Code columns are the first of each code/label pair after the data marking columns,
+    the header of a code column is the code list id
+    codelist_index is from Load_Codelist_Index(), code columns not in it are not checked
+    Returns a dict of unknown codes and how many rows they are in
+    {codelist_id: {code: number_of_rows}}
+    Only the first MAX_REPORTED_EXAMPLES unknown codes of a code list are kept, rows with any others are counted under OTHER_UNKNOWN_CODES
+    Rows without the same number of columns as the header are not checked, they are returned under
+    MALFORMED_ROWS as {number_of_rows:, examples:{line_number: number_of_columns}} - the first MAX_REPORTED_EXAMPLES
+    '''
+    with Open_V4(v4) as v4_file:
+        f = io.TextIOWrapper(v4_file, encoding='utf-8', newline='')
+        reader = csv.reader(f)
+        header = next(reader)
+        
+        # quick check
+        assert header[0].lower().startswith('v4_'), 'first column of v4 is not the obs column - {}'.format(header[0])
+        number_of_data_markings = int(header[0].split('_')[-1])
+        
+        columns_to_check = [] # (column number, code set, unknown code counts)
+        unknown_codes_dict = {}
+        malformed_rows = {'number_of_rows':0, 'examples':{}}
+        number_of_columns = len(header)
+        for column_number in range(1 + number_of_data_markings, len(header), 2):
+            codelist_id = header[column_number]
+            if codelist_id in codelist_index.keys():
+                unknown_codes_dict[codelist_id] = {}
+                columns_to_check.append((column_number, codelist_index[codelist_id], unknown_codes_dict[codelist_id]))
+            else:
+                print('Code list "{}" not in index, codes not checked'.format(codelist_id))
+        
+        for row in reader:
+            if len(row) != number_of_columns:
+                malformed_rows['number_of_rows'] += 1
+                if len(malformed_rows['examples']) < MAX_REPORTED_EXAMPLES:
+                    malformed_rows['examples'][reader.line_num] = len(row)
+                continue
+            for column_number, codes, unknown_codes in columns_to_check:
+                code = row[column_number]
+                if code not in codes:
+                    if code not in unknown_codes.keys() and len(unknown_codes) >= MAX_REPORTED_EXAMPLES:
+                        code = OTHER_UNKNOWN_CODES
+                    unknown_codes[code] = unknown_codes.get(code, 0) + 1
+                    
+    unknown_codes_dict = {codelist_id:unknown_codes for codelist_id, unknown_codes in unknown_codes_dict.items() if len(unknown_codes) != 0}
+    for codelist_id in unknown_codes_dict.keys():
+        for code, number_of_rows in unknown_codes_dict[codelist_id].items():
+            print('{} - unknown code "{}" in {} rows'.format(codelist_id, code, number_of_rows))
+    if malformed_rows['number_of_rows'] != 0:
+        print('{} rows do not have {} columns, first is line {}'.format(malformed_rows['number_of_rows'], number_of_columns, min(malformed_rows['examples'].keys())))
+        unknown_codes_dict[MALFORMED_ROWS] = malformed_rows
+    return unknown_codes_dict
+
+
+def Check_V4_Codes(access_token, dataset_id, v4, index_dir):
+    '''
+    Checks the codes in a v4 against the code lists in the recipe of dataset_id
+    Updates the code list index first
+    Raises an error if there are any unknown codes
+    '''
+    recipe_dict = Get_Recipe(access_token, dataset_id)
+    codelist_ids = [item['id'] for item in recipe_dict['output_instances'][0]['code_lists']]
+    
+    Update_Codelist_Index(access_token, index_dir, codelist_ids)
+    codelist_index = Load_Codelist_Index(index_dir, codelist_ids)
+    
+    unknown_codes_dict = Validate_V4_Codes(v4, codelist_index)
+    malformed_rows = unknown_codes_dict.pop(MALFORMED_ROWS, None)
+    if malformed_rows is not None:
+        raise Exception('{} - v4 has {} malformed rows, first is line {}'.format(dataset_id, malformed_rows['number_of_rows'], min(malformed_rows['examples'].keys())))
+    if len(unknown_codes_dict) != 0:
+        raise Exception('{} - v4 has codes that are not in code lists {}'.format(dataset_id, ', '.join(unknown_codes_dict.keys())))
+    print('{} - v4 codes checked against code lists'.format(dataset_id))
+    
+
+def Get_Dataset_Instances_Api(access_token, projected=False, records=False):
     ''' 
     Returns /dataset/instances API 
+    projected=True only keeps the fields from Project_Instance()
+    records=True returns a list of Instance_Record - see Create_Record_Index()
     '''
     dataset_instances_api_url = 'https://publishing.ons.gov.uk/dataset/instances'
-    headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(dataset_instances_api_url + '?limit=1000', headers=headers)
-    if r.status_code == 200:
-        whole_dict = r.json()
-        total_count = whole_dict['total_count']
-        if total_count <= 1000:
-            dataset_instances_dict = r.json()['items']
-        elif total_count > 1000:
-            number_of_iterations = round(total_count / 1000) + 1
-            offset = 0
-            dataset_instances_dict = []
-            for i in range(number_of_iterations):
-                new_url = dataset_instances_api_url + '?limit=1000&offset={}'.format(offset)
-                new_dict = requests.get(new_url, headers=headers).json()
-                for item in new_dict['items']:
-                    dataset_instances_dict.append(item)
-                offset += 1000
-        return dataset_instances_dict
+    if records:
+        project_item = Record_Instance
+    elif projected:
+        project_item = Project_Instance
     else:
-        raise Exception('/dataset/instances API returned a {} error'.format(r.status_code))
+        project_item = None
+    
+    dataset_instances_dict = list(Iterate_Api_Listing(access_token, dataset_instances_api_url, project_item))
+    return dataset_instances_dict
 
 
 def Get_Latest_Dataset_Instances(access_token):
@@ -345,7 +729,7 @@ def Get_Latest_Dataset_Instances(access_token):
     Returns latest upload id
     Uses Get_Dataset_Instances_Api()
     '''
-    dataset_instances_dict = Get_Dataset_Instances_Api(access_token)
+    dataset_instances_dict = Get_Dataset_Instances_Api(access_token, records=True)
     latest_id = dataset_instances_dict[0]['id']
     return latest_id
 
@@ -357,7 +741,7 @@ def Get_Dataset_Instance_Info(access_token, instance_id):
     dataset_instances_url = 'https://publishing.ons.gov.uk/dataset/instances/' + instance_id
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(dataset_instances_url, headers=headers)
+    r = session.get(dataset_instances_url, headers=headers)
     if r.status_code == 200:
         dataset_instances_dict = r.json()
         return dataset_instances_dict
@@ -365,33 +749,24 @@ def Get_Dataset_Instance_Info(access_token, instance_id):
         raise Exception('/dataset/instances/{} API returned a {} error'.format(instance_id, r.status_code))
     
 
-def Get_Dataset_Jobs_Api(access_token):
+def Get_Dataset_Jobs_Api(access_token, projected=False, records=False):
     '''
     Returns dataset/jobs API
+    projected=True only keeps the fields from Project_Job()
+    records=True returns a list of Job_Record - see Create_Record_Index()
     '''
 
     dataset_jobs_api_url = 'https://publishing.ons.gov.uk/dataset/jobs'
-    headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(dataset_jobs_api_url + '?limit=1000', headers=headers)
-    if r.status_code == 200:
-        whole_dict = r.json()
-        total_count = whole_dict['total_count']
-        if total_count <= 1000:
-            dataset_jobs_dict = whole_dict['items']
-        elif total_count > 1000:
-            number_of_iterations = round(total_count / 1000) + 1
-            offset = 0
-            dataset_jobs_dict = []
-            for i in range(number_of_iterations):
-                new_url = dataset_jobs_api_url + '?limit=1000&offset={}'.format(offset)
-                new_dict = requests.get(new_url, headers=headers).json()
-                for item in new_dict['items']:
-                    dataset_jobs_dict.append(item)
-                offset += 1000
-        return dataset_jobs_dict
+    if records:
+        project_item = Record_Job
+    elif projected:
+        project_item = Project_Job
     else:
-        raise Exception('/dataset/jobs API returned a {} error'.format(r.status_code))
+        project_item = None
+        
+    dataset_jobs_dict = list(Iterate_Api_Listing(access_token, dataset_jobs_api_url, project_item))
+    return dataset_jobs_dict
         
         
 def Get_Latest_Job_Info(access_token):
@@ -399,20 +774,319 @@ def Get_Latest_Job_Info(access_token):
     Returns latest job id and recipe id and instance id
     Uses Get_Dataset_Jobs_Api()
     '''
-    dataset_jobs_dict = Get_Dataset_Jobs_Api(access_token)
+    dataset_jobs_dict = Get_Dataset_Jobs_Api(access_token, records=True)
     latest_id = dataset_jobs_dict[-1]['id']
     recipe_id = dataset_jobs_dict[-1]['recipe'] # to be used as a quick check
-    instance_id = dataset_jobs_dict[-1]['links']['instances'][0]['id']
+    instance_id = dataset_jobs_dict[-1]['instance_id']
     return latest_id, recipe_id, instance_id
 
 
-def Post_New_Job(access_token, dataset_id, s3_url):
+def Iterate_Api_Listing(access_token, api_url, project_item=None, page_size=1000, stream=None):
+    '''
+    Yields each item of a paginated listing api - ie /dataset/instances, /dataset/jobs, /recipes
+    project_item is called on each item to only keep the fields that are needed - ie Project_Instance
+    stream=True decodes items one at a time as the page downloads (needs ijson),
+    defaults to streaming if ijson is installed, otherwise each page is decoded with Decode_Json()
+    Listings that are in the response cache (see Enable_Response_Cache) aren't streamed by default, 
+    only whole responses are cached
+    '''
+    headers = {'X-Florence-Token':access_token}
+    if stream is None:
+        stream = ijson is not None and not Is_Url_Cached(api_url)
+    if stream and ijson is None:
+        raise Exception('ijson needs to be installed to stream listings')
+        
+    offset = 0
+    while True:
+        page_url = api_url + '?limit={}&offset={}'.format(page_size, offset)
+        r = session.get(page_url, headers=headers, stream=stream)
+        if r.status_code != 200:
+            r.close()
+            raise Exception('{} returned a {} error'.format(api_url, r.status_code))
+        
+        page_info = {} # total_count of the listing
+        try:
+            if stream:
+                r.raw.decode_content = True
+                items = Iterate_Listing_Page(r.raw, page_info)
+            else:
+                page = Decode_Json(r.content)
+                items = page['items']
+                if 'total_count' in page.keys():
+                    page_info['total_count'] = page['total_count']
+                
+            number_of_items = 0
+            for item in items:
+                number_of_items += 1
+                if project_item is None:
+                    yield item
+                else:
+                    yield project_item(item)
+        finally:
+            r.close()
+            
+        # the api can return fewer items than page_size before the last page, so go by total_count
+        offset += number_of_items
+        if number_of_items == 0 or offset >= page_info.get('total_count', offset):
+            break
+            
+            
+def Iterate_Listing_Page(raw, page_info):
+    '''
+    Yields each item of a page of a listing api as it is decoded with ijson
+    page_info['total_count'] is set if the page has one, which is known once every item has been yielded
+    '''
+    builder = None
+    for prefix, event, value in ijson.parse(raw, use_float=True):
+        if prefix == 'total_count':
+            page_info['total_count'] = value
+        elif prefix == 'items.item' and event in ('start_map', 'start_array'):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == 'items.item' and event in ('end_map', 'end_array'):
+            builder.event(event, value)
+            yield builder.value
+            builder = None
+        elif builder is not None:
+            builder.event(event, value)
+        elif prefix == 'items.item':
+            yield value
+
+
+def Decode_Json(content):
+    '''
+    Decodes json bytes, with orjson if it is installed
+    '''
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def Get_Nested(item, *keys):
+    '''
+    Returns item[key1][key2]... or None if any of them are missing
+    keys can be dict keys or list indexes
+    '''
+    for key in keys:
+        try:
+            item = item[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return item
+
+
+def Project_Instance(item):
+    '''
+    Returns only the fields of an instance that the pipeline uses
+    '''
+    return {
+            'id':item.get('id'),
+            'state':item.get('state'),
+            'dataset_id':Get_Nested(item, 'links', 'dataset', 'id'),
+            'edition':item.get('edition'),
+            'version':item.get('version'),
+            'job_id':Get_Nested(item, 'links', 'job', 'id'),
+            'last_updated':item.get('last_updated'),
+            'total_observations':item.get('total_observations'),
+            'total_inserted_observations':Get_Nested(item, 'import_tasks', 'import_observations', 'total_inserted_observations')
+            }
+    
+    
+def Project_Job(item):
+    '''
+    Returns only the fields of a job that the pipeline uses
+    '''
+    return {
+            'id':item.get('id'),
+            'state':item.get('state'),
+            'recipe':item.get('recipe'),
+            'instance_id':Get_Nested(item, 'links', 'instances', 0, 'id'),
+            'last_updated':item.get('last_updated'),
+            'number_of_files':len(item.get('files') or [])
+            }
+
+
+def Project_Recipe(item):
+    '''
+    Returns only the fields of a recipe that the pipeline uses
+    '''
+    return {
+            'id':item.get('id'),
+            'alias':item.get('alias'),
+            'recipe_alias':Get_Nested(item, 'files', 0, 'description'),
+            'dataset_id':Get_Nested(item, 'output_instances', 0, 'dataset_id'),
+            'editions':Get_Nested(item, 'output_instances', 0, 'editions'),
+            'code_lists':[code_list['id'] for code_list in Get_Nested(item, 'output_instances', 0, 'code_lists') or []]
+            }
+
+
+### Compact listing records ###
+# Instances & jobs kept as __slots__ records with only the fields the pipeline uses
+# Records can still be read like the projected dicts - record['id'] - so either can be passed around
+# Create_Record_Index() gives O(1) lookups by id and filters by dataset, state & time window
+
+class Listing_Record:
+    '''
+    Base class for compact records, fields are in __slots__
+    '''
+    __slots__ = ()
+    
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            value = fields.get(field)
+            # the same few strings are repeated across thousands of records
+            if type(value) == str and field in ('state', 'dataset_id', 'edition', 'recipe'):
+                value = sys.intern(value)
+            setattr(self, field, value)
+            
+    def __getitem__(self, field):
+        return getattr(self, field)
+    
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+    
+    def to_dict(self):
+        return {field:getattr(self, field) for field in self.__slots__}
+    
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(field, getattr(self, field)) for field in self.__slots__))
+    
+
+class Instance_Record(Listing_Record):
+    '''
+    An instance from /dataset/instances - fields as Project_Instance(), plus last_updated as a timestamp
+    '''
+    __slots__ = ('id', 'state', 'dataset_id', 'edition', 'version', 'job_id', 'last_updated', 'updated_timestamp',
+                 'total_observations', 'total_inserted_observations')
+    
+
+class Job_Record(Listing_Record):
+    '''
+    A job from /dataset/jobs - fields as Project_Job(), plus last_updated as a timestamp
+    '''
+    __slots__ = ('id', 'state', 'recipe', 'instance_id', 'last_updated', 'updated_timestamp', 'number_of_files')
+
+
+def Record_Instance(item):
+    '''
+    Returns an Instance_Record of an item from /dataset/instances
+    '''
+    fields = Project_Instance(item)
+    fields['updated_timestamp'] = Parse_Api_Time(fields['last_updated'])
+    return Instance_Record(**fields)
+
+
+def Record_Job(item):
+    '''
+    Returns a Job_Record of an item from /dataset/jobs
+    '''
+    fields = Project_Job(item)
+    fields['updated_timestamp'] = Parse_Api_Time(fields['last_updated'])
+    return Job_Record(**fields)
+
+
+def Parse_Api_Time(value):
+    '''
+    Converts an API time (ie "2021-07-08T09:30:12.345678901Z") or a datetime to a unix timestamp
+    Returns None if value is None or can't be read
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    
+    match = re.match(r'^(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}(?::\d{2})?)(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})?$', value.strip())
+    if match is None:
+        return None
+    date, clock, fraction, zone = match.groups()
+    parsed = datetime.datetime.fromisoformat('{}T{}'.format(date, clock))
+    if fraction is not None:
+        parsed = parsed.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    if zone is None or zone == 'Z':
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    else:
+        zone = zone.replace(':', '')
+        offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+        parsed = parsed.replace(tzinfo=datetime.timezone(offset if zone[0] == '+' else -offset))
+    return parsed.timestamp()
+
+
+def Create_Record_Index(records):
+    '''
+    Returns a dict of indexes over a list of records (Instance_Record or Job_Record)
+    by_id - {id:record}
+    by_dataset, by_state - {value:[positions in records]}
+    by_time - positions sorted by updated_timestamp, with the timestamps in times
+    '''
+    records = list(records)
+    index = {}
+    index['records'] = records
+    index['by_id'] = {}
+    index['by_dataset'] = collections.defaultdict(list)
+    index['by_state'] = collections.defaultdict(list)
+    
+    for position, record in enumerate(records):
+        index['by_id'][record.id] = record
+        index['by_dataset'][record.get('dataset_id')].append(position)
+        index['by_state'][record.state].append(position)
+        
+    timed_positions = sorted((record.updated_timestamp, position) for position, record in enumerate(records) if record.updated_timestamp is not None)
+    index['times'] = [timestamp for timestamp, position in timed_positions]
+    index['by_time'] = [position for timestamp, position in timed_positions]
+    return index
+
+
+def Get_Record(index, record_id):
+    '''
+    Returns the record with id record_id, None if it isn't in the index
+    '''
+    return index['by_id'].get(record_id)
+
+
+def Filter_Records(index, dataset_id=None, state=None, since=None, until=None):
+    '''
+    Returns the records matching every filter given, in listing order
+    dataset_id & state can be a single value or a list of values
+    since & until are datetimes, API time strings or unix timestamps - last_updated is since <= t < until
+    Filters are answered from the index, starting with the smallest set of positions
+    '''
+    position_sets = []
+    for key, values in (('by_dataset', dataset_id), ('by_state', state)):
+        if values is None:
+            continue
+        if type(values) not in (list, tuple, set):
+            values = [values]
+        positions = set()
+        for value in values:
+            positions.update(index[key].get(value, []))
+        position_sets.append(positions)
+        
+    if since is not None or until is not None:
+        start = 0 if since is None else bisect.bisect_left(index['times'], Parse_Api_Time(since))
+        end = len(index['times']) if until is None else bisect.bisect_left(index['times'], Parse_Api_Time(until))
+        position_sets.append(set(index['by_time'][start:end]))
+        
+    if len(position_sets) == 0:
+        return list(index['records'])
+    
+    position_sets.sort(key=len)
+    positions = position_sets[0].intersection(*position_sets[1:])
+    return [index['records'][position] for position in sorted(positions)]
+
+
+def Post_New_Job(access_token, dataset_id, s3_url, recipe_info=None):
     '''
     Creates a new job in the /dataset/jobs API
     Job is created in state 'created'
-    Uses Get_Recipe_Info() to get information
+    Uses Get_Recipe_Info() to get information, unless it is passed as recipe_info
     '''
-    dataset_dict = Get_Recipe_Info(access_token, dataset_id)
+    dataset_dict = recipe_info
+    if dataset_dict is None:
+        dataset_dict = Get_Recipe_Info(access_token, dataset_id)
     
     dataset_jobs_api_url = 'https://publishing.ons.gov.uk/dataset/jobs'
     headers = {'X-Florence-Token':access_token}
@@ -429,7 +1103,7 @@ def Post_New_Job(access_token, dataset_id, s3_url):
         ]
     }
         
-    r = requests.post(dataset_jobs_api_url, headers=headers, json=new_job_json)
+    r = session.post(dataset_jobs_api_url, headers=headers, json=new_job_json)
     if r.status_code == 201:
         print('Job created succefully')
     else:
@@ -447,13 +1121,16 @@ def Post_New_Job(access_token, dataset_id, s3_url):
         return job_id, job_instance_id
 
 
-def Add_File_To_Existing_Job(access_token, dataset_id, job_id, s3_url):
+def Add_File_To_Existing_Job(access_token, dataset_id, job_id, s3_url, recipe_info=None):
     '''
     Adds file to a job
     Only needed if file wasnt originally attached to new job - ie files = []
+    recipe_info is from Get_Recipe_Info(), it is looked up if not given
     '''
 
-    dataset_dict = Get_Recipe_Info(access_token, dataset_id)
+    dataset_dict = recipe_info
+    if dataset_dict is None:
+        dataset_dict = Get_Recipe_Info(access_token, dataset_id)
     
     attaching_file_to_job_url = 'https://publishing.ons.gov.uk/dataset/jobs/' + job_id + '/files'
     headers = {'X-Florence-Token':access_token}
@@ -463,7 +1140,7 @@ def Add_File_To_Existing_Job(access_token, dataset_id, job_id, s3_url):
             'url':s3_url
             }
 
-    r = requests.put(attaching_file_to_job_url, headers=headers, json=added_file_json)
+    r = session.put(attaching_file_to_job_url, headers=headers, json=added_file_json)
     if r.status_code == 200:
         print('File added successfully')
     else:
@@ -486,7 +1163,7 @@ def Update_State_Of_Job(access_token, job_id):
     job_id_dict = Get_Job_Info(access_token, job_id)
     
     if len(job_id_dict['files']) != 0:
-        r = requests.put(updating_state_of_job_url, headers=headers, json=updating_state_of_job_json)
+        r = session.put(updating_state_of_job_url, headers=headers, json=updating_state_of_job_json)
         if r.status_code == 200:
             print('State updated successfully')
         else:
@@ -502,7 +1179,7 @@ def Get_Job_Info(access_token, job_id):
     dataset_jobs_id_url = 'https://publishing.ons.gov.uk/dataset/jobs/' + job_id
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(dataset_jobs_id_url, headers=headers)
+    r = session.get(dataset_jobs_id_url, headers=headers)
     if r.status_code == 200:
         job_info_dict = r.json()
         return job_info_dict
@@ -510,7 +1187,7 @@ def Get_Job_Info(access_token, job_id):
         raise Exception('/dataset/jobs/{} returned error {}'.format(job_id, r.status_code))
 
 
-def Upload_Data_To_Florence(credentials, dataset_id, v4):
+def Upload_Data_To_Florence(credentials, dataset_id, v4, chunk_size=None):
     '''Uploads v4 into Florence'''
     # get access_token
     access_token = Get_Access_Token(credentials)
@@ -519,7 +1196,7 @@ def Upload_Data_To_Florence(credentials, dataset_id, v4):
     Check_Recipe_Exists(access_token, dataset_id)
     
     # upload v4 into s3 bucket
-    s3_url = Post_V4_To_S3(access_token, v4)
+    s3_url = Post_V4_To_S3(access_token, v4, chunk_size=chunk_size)
     
     # create new job
     job_id, instance_id = Post_New_Job(access_token, dataset_id, s3_url)
@@ -530,145 +1207,1042 @@ def Upload_Data_To_Florence(credentials, dataset_id, v4):
     return instance_id
 
 
-def Post_V4_To_S3(access_token, v4):
+def Post_V4_To_S3(access_token, v4, chunk_size=None, tuner=None, progress_callback=None, dataset_id=None, scheduler=None, priority=1):
     '''
     Uploading a v4 to the s3 bucket
-    v4 is full file path
+    v4 is full file path, can be compressed (.gz, .zip, .zst) - it is decompressed as it uploads, see Open_V4()
+    chunk_size is the size of each chunk in bytes, defaults to 5MB
+    chunk_size='adaptive' picks the size from tuner (or CHUNK_SIZE_TUNER)
+    progress_callback is called after each chunk, events are tagged with dataset_id
+    scheduler shares bandwidth with other uploads (defaults to UPLOAD_SCHEDULER), priority is this file's share
+    '''
+    csv_total_size = Get_V4_Size(v4) # size of the whole csv
+    file_name = Get_V4_File_Name(v4)
+    
+    with Open_V4(v4) as v4_file:
+        s3_url = Post_Stream_To_S3(access_token, v4_file, csv_total_size, file_name, chunk_size=chunk_size, tuner=tuner, 
+                                   progress_callback=progress_callback, dataset_id=dataset_id, scheduler=scheduler, priority=priority)
+    return s3_url
+
+
+def Post_Stream_To_S3(access_token, stream, csv_total_size, file_name, chunk_size=None, tuner=None, progress_callback=None, dataset_id=None, scheduler=None, priority=1):
+    '''
+    Uploads csv_total_size bytes read from stream (anything with readinto) to the s3 bucket
+    The size has to be known up front as every chunk sends resumableTotalSize & resumableTotalChunks
+    Other arguments are the same as Post_V4_To_S3
     '''
     # properties that do not change for the upload
-    csv_total_size = str(os.path.getsize(v4)) # size of the whole csv
     timestamp = datetime.datetime.now() # to be ued as unique resumableIdentifier
     timestamp = datetime.datetime.strftime(timestamp, '%d%m%y%H%M%S')
-    file_name = v4.split("/")[-1]
     
     upload_url = 'https://publishing.ons.gov.uk/upload'
     headers = {'X-Florence-Token':access_token}
     
-    # chunk up the data
-    temp_files = Create_Temp_Chunks(v4) # list of temporary files
-    total_number_of_chunks = len(temp_files)
+    if chunk_size == 'adaptive':
+        if tuner is None:
+            tuner = CHUNK_SIZE_TUNER
+        # throughput is recorded against the candidate, even if the chunk size had to be made bigger
+        candidate_size = Get_Chunk_Size_Candidate(tuner, csv_total_size)
+        chunk_size = Check_Chunk_Size(candidate_size, csv_total_size)
+    else:
+        tuner = None
+        chunk_size = Check_Chunk_Size(chunk_size, csv_total_size)
+    
+    if scheduler is None:
+        scheduler = UPLOAD_SCHEDULER
+    
+    total_number_of_chunks = max(-(-csv_total_size // chunk_size), 1)
     chunk_number = 1 # starting chunk number
+    bytes_sent = 0
+    progress_tracker = Create_Progress_Tracker(csv_total_size)
+    upload_id = Register_Upload(scheduler, priority)
+    
+    # chunks are read straight from the stream into buffers from the pool, no temporary files
+    buffer_pool = Get_Buffer_Pool(chunk_size)
     
     # uploading each chunk
-    for chunk_file in temp_files:
-        csv_size = str(os.path.getsize(chunk_file)) # Size of the chunk
-
-        with open(chunk_file, 'rb') as f:
-            files = {'file': f} # Inlcude the opened file in the request
+    try:
+        while chunk_number <= total_number_of_chunks:
+            buffer = Get_Buffer(buffer_pool)
+            try:
+                csv_size = Read_Chunk_Into(stream, buffer) # Size of the chunk
+                expected_size = min(chunk_size, csv_total_size - bytes_sent)
+                if csv_size != expected_size:
+                    raise Exception('chunk {} of {} is {} bytes, expected {}'.format(chunk_number, file_name, csv_size, expected_size))
+                files = {'file': (file_name, memoryview(buffer)[:csv_size])} # Inlcude the chunk in the request
+                
+                # Params that are added to the request
+                # resumableChunkSize, resumableTotalSize & resumableTotalChunks are the same for every chunk
+                params = {
+                        "resumableType": "text/csv",
+                        "resumableChunkNumber": chunk_number,
+                        "resumableCurrentChunkSize": str(csv_size),
+                        "resumableTotalSize": str(csv_total_size),
+                        "resumableChunkSize": str(chunk_size),
+                        "resumableIdentifier": timestamp + '-' + file_name.replace('.', ''),
+                        "resumableFilename": file_name,
+                        "resumableRelativePath": ".",
+                        "resumableTotalChunks": total_number_of_chunks
+                }
             
-            # Params that are added to the request
-            params = {
-                    "resumableType": "text/csv",
-                    "resumableChunkNumber": chunk_number,
-                    "resumableCurrentChunkSize": csv_size,
-                    "resumableTotalSize": csv_total_size,
-                    "resumableChunkSize": csv_size,
-                    "resumableIdentifier": timestamp + '-' + file_name.replace('.', ''),
-                    "resumableFilename": file_name,
-                    "resumableRelativePath": ".",
-                    "resumableTotalChunks": total_number_of_chunks
-            }
+                # making the POST request once the scheduler has room for it
+                Acquire_Upload_Slot(scheduler, upload_id, csv_size)
+                try:
+                    start_time = time.perf_counter()
+                    r = session.post(upload_url, headers=headers, params=params, files=files)
+                    if r.status_code != 200:  
+                        raise Exception('{} returned error {}'.format(upload_url, r.status_code))
+                finally:
+                    Release_Upload_Slot(scheduler, upload_id)
+            
+                # only full sized chunks say anything about the chunk size
+                if tuner is not None and csv_size == chunk_size:
+                    Record_Chunk_Throughput(tuner, candidate_size, csv_size, time.perf_counter() - start_time)
             
-            # making the POST request
-            r = requests.post(upload_url, headers=headers, params=params, files=files)
-            if r.status_code != 200:  
-                raise Exception('{} returned error {}'.format(upload_url, r.status_code))
+                bytes_sent += csv_size
+                if progress_callback is not None:
+                    seconds_elapsed, bytes_per_second, eta_seconds = Update_Progress_Tracker(progress_tracker, bytes_sent)
+                    progress_callback({
+                            'event':'chunk_sent',
+                            'dataset_id':dataset_id,
+                            'chunk_number':chunk_number,
+                            'total_chunks':total_number_of_chunks,
+                            'bytes_sent':bytes_sent,
+                            'total_bytes':csv_total_size,
+                            'seconds_elapsed':seconds_elapsed,
+                            'mb_per_second':bytes_per_second / (1024 * 1024),
+                            'eta_seconds':eta_seconds
+                            })
                 
-            chunk_number += 1 # moving onto next chunk number
-        
-    s3_url = 'https://s3-eu-west-1.amazonaws.com/ons-dp-production-publishing-uploaded-datasets/{}'.format(params['resumableIdentifier'])
+                chunk_number += 1 # moving onto next chunk number
+            finally:
+                # the request body is built by the time post returns, so the buffer can be reused
+                Return_Buffer(buffer_pool, buffer)
+            
+    finally:
+        # always give up this upload's share of the budget, even if reading or uploading failed
+        Unregister_Upload(scheduler, upload_id)
+        Release_Buffer_Pool(buffer_pool)
+    
+    # stream should be finished - anything left means csv_total_size was wrong
+    if Read_Chunk_Into(stream, bytearray(1)) != 0:
+        raise Exception('{} is bigger than {} bytes, upload is incomplete'.format(file_name, csv_total_size))
     
-    # delete temp files
-    Delete_Temp_Chunks(temp_files)
+    s3_url = 'https://s3-eu-west-1.amazonaws.com/ons-dp-production-publishing-uploaded-datasets/{}'.format(params['resumableIdentifier'])
     
     return s3_url
      
 
-def Create_Temp_Chunks(v4):
+def Post_V4_Shards_To_S3(access_token, v4, number_of_shards, chunk_size=None, progress_callback=None, dataset_id=None, priority=1):
     '''
-    Chunks up the data into text files
-    returns number of chunks
-    chunks created in same directory as v4
-    Will be deleted after upload
+    Splits a v4 into number_of_shards on row boundaries, each with the v4 header, and uploads them at the same time
+    Shards are read straight from the v4, nothing is written to disk
+    Each shard is its own upload (v4-name-shard-1of4.csv etc) so has its own resumableIdentifier
+    Returns a list of s3_urls in shard order
     '''
-    chunk_size = 5 * 1024 * 1024
-    file_number = 1
-    location = '/'.join(v4.split('/')[:-1]) + '/'
-    temp_files = []
-    with open(v4, 'rb') as f:
-        chunk = f.read(chunk_size)
-        while chunk:
-            file_name = location + 'temp-file-part-' + str(file_number)
-            with open(file_name, 'wb') as chunk_file:
-                chunk_file.write(chunk)
-                temp_files.append(file_name)
-            file_number += 1
-            chunk = f.read(chunk_size)
-    return temp_files 
+    if Get_V4_Compression(v4) is not None:
+        raise Exception('{} is compressed, shards are split from an uncompressed v4'.format(v4))
+    file_name = v4.split("/")[-1]
+    name, extension = os.path.splitext(file_name)
+    header, shard_ranges = Get_V4_Shard_Ranges(v4, number_of_shards)
+    
+    def upload_shard(shard_number):
+        start, end = shard_ranges[shard_number]
+        shard_name = '{}-shard-{}of{}{}'.format(name, shard_number + 1, len(shard_ranges), extension)
+        stream = Block_Stream(Iterate_V4_Shard(v4, header, start, end))
+        return Post_Stream_To_S3(access_token, stream, len(header) + end - start, shard_name, chunk_size=chunk_size, 
+                                 progress_callback=progress_callback, dataset_id=dataset_id, priority=priority)
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shard_ranges)) as executor:
+        s3_urls = list(executor.map(upload_shard, range(len(shard_ranges))))
+    return s3_urls
 
 
-def Delete_Temp_Chunks(temporary_files):
+def Get_V4_Shard_Ranges(v4, number_of_shards):
     '''
-    Deletes the temporary chunks that were uploaded
+    Returns the header row (bytes) and a list of (start, end) byte offsets of each shard's rows
+    Shards are about the same size, each ends at the end of a row
+    Rows are split on newlines, so a v4 with a newline inside a quoted label can't be sharded
+    Fewer shards are returned if the v4 has fewer rows than number_of_shards
     '''
-    for file in temporary_files:
-        os.remove(file)
+    assert number_of_shards >= 1, 'number_of_shards must be at least 1'
+    v4_size = os.path.getsize(v4)
     
+    with open(v4, 'rb') as f:
+        header = f.readline()
+        rows_start = f.tell()
+        boundaries = [rows_start]
+        for shard_number in range(1, number_of_shards):
+            target = rows_start + (v4_size - rows_start) * shard_number // number_of_shards
+            if target <= boundaries[-1]:
+                continue
+            # move on to the start of the next row
+            f.seek(target - 1)
+            f.readline()
+            boundary = f.tell()
+            if boundaries[-1] < boundary < v4_size:
+                boundaries.append(boundary)
+        boundaries.append(v4_size)
+    
+    shard_ranges = [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+    if len(shard_ranges) == 0:
+        shard_ranges = [(rows_start, rows_start)]
+    return header, shard_ranges
 
-def Get_State_Of_Instance(access_token, instance_id):
+
+def Iterate_V4_Shard(v4, header, start, end, block_size=1024 * 1024):
     '''
-    Checks state of an instance
-    Returns job_state
+    Yields the header then bytes start:end of v4, in blocks
     '''
-    instance_id_url = 'https://publishing.ons.gov.uk/dataset/instances/' + instance_id
-    headers = {'X-Florence-Token':access_token}
+    yield header
+    with open(v4, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                raise Exception('{} ended before byte {}'.format(v4, end))
+            remaining -= len(block)
+            yield block
+
+
+def Submit_Sharded_Job(access_token, dataset_id, s3_urls, job_id=None):
+    '''
+    Creates one job with every shard attached, then submits it
+    job_id is an existing job with the first shard already attached - only shards it doesn't have yet are added
+    Returns job_id, instance_id
+    '''
+    # the recipe is the same for every shard, so it is only looked up once
+    recipe_info = Get_Recipe_Info(access_token, dataset_id)
     
-    r = requests.get(instance_id_url, headers=headers)
-    if r.status_code != 200:
-        raise Exception('{} raised a {} error'.format(instance_id_url, r.status_code))
+    if job_id is None:
+        job_id, instance_id = Post_New_Job(access_token, dataset_id, s3_urls[0], recipe_info)
+        job_dict = Get_Job_Info(access_token, job_id)
+    else:
+        job_dict = Get_Job_Info(access_token, job_id)
+        instance_id = Get_Nested(job_dict, 'links', 'instances', 0, 'id')
         
-    dataset_instance_dict = r.json()
-    job_state = dataset_instance_dict['state']
+    attached_urls = [item.get('url') for item in job_dict['files']]
+    for s3_url in s3_urls:
+        if s3_url not in attached_urls:
+            Add_File_To_Existing_Job(access_token, dataset_id, job_id, s3_url, recipe_info)
     
-    if job_state == 'created':
-        print('State of instance is "{}", import process has not been triggered'.format(job_state))
-        
-    elif job_state == 'submitted':
-        total_inserted_observations = dataset_instance_dict['import_tasks']['import_observations']['total_inserted_observations']
-        try:
-            total_observations = dataset_instance_dict['total_observations']
-        except:
-            error_message = dataset_instance_dict['events'][0]['message']
-            print('Job is submitted but total_observations could not be determined')
-            print('An error has occured')
-            raise Exception(error_message)
-        print('Import process is running')
-        print('{} out of {} observations have been imported'.format(total_inserted_observations, total_observations))
+    # a missing shard would mean missing observations
+    number_of_files = len(Get_Job_Info(access_token, job_id)['files'])
+    if number_of_files != len(s3_urls):
+        raise Exception('Job {} has {} files, expected {} shards'.format(job_id, number_of_files, len(s3_urls)))
     
-    elif job_state == 'completed':
-        print('Import complete!')
-        
-    else:
-        print('Instance has state - "{}"'.format(job_state))
-        
-    return job_state
+    Update_State_Of_Job(access_token, job_id)
+    return job_id, instance_id
 
 
-def Update_Metadata(access_token, dataset_id, metadata_dict):
+### Compressed v4s ###
+# A v4 can be given as .gz, .zip (containing one csv) or .zst (needs zstandard) and is decompressed as it is read
+# The upload needs the uncompressed size before it starts - zip & zstandard usually record it,
+# gzip only records it modulo 4GB so the file is read through once to count it (remembered in V4_SIZE_CACHE)
+# zstandard's size is from the first frame header, files from tools that write several frames (ie pzstd) fail the upload's size check
+
+V4_SIZE_CACHE = {} # {(v4, modified time, size on disk):uncompressed size}
+
+def Get_V4_Compression(v4):
     '''
-    Used to update all metadata except dimensional data and usage notes
-    Updates using /dataset/datasets/{id}
-    Can be used before or after data is in collection
-    This metadata is saved in CMD
-    Not all fields are required - only ones that need changing
+    Returns 'gz', 'zip' or 'zst' from the v4's file extension, None if it isn't compressed
+    '''
+    extension = os.path.splitext(v4)[-1].lower()
+    if extension in ('.gz', '.zip', '.zst'):
+        return extension[1:]
+    return None
 
-    metadata is a dict with format (possible others)
-    {
-    collection_id : '' (may not be needed)
-    contact : [{email : '', name : '', telephone : ''}] 
-    description : '' (Summary section in florence)
-    next_release : ''
-    release_frequency : ''
+
+@contextlib.contextmanager
+def Open_V4(v4):
+    '''
+    Opens a v4 for reading as bytes, decompressing it if needed
+    ie - with Open_V4(v4) as f:
+    '''
+    compression = Get_V4_Compression(v4)
+    if compression is None:
+        with open(v4, 'rb') as f:
+            yield f
+            
+    elif compression == 'gz':
+        with gzip.open(v4, 'rb') as f:
+            yield f
+            
+    elif compression == 'zip':
+        with zipfile.ZipFile(v4) as zip_file:
+            with zip_file.open(Get_Zip_V4_Member(zip_file, v4)) as f:
+                yield f
+                
+    elif compression == 'zst':
+        if zstandard is None:
+            raise Exception('zstandard needs to be installed to read {}'.format(v4))
+        with open(v4, 'rb') as compressed_file:
+            with zstandard.ZstdDecompressor().stream_reader(compressed_file, read_across_frames=True) as zstd_reader:
+                # buffered so readline works as well
+                yield io.BufferedReader(zstd_reader, 1024 * 1024)
+                
+
+def Get_Zip_V4_Member(zip_file, v4):
+    '''
+    Returns the ZipInfo of the v4 in a zip - the only file in it, or the only csv
+    '''
+    members = [member for member in zip_file.infolist() if not member.is_dir()]
+    if len(members) != 1:
+        members = [member for member in members if member.filename.lower().endswith('.csv')]
+    if len(members) != 1:
+        raise Exception('{} should contain one csv, found {}'.format(v4, [member.filename for member in zip_file.infolist()]))
+    return members[0]
+
+
+def Get_V4_File_Name(v4):
+    '''
+    Returns the name of the uncompressed v4, used as the name of the upload
+    '''
+    compression = Get_V4_Compression(v4)
+    if compression == 'zip':
+        with zipfile.ZipFile(v4) as zip_file:
+            return Get_Zip_V4_Member(zip_file, v4).filename.split('/')[-1]
+    file_name = v4.split('/')[-1]
+    if compression is not None:
+        file_name = os.path.splitext(file_name)[0]
+    return file_name
+
+
+def Get_V4_Size(v4):
+    '''
+    Returns the uncompressed size of a v4 in bytes
+    From the zip directory or the zstandard frame header if they have it, otherwise the v4 is read through once
+    '''
+    compression = Get_V4_Compression(v4)
+    if compression is None:
+        return os.path.getsize(v4)
+    
+    file_stat = os.stat(v4)
+    cache_key = (os.path.abspath(v4), file_stat.st_mtime, file_stat.st_size)
+    if cache_key in V4_SIZE_CACHE.keys():
+        return V4_SIZE_CACHE[cache_key]
+    
+    v4_size = None
+    if compression == 'zip':
+        with zipfile.ZipFile(v4) as zip_file:
+            v4_size = Get_Zip_V4_Member(zip_file, v4).file_size
+            
+    elif compression == 'zst' and zstandard is not None:
+        with open(v4, 'rb') as f:
+            frame_parameters = zstandard.get_frame_parameters(f.read(18)) # longest zstandard frame header
+        # size of the first frame - a file of several frames is caught at the end of the upload by Post_Stream_To_S3
+        if frame_parameters.content_size not in (zstandard.CONTENTSIZE_UNKNOWN, zstandard.CONTENTSIZE_ERROR):
+            v4_size = frame_parameters.content_size
+    
+    if v4_size is None:
+        v4_size = 0
+        buffer = bytearray(1024 * 1024)
+        with Open_V4(v4) as f:
+            for n in iter(lambda: f.readinto(buffer), 0):
+                v4_size += n
+                
+    V4_SIZE_CACHE[cache_key] = v4_size
+    return v4_size
+
+
+def Create_Buffer_Pool(buffer_size, number_of_buffers=BUFFER_POOL_SIZE):
+    '''
+    Returns a dict holding a fixed number of reusable bytearrays of buffer_size bytes
+    Buffers are only allocated when first needed, never more than number_of_buffers of them
+    '''
+    buffer_pool = {}
+    buffer_pool['buffer_size'] = buffer_size
+    buffer_pool['number_of_buffers'] = number_of_buffers
+    buffer_pool['free_buffers'] = queue.LifoQueue() # most recently used first - likely still in memory
+    buffer_pool['allocated'] = 0
+    buffer_pool['users'] = 0 # uploads using the pool, see Get_Buffer_Pool()
+    buffer_pool['lock'] = threading.Lock()
+    return buffer_pool
+
+
+def Get_Buffer(buffer_pool):
+    '''
+    Returns a free buffer, blocks if all of them are in use
+    '''
+    try:
+        return buffer_pool['free_buffers'].get_nowait()
+    except queue.Empty:
+        pass
+    
+    with buffer_pool['lock']:
+        if buffer_pool['allocated'] < buffer_pool['number_of_buffers']:
+            buffer_pool['allocated'] += 1
+            return bytearray(buffer_pool['buffer_size'])
+        
+    return buffer_pool['free_buffers'].get()
+
+
+def Return_Buffer(buffer_pool, buffer):
+    '''
+    Puts a buffer back in the pool once nothing is using it
+    '''
+    buffer_pool['free_buffers'].put(buffer)
+
+
+def Get_Buffer_Pool(buffer_size):
+    '''
+    Returns the shared pool for buffers of buffer_size bytes, creating it if needed
+    Pools of other sizes that no upload is using are dropped, so their buffers are freed
+    Give the pool back with Release_Buffer_Pool() once the upload is done with it
+    '''
+    with BUFFER_POOLS_LOCK:
+        if buffer_size not in BUFFER_POOLS.keys():
+            for idle_size in [size for size, buffer_pool in BUFFER_POOLS.items() if buffer_pool['users'] == 0]:
+                del BUFFER_POOLS[idle_size]
+            BUFFER_POOLS[buffer_size] = Create_Buffer_Pool(buffer_size)
+        buffer_pool = BUFFER_POOLS[buffer_size]
+        buffer_pool['users'] += 1
+        return buffer_pool
+    
+    
+def Release_Buffer_Pool(buffer_pool):
+    '''
+    Marks an upload as finished with a pool from Get_Buffer_Pool()
+    '''
+    with BUFFER_POOLS_LOCK:
+        buffer_pool['users'] -= 1
+
+
+def Read_Chunk_Into(f, buffer):
+    '''
+    Fills buffer from f with readinto, returns the number of bytes read (less than len(buffer) at the end of the file)
+    '''
+    view = memoryview(buffer)
+    bytes_read = 0
+    while bytes_read < len(buffer):
+        n = f.readinto(view[bytes_read:])
+        if not n:
+            break
+        bytes_read += n
+    return bytes_read
+
+
+# one pool per chunk size, shared by every upload in this process
+# memory used for chunks is at most BUFFER_POOL_SIZE * chunk_size for each chunk size being uploaded,
+# plus the last pool used - pools that aren't in use are dropped when a different size is needed
+BUFFER_POOLS = {}
+BUFFER_POOLS_LOCK = threading.Lock()
+
+
+def Check_Chunk_Size(chunk_size, total_size):
+    '''
+    Returns a chunk size that the upload service will accept
+    None gives the default 5MB
+    s3 needs every part but the last to be at least 5MB, and no more than 10000 parts
+    '''
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    
+    if type(chunk_size) != int:
+        raise Exception('chunk_size needs to be an int or "adaptive", not {}'.format(chunk_size))
+    
+    if chunk_size < MIN_CHUNK_SIZE or chunk_size > MAX_CHUNK_SIZE:
+        raise Exception('chunk_size must be between {} and {} bytes, not {}'.format(MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, chunk_size))
+    
+    # too many chunks - make them bigger
+    smallest_chunk_size = -(-total_size // MAX_NUMBER_OF_CHUNKS)
+    if chunk_size < smallest_chunk_size:
+        chunk_size = smallest_chunk_size
+        
+    return chunk_size
+
+
+def Create_Chunk_Size_Tuner(min_chunk_size=MIN_CHUNK_SIZE, max_chunk_size=MAX_CHUNK_SIZE, samples_per_size=3):
+    '''
+    Returns a dict used to pick chunk sizes for adaptive uploads
+    Candidate sizes double from min_chunk_size up to max_chunk_size
+    Each candidate is tried for samples_per_size full chunks, after that
+    the candidate with the best bytes/sec is used
+    '''
+    assert MIN_CHUNK_SIZE <= min_chunk_size <= max_chunk_size <= MAX_CHUNK_SIZE, 'chunk sizes must be between {} and {}'.format(MIN_CHUNK_SIZE, MAX_CHUNK_SIZE)
+    
+    candidates = []
+    size = min_chunk_size
+    while size <= max_chunk_size:
+        candidates.append(size)
+        size *= 2
+        
+    tuner = {}
+    tuner['candidates'] = candidates
+    tuner['samples_per_size'] = samples_per_size
+    tuner['results'] = {size:{'chunks':0, 'bytes':0, 'seconds':0.0} for size in candidates}
+    tuner['lock'] = threading.Lock() # shared by uploads running at the same time
+    return tuner
+
+
+def Get_Adaptive_Chunk_Size(tuner, total_size):
+    '''
+    Returns the chunk size to use for a file of total_size bytes
+    Chunk size is fixed for a whole file so the resumable params stay the same for every chunk,
+    the tuner learns across the chunks of every upload that uses it
+    '''
+    return Check_Chunk_Size(Get_Chunk_Size_Candidate(tuner, total_size), total_size)
+
+
+def Get_Chunk_Size_Candidate(tuner, total_size):
+    '''
+    Returns the candidate chunk size to try for a file of total_size bytes, before Check_Chunk_Size()
+    Throughput is recorded against the candidate with Record_Chunk_Throughput()
+    '''
+    with tuner['lock']:
+        results = tuner['results']
+        
+        # candidates that the file is big enough to give a full chunk for
+        usable_candidates = [size for size in tuner['candidates'] if size <= total_size]
+        if len(usable_candidates) == 0:
+            # file fits in a single chunk, size makes no difference
+            return tuner['candidates'][0]
+        
+        # try out candidates that haven't been measured enough yet
+        for size in usable_candidates:
+            if results[size]['chunks'] < tuner['samples_per_size']:
+                return size
+            
+        # settle on the fastest
+        return max(usable_candidates, key=lambda size: results[size]['bytes'] / max(results[size]['seconds'], 1e-9))
+
+
+def Record_Chunk_Throughput(tuner, candidate_size, chunk_bytes, seconds):
+    '''
+    Records how long a chunk took to upload, against the candidate from Get_Chunk_Size_Candidate()
+    '''
+    with tuner['lock']:
+        result = tuner['results'][candidate_size]
+        result['chunks'] += 1
+        result['bytes'] += chunk_bytes
+        result['seconds'] += seconds
+
+
+# shared by every adaptive upload in this process
+CHUNK_SIZE_TUNER = Create_Chunk_Size_Tuner()
+
+
+### Upload bandwidth budget - shared by every upload running at the same time ###
+
+def Create_Upload_Scheduler(bytes_per_second=None, max_in_flight_chunks=None):
+    '''
+    Returns a dict used to share bandwidth between uploads running at the same time
+    bytes_per_second is the total upload rate across every file (None for no limit)
+    max_in_flight_chunks is the total number of chunks being sent at once (None for no limit)
+    Each active file has its own token bucket, refilled with its priority weighted share of bytes_per_second,
+    so a big file can't starve small ones
+    '''
+    scheduler = {}
+    scheduler['bytes_per_second'] = bytes_per_second
+    scheduler['max_in_flight_chunks'] = max_in_flight_chunks
+    scheduler['condition'] = threading.Condition()
+    scheduler['uploads'] = {}
+    scheduler['in_flight_chunks'] = 0
+    scheduler['next_upload_id'] = 1
+    return scheduler
+
+
+def Set_Upload_Budget(scheduler, bytes_per_second=None, max_in_flight_chunks=None):
+    '''
+    Changes the limits of a scheduler, uploads that are running pick up the change straight away
+    '''
+    with scheduler['condition']:
+        Refill_Upload_Tokens(scheduler)
+        scheduler['bytes_per_second'] = bytes_per_second
+        scheduler['max_in_flight_chunks'] = max_in_flight_chunks
+        scheduler['condition'].notify_all()
+
+
+def Register_Upload(scheduler, priority=1):
+    '''
+    Adds a file to the scheduler, returns an upload_id used for the rest of its chunks
+    priority is the weight of this file's share of the budget
+    '''
+    assert priority > 0, 'priority must be more than 0'
+    with scheduler['condition']:
+        Refill_Upload_Tokens(scheduler)
+        upload_id = scheduler['next_upload_id']
+        scheduler['next_upload_id'] += 1
+        scheduler['uploads'][upload_id] = {
+                'priority':priority,
+                'tokens':0.0,
+                'last_refill':time.monotonic(),
+                'chunk_bytes':0,
+                'in_flight_chunks':0,
+                'bytes_sent':0,
+                'waiting':False
+                }
+        scheduler['condition'].notify_all()
+    return upload_id
+
+
+def Unregister_Upload(scheduler, upload_id):
+    '''
+    Removes a finished (or failed) file, its share goes to the files still uploading
+    '''
+    with scheduler['condition']:
+        Refill_Upload_Tokens(scheduler)
+        scheduler['uploads'].pop(upload_id, None)
+        scheduler['condition'].notify_all()
+
+
+def Refill_Upload_Tokens(scheduler):
+    '''
+    Tops up every file's bucket with its share of bytes_per_second since the last refill
+    A bucket holds at most 1 second of its share (or one chunk if that's bigger), so idle files can't save up a burst
+    Must be called holding scheduler['condition']
+    '''
+    now = time.monotonic()
+    if scheduler['bytes_per_second'] is None:
+        for upload in scheduler['uploads'].values():
+            upload['last_refill'] = now
+        return
+    
+    total_priority = sum(upload['priority'] for upload in scheduler['uploads'].values())
+    for upload in scheduler['uploads'].values():
+        share = scheduler['bytes_per_second'] * upload['priority'] / total_priority
+        upload['tokens'] = min(upload['tokens'] + share * (now - upload['last_refill']), max(share, upload['chunk_bytes']))
+        upload['last_refill'] = now
+
+
+def Acquire_Upload_Slot(scheduler, upload_id, chunk_bytes):
+    '''
+    Blocks until the chunk can be sent without going over the budget
+    A file can send once its bucket has enough tokens for the chunk
+    When there are more files waiting than free in-flight slots, the file with fewest chunks in flight
+    for its priority goes first
+    '''
+    with scheduler['condition']:
+        upload = scheduler['uploads'][upload_id]
+        upload['waiting'] = True
+        upload['chunk_bytes'] = chunk_bytes
+        while True:
+            Refill_Upload_Tokens(scheduler)
+            wait_seconds = None
+            
+            if scheduler['bytes_per_second'] is not None and upload['tokens'] < chunk_bytes:
+                share = scheduler['bytes_per_second'] * upload['priority'] / sum(u['priority'] for u in scheduler['uploads'].values())
+                wait_seconds = (chunk_bytes - upload['tokens']) / share
+                
+            elif scheduler['max_in_flight_chunks'] is None:
+                break
+            
+            elif scheduler['in_flight_chunks'] < scheduler['max_in_flight_chunks']:
+                # only the most deserving of the files that are ready can have the slot
+                ready_uploads = [(u['in_flight_chunks'] / u['priority'], u['bytes_sent'] / u['priority'], key) 
+                                 for key, u in scheduler['uploads'].items() if u['waiting'] and 
+                                 (scheduler['bytes_per_second'] is None or u['tokens'] >= u['chunk_bytes'])]
+                if min(ready_uploads)[2] == upload_id:
+                    break
+                
+            scheduler['condition'].wait(wait_seconds)
+        
+        upload['waiting'] = False
+        if scheduler['bytes_per_second'] is not None:
+            upload['tokens'] -= chunk_bytes
+        upload['in_flight_chunks'] += 1
+        upload['bytes_sent'] += chunk_bytes
+        scheduler['in_flight_chunks'] += 1
+        # the files still waiting have a new most deserving file, which might be asleep
+        scheduler['condition'].notify_all()
+
+
+def Release_Upload_Slot(scheduler, upload_id):
+    '''
+    Called once a chunk has been sent (or failed)
+    '''
+    with scheduler['condition']:
+        scheduler['in_flight_chunks'] -= 1
+        if upload_id in scheduler['uploads'].keys():
+            scheduler['uploads'][upload_id]['in_flight_chunks'] -= 1
+        scheduler['condition'].notify_all()
+
+
+# shared by every upload in this process - no limits unless set with Set_Upload_Budget()
+UPLOAD_SCHEDULER = Create_Upload_Scheduler()
+
+
+### Building v4s from columns ###
+
+def Iterate_V4_Blocks(observations, dimensions, data_markings=None, block_rows=V4_BLOCK_ROWS):
+    '''
+    Yields a v4 as bytes - the header, then blocks of block_rows rows
+    observations is a column of values (list, numpy array, pandas Series or pyarrow array)
+    dimensions is a list of dicts, one per dimension in v4 order:
+        {'codelist':'calendar-years', 'name':'Time', 'codes':column, 'labels':column}
+    data_markings is an optional dict of {column name:column}, ie {'Data Marking':column}
+    The v4 is laid out as Dimension_Metadata_From_CSVW expects - V4_N, N data marking columns, then code/label pairs
+    Each block is built a column at a time, codes & labels are escaped once per distinct value
+    (keyed on type as well, as 1, 1.0 & True are equal but are written differently)
+    Rows are then put together with a python join per row - nothing is vectorised
+    '''
+    if data_markings is None:
+        data_markings = {}
+    number_of_rows = Check_V4_Table(observations, dimensions, data_markings)
+    
+    yield Get_V4_Header(dimensions, data_markings)
+    
+    columns = Get_V4_Columns(observations, dimensions, data_markings)
+    escaped_values = [{} for column in columns]
+    
+    for start in range(0, number_of_rows, block_rows):
+        stop = min(start + block_rows, number_of_rows)
+        block_columns = []
+        for (column, escape_function), escaped in zip(columns, escaped_values):
+            values = Column_To_List(Slice_Column(column, start, stop))
+            if escape_function == Format_Observation:
+                block_columns.append([Format_Observation(value) for value in values])
+                continue
+            if len(escaped) > V4_ESCAPE_CACHE_SIZE:
+                escaped.clear()
+            keys = list(zip(map(type, values), values))
+            for key in set(keys).difference(escaped.keys()):
+                escaped[key] = Escape_V4_Value(key[1])
+            block_columns.append(list(map(escaped.__getitem__, keys)))
+        yield ('\n'.join(map(','.join, zip(*block_columns))) + '\n').encode('utf-8')
+
+
+def Get_V4_Columns(observations, dimensions, data_markings):
+    '''
+    Returns the columns of a v4 in order, each with the function that formats its values
+    [(column, escape_function), ...]
+    '''
+    columns = [(observations, Format_Observation)]
+    columns += [(column, Escape_V4_Value) for column in data_markings.values()]
+    for dimension in dimensions:
+        columns += [(dimension['codes'], Escape_V4_Value), (dimension['labels'], Escape_V4_Value)]
+    return columns
+
+
+def Check_V4_Table(observations, dimensions, data_markings):
+    '''
+    Checks every column is the same length, returns the number of rows
+    '''
+    number_of_rows = len(observations)
+    assert len(dimensions) > 0, 'v4 needs at least one dimension'
+    for name, column in data_markings.items():
+        assert len(column) == number_of_rows, 'data marking {} has {} rows, observations has {}'.format(name, len(column), number_of_rows)
+    for dimension in dimensions:
+        for key in ('codelist', 'name', 'codes', 'labels'):
+            assert key in dimension.keys(), 'dimension is missing {}'.format(key)
+        for key in ('codes', 'labels'):
+            assert len(dimension[key]) == number_of_rows, '{} {} has {} rows, observations has {}'.format(dimension['name'], key, len(dimension[key]), number_of_rows)
+    return number_of_rows
+
+
+def Get_V4_Header(dimensions, data_markings):
+    '''
+    Returns the header row of a v4 as bytes
+    '''
+    header = ['V4_{}'.format(len(data_markings))]
+    header += list(data_markings.keys())
+    for dimension in dimensions:
+        header += [dimension['codelist'], dimension['name']]
+    return (','.join(Escape_V4_Value(value) for value in header) + '\n').encode('utf-8')
+
+
+def Slice_Column(column, start, stop):
+    '''
+    Returns rows start:stop of a list, numpy array, pandas Series or pyarrow array
+    '''
+    if hasattr(column, 'iloc'):
+        return column.iloc[start:stop]
+    if hasattr(column, 'to_pylist'):
+        return column.slice(start, stop - start)
+    return column[start:stop]
+
+
+def Column_To_List(column):
+    '''
+    Converts a column to a list of python values
+    '''
+    if hasattr(column, 'to_pylist'):
+        return column.to_pylist()
+    if hasattr(column, 'tolist'):
+        return column.tolist()
+    return list(column)
+
+
+def Is_Missing_Value(value):
+    '''
+    True for None, NaN and pandas NA/NaT
+    '''
+    if value is None:
+        return True
+    if type(value) == float:
+        return value != value
+    return type(value).__name__ in ('NAType', 'NaTType')
+
+
+def Format_Observation(value):
+    '''
+    Returns an observation as it appears in a v4 - whole numbers have no decimal point, missing values are blank
+    '''
+    if Is_Missing_Value(value):
+        return ''
+    if type(value) == float and value.is_integer():
+        return str(int(value))
+    return Escape_V4_Value(value)
+
+
+def Escape_V4_Value(value):
+    '''
+    Returns a value as a csv field, quoted if needed
+    '''
+    if Is_Missing_Value(value):
+        return ''
+    value = str(value)
+    if ',' in value or '"' in value or '\n' in value or '\r' in value:
+        return '"{}"'.format(value.replace('"', '""'))
+    return value
+
+
+def Get_V4_Table_Size(observations, dimensions, data_markings=None, block_rows=V4_BLOCK_ROWS):
+    '''
+    Returns the size in bytes of the v4 that Iterate_V4_Blocks would build, without building it
+    Worked out from the widths of each column - each distinct value in a block is formatted & measured once
+    '''
+    if data_markings is None:
+        data_markings = {}
+    number_of_rows = Check_V4_Table(observations, dimensions, data_markings)
+    columns = Get_V4_Columns(observations, dimensions, data_markings)
+    
+    # a comma after every field but the last in a row, and a newline after the last
+    v4_size = len(Get_V4_Header(dimensions, data_markings)) + number_of_rows * len(columns)
+    for column, escape_function in columns:
+        widths = {}
+        for start in range(0, number_of_rows, block_rows):
+            stop = min(start + block_rows, number_of_rows)
+            if len(widths) > V4_ESCAPE_CACHE_SIZE:
+                widths.clear()
+            values = Column_To_List(Slice_Column(column, start, stop))
+            for key, count in collections.Counter(zip(map(type, values), values)).items():
+                if key not in widths.keys():
+                    widths[key] = len(escape_function(key[1]).encode('utf-8'))
+                v4_size += widths[key] * count
+    return v4_size
+
+
+def Write_V4_Table(v4, observations, dimensions, data_markings=None, block_rows=V4_BLOCK_ROWS):
+    '''
+    Writes a v4 built from columns to disk, for when a file is needed rather than an upload
+    Returns the size of the v4
+    '''
+    v4_size = 0
+    with open(v4, 'wb') as f:
+        for block in Iterate_V4_Blocks(observations, dimensions, data_markings, block_rows):
+            f.write(block)
+            v4_size += len(block)
+    return v4_size
+
+
+class Block_Stream(io.RawIOBase):
+    '''
+    Read only file object over an iterable of bytes blocks, so they can be passed to Post_Stream_To_S3
+    '''
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.block = memoryview(b'')
+        
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while len(self.block) == 0:
+            try:
+                self.block = memoryview(next(self.blocks))
+            except StopIteration:
+                return 0
+        n = min(len(buffer), len(self.block))
+        buffer[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+
+def Post_V4_Table_To_S3(access_token, file_name, observations, dimensions, data_markings=None, chunk_size=None, 
+                        progress_callback=None, dataset_id=None, priority=1, block_rows=V4_BLOCK_ROWS):
+    '''
+    Builds a v4 from columns (see Iterate_V4_Blocks) and uploads it without writing it to disk
+    file_name is the name the upload is given, ie 'v4-cpih.csv'
+    Its size is worked out from the columns first (needed before the first chunk is sent), the v4 is only built as it is uploaded
+    Returns the s3_url
+    '''
+    v4_size = Get_V4_Table_Size(observations, dimensions, data_markings, block_rows)
+    stream = Block_Stream(Iterate_V4_Blocks(observations, dimensions, data_markings, block_rows))
+    return Post_Stream_To_S3(access_token, stream, v4_size, file_name, chunk_size=chunk_size, 
+                             progress_callback=progress_callback, dataset_id=dataset_id, priority=priority)
+    
+
+def Get_State_Of_Instance(access_token, instance_id):
+    '''
+    Checks state of an instance
+    Returns job_state
+    '''
+    import_progress = Get_Import_Progress(access_token, instance_id)
+    Print_Import_Progress(import_progress)
+    job_state = import_progress['state']
+    return job_state
+
+
+def Get_Import_Progress(access_token, instance_id):
+    '''
+    Returns the state of an instance and how many observations have been imported
+    {state:'', total_inserted_observations:int, total_observations:int}
+    Observation counts are None if not known
+    '''
+    instance_id_url = 'https://publishing.ons.gov.uk/dataset/instances/' + instance_id
+    headers = {'X-Florence-Token':access_token}
+    
+    r = session.get(instance_id_url, headers=headers)
+    if r.status_code != 200:
+        raise Exception('{} raised a {} error'.format(instance_id_url, r.status_code))
+        
+    dataset_instance_dict = r.json()
+    job_state = dataset_instance_dict['state']
+    
+    import_progress = {}
+    import_progress['state'] = job_state
+    import_progress['total_observations'] = dataset_instance_dict.get('total_observations')
+    try:
+        import_progress['total_inserted_observations'] = dataset_instance_dict['import_tasks']['import_observations']['total_inserted_observations']
+    except (KeyError, TypeError):
+        import_progress['total_inserted_observations'] = None
+    
+    if job_state == 'submitted' and import_progress['total_observations'] is None:
+        error_message = dataset_instance_dict['events'][0]['message']
+        print('Job is submitted but total_observations could not be determined')
+        print('An error has occured')
+        raise Exception(error_message)
+        
+    return import_progress
+
+
+def Print_Import_Progress(import_progress, dataset_id=None):
+    '''
+    Prints the state of an instance from Get_Import_Progress()
+    Lines start with dataset_id if given
+    '''
+    job_state = import_progress['state']
+    if dataset_id is None:
+        prefix = ''
+    else:
+        prefix = '{} - '.format(dataset_id)
+    
+    if job_state == 'created':
+        print(prefix + 'State of instance is "{}", import process has not been triggered'.format(job_state))
+        
+    elif job_state == 'submitted':
+        print(prefix + 'Import process is running')
+        print(prefix + '{} out of {} observations have been imported'.format(import_progress['total_inserted_observations'], import_progress['total_observations']))
+    
+    elif job_state == 'completed':
+        print(prefix + 'Import complete!')
+        
+    else:
+        print(prefix + 'Instance has state - "{}"'.format(job_state))
+
+
+### Progress events ###
+# progress_callback is called with a dict for each event, tagged with the dataset_id
+# upload - {event:'chunk_sent', dataset_id, chunk_number, total_chunks, bytes_sent, total_bytes, 
+#           seconds_elapsed, mb_per_second, eta_seconds}
+# import - {event:'import_progress', dataset_id, instance_id, state, inserted_observations, total_observations,
+#           seconds_elapsed, observations_per_second, eta_seconds}
+
+def Create_Progress_Tracker(total, window=5, done=0):
+    '''
+    Returns a dict used to work out a moving average rate & ETA
+    total is the amount to be done - bytes or observations, done is the amount already done
+    Rate is averaged over the last window updates
+    '''
+    start_time = time.perf_counter()
+    tracker = {}
+    tracker['start_time'] = start_time
+    tracker['total'] = total
+    tracker['window'] = window
+    tracker['samples'] = [(start_time, done)]
+    return tracker
+
+
+def Update_Progress_Tracker(tracker, done):
+    '''
+    Adds how much is done so far to the tracker
+    Returns seconds_elapsed, rate (per second) and eta_seconds (None if rate not known yet)
+    '''
+    now = time.perf_counter()
+    tracker['samples'].append((now, done))
+    tracker['samples'] = tracker['samples'][-(tracker['window'] + 1):]
+    
+    first_time, first_done = tracker['samples'][0]
+    seconds = now - first_time
+    if seconds > 0 and done > first_done:
+        rate = (done - first_done) / seconds
+    else:
+        rate = 0.0
+        
+    if rate > 0 and tracker['total'] is not None:
+        eta_seconds = max(tracker['total'] - done, 0) / rate
+    else:
+        eta_seconds = None
+        
+    return now - tracker['start_time'], rate, eta_seconds
+
+
+def Print_Progress(event):
+    '''
+    A progress_callback that prints each event on one line
+    '''
+    if event['eta_seconds'] is None:
+        eta = '?'
+    else:
+        eta = '{:.0f}s'.format(event['eta_seconds'])
+        
+    if event['event'] == 'chunk_sent':
+        print('{} - chunk {}/{} sent, {:.1f} MB/s, ETA {}'.format(
+                event['dataset_id'], event['chunk_number'], event['total_chunks'], event['mb_per_second'], eta))
+    elif event['event'] == 'import_progress':
+        print('{} - {} out of {} observations imported, {:.0f} obs/s, ETA {}'.format(
+                event['dataset_id'], event['inserted_observations'], event['total_observations'], event['observations_per_second'], eta))
+
+
+def Create_Progress_Queue():
+    '''
+    Returns a progress_callback and the queue.Queue that it puts events on
+    Lets a batch runner read events from every upload in one place
+    '''
+    progress_queue = queue.Queue()
+    return progress_queue.put, progress_queue
+
+
+def Create_Async_Progress_Queue(loop):
+    '''
+    Returns a progress_callback and an asyncio.Queue on loop that it puts events on
+    The callback can be called from any thread
+    '''
+    progress_queue = asyncio.Queue()
+    
+    def progress_callback(event):
+        loop.call_soon_threadsafe(progress_queue.put_nowait, event)
+        
+    return progress_callback, progress_queue
+
+
+def Update_Metadata(access_token, dataset_id, metadata_dict):
+    '''
+    Used to update all metadata except dimensional data and usage notes
+    Updates using /dataset/datasets/{id}
+    Can be used before or after data is in collection
+    This metadata is saved in CMD
+    Not all fields are required - only ones that need changing
+
+    metadata is a dict with format (possible others)
+    {
+    collection_id : '' (may not be needed)
+    contact : [{email : '', name : '', telephone : ''}] 
+    description : '' (Summary section in florence)
+    next_release : ''
+    release_frequency : ''
     title : '' (Title section in florence)
     unit_of_measure : ''
     keywords : []
@@ -687,7 +2261,7 @@ def Update_Metadata(access_token, dataset_id, metadata_dict):
     dataset_url = 'https://publishing.ons.gov.uk/dataset/datasets/' + dataset_id
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.put(dataset_url, headers=headers, json=metadata)
+    r = session.put(dataset_url, headers=headers, json=metadata)
     if r.status_code != 200:
         print('Metadata not updated, returned a {} error'.format(r.status_code))
     else:
@@ -719,7 +2293,7 @@ def Update_Dimensions(access_token, dataset_id, instance_id, metadata_dict):
           
         # making the request for each dimension separately
         dimension_url = instance_url + '/dimensions/' + dimension
-        r = requests.put(dimension_url, headers=headers, json=new_dimension_info)
+        r = session.put(dimension_url, headers=headers, json=new_dimension_info)
         
         if r.status_code != 200:
             print('Dimension info not updated for {}, returned a {} error'.format(dimension, r.status_code))
@@ -749,11 +2323,7 @@ def Update_Usage_Notes(access_token, dataset_id, version_number, metadata_dict,
         return 'No usage notes to add'
     
     usage_notes = metadata_dict['usage_notes']
-        
-    assert type(usage_notes) == list, 'usage notes must be in a list'
-    for item in usage_notes:
-        for key in item.keys():
-            assert key in ('note', 'title'), 'usage note can only have a note and/or a title'
+    Check_Usage_Notes(usage_notes)
         
     usage_notes_to_add = {}
     usage_notes_to_add['usage_notes'] = usage_notes
@@ -761,13 +2331,23 @@ def Update_Usage_Notes(access_token, dataset_id, version_number, metadata_dict,
     version_url = 'https://publishing.ons.gov.uk/dataset/datasets/{}/editions/{}/versions/{}'.format(dataset_id, edition, version_number)
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.put(version_url, headers=headers, json=usage_notes_to_add)
+    r = session.put(version_url, headers=headers, json=usage_notes_to_add)
     if r.status_code == 200:
         print('Usage notes added')
     else:
         print('Usage notes not added, returned a {} error'.format(r.status_code))
-     
-    
+        
+        
+def Check_Usage_Notes(usage_notes):
+    '''
+    Checks usage notes are a list of dicts with only a note and/or a title
+    '''
+    assert type(usage_notes) == list, 'usage notes must be in a list'
+    for item in usage_notes:
+        for key in item.keys():
+            assert key in ('note', 'title'), 'usage note can only have a note and/or a title'
+     
+    
 def Get_Version_number(access_token, dataset_id, instance_id):
     '''
     Gets version number of instance ready to be published from /datasets/instances{instance_id}
@@ -779,7 +2359,7 @@ def Get_Version_number(access_token, dataset_id, instance_id):
     instance_url = 'https://publishing.ons.gov.uk/dataset/instances/' + instance_id
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(instance_url, headers=headers)
+    r = session.get(instance_url, headers=headers)
     if r.status_code != 200:
         raise Exception('/datasets/{}/instances/{} returned a {} error'.format(dataset_id, instance_id, r.status_code))
         
@@ -919,10 +2499,196 @@ def Usage_Notes_From_CSVW(usage_notes):
 
 
 
-def Upload_Metadata_To_Cmd(credentials, dataset_id, metadata_file, instance_id, edition):
+def Get_Dataset_Info(access_token, dataset_id):
+    '''
+    Returns the dataset document from /dataset/datasets/{id}
+    '''
+    dataset_url = 'https://publishing.ons.gov.uk/dataset/datasets/' + dataset_id
+    headers = {'X-Florence-Token':access_token}
+    
+    r = session.get(dataset_url, headers=headers)
+    if r.status_code == 200:
+        dataset_dict = r.json()
+        return dataset_dict
+    else:
+        raise Exception('/dataset/datasets/{} returned a {} error'.format(dataset_id, r.status_code))
+    
+    
+def Get_Version_Info(access_token, dataset_id, edition, version_number):
+    '''
+    Returns the version document from /dataset/datasets/{id}/editions/{edition}/versions/{version}
+    '''
+    version_url = 'https://publishing.ons.gov.uk/dataset/datasets/{}/editions/{}/versions/{}'.format(dataset_id, edition, version_number)
+    headers = {'X-Florence-Token':access_token}
+    
+    r = session.get(version_url, headers=headers)
+    if r.status_code == 200:
+        version_dict = r.json()
+        return version_dict
+    else:
+        raise Exception('/dataset/datasets/{}/editions/{}/versions/{} returned a {} error'.format(dataset_id, edition, version_number, r.status_code))
+
+
+def Get_Current_Metadata(access_token, dataset_id, instance_id, edition=None, version_number=None):
+    '''
+    Fetches the dataset, instance and version documents concurrently
+    Returns the metadata currently in CMD in the same format as Read_CSVW()
+    Usage notes are only fetched if edition and version_number are given
+    '''
+    dataset_dict, instance_dict, version_dict = Get_Metadata_Documents(access_token, dataset_id, instance_id, edition, version_number)
+    return Current_Metadata_From_Documents(dataset_dict, instance_dict, version_dict)
+
+
+def Get_Metadata_Documents(access_token, dataset_id, instance_id, edition=None, version_number=None):
+    '''
+    Fetches the dataset, instance and version documents concurrently
+    Returns (dataset_dict, instance_dict, version_dict) - version_dict is {} if edition or version_number aren't given
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        dataset_future = executor.submit(Get_Dataset_Info, access_token, dataset_id)
+        instance_future = executor.submit(Get_Dataset_Instance_Info, access_token, instance_id)
+        if edition is not None and version_number is not None:
+            version_future = executor.submit(Get_Version_Info, access_token, dataset_id, edition, version_number)
+        else:
+            version_future = None
+        
+        dataset_dict = dataset_future.result()
+        instance_dict = instance_future.result()
+        if version_future is not None:
+            version_dict = version_future.result()
+        else:
+            version_dict = {}
+            
+    return dataset_dict, instance_dict, version_dict
+
+
+def Current_Metadata_From_Documents(dataset_dict, instance_dict, version_dict):
+    '''
+    Returns the metadata in the dataset, instance & version documents in the same format as Read_CSVW()
+    '''
+    current_metadata_dict = {}
+    
+    # unpublished changes are in 'next'
+    if 'next' in dataset_dict.keys():
+        current_metadata_dict['metadata'] = dataset_dict['next']
+    elif 'current' in dataset_dict.keys():
+        current_metadata_dict['metadata'] = dataset_dict['current']
+    else:
+        current_metadata_dict['metadata'] = dataset_dict
+        
+    current_metadata_dict['dimension_data'] = {}
+    for dimension in instance_dict.get('dimensions', []):
+        current_metadata_dict['dimension_data'][dimension['name']] = dimension
+        
+    current_metadata_dict['usage_notes'] = version_dict.get('usage_notes', [])
+    
+    return current_metadata_dict
+
+
+def Normalise_Metadata_Value(value):
+    '''
+    Normalises a metadata value so that CSVW and CMD values can be compared
+    Strips whitespace & line endings, treats None as ''
+    '''
+    if value is None:
+        return ''
+    if type(value) == str:
+        return ' '.join(value.split())
+    if type(value) == list:
+        return [Normalise_Metadata_Value(item) for item in value]
+    if type(value) == dict:
+        return {key:Normalise_Metadata_Value(value[key]) for key in value.keys()}
+    return value
+
+
+def Metadata_Value_Matches(new_value, current_value):
+    '''
+    Checks if new_value is already in CMD as current_value
+    Only keys in new_value are compared - CMD adds its own keys to dicts
+    '''
+    new_value = Normalise_Metadata_Value(new_value)
+    current_value = Normalise_Metadata_Value(current_value)
+    
+    if type(new_value) == dict:
+        if type(current_value) != dict:
+            return False
+        for key in new_value.keys():
+            if not Metadata_Value_Matches(new_value[key], current_value.get(key)):
+                return False
+        return True
+    
+    if type(new_value) == list:
+        if type(current_value) != list or len(new_value) != len(current_value):
+            return False
+        for new_item, current_item in zip(new_value, current_value):
+            if not Metadata_Value_Matches(new_item, current_item):
+                return False
+        return True
+    
+    return new_value == current_value
+
+
+def Get_Metadata_Changes(metadata_dict, current_metadata_dict):
+    '''
+    Compares metadata_dict from Read_CSVW() to current_metadata_dict from Get_Current_Metadata()
+    Returns a metadata_dict with only what has changed, and a dict of what was skipped
+    Usage notes are all or nothing as the PUT replaces the existing ones
+    '''
+    changed_metadata_dict = {'metadata':{}, 'dimension_data':{}, 'usage_notes':[]}
+    skipped_dict = {'metadata':[], 'dimension_data':[], 'usage_notes':False}
+    
+    for key in metadata_dict['metadata'].keys():
+        if Metadata_Value_Matches(metadata_dict['metadata'][key], current_metadata_dict['metadata'].get(key)):
+            skipped_dict['metadata'].append(key)
+        else:
+            changed_metadata_dict['metadata'][key] = metadata_dict['metadata'][key]
+            
+    for dimension in metadata_dict['dimension_data'].keys():
+        if Metadata_Value_Matches(metadata_dict['dimension_data'][dimension], current_metadata_dict['dimension_data'].get(dimension)):
+            skipped_dict['dimension_data'].append(dimension)
+        else:
+            changed_metadata_dict['dimension_data'][dimension] = metadata_dict['dimension_data'][dimension]
+            
+    if len(metadata_dict['usage_notes']) != 0:
+        if Metadata_Value_Matches(metadata_dict['usage_notes'], current_metadata_dict['usage_notes']):
+            skipped_dict['usage_notes'] = True
+        else:
+            changed_metadata_dict['usage_notes'] = metadata_dict['usage_notes']
+            
+    return changed_metadata_dict, skipped_dict
+
+
+def Update_Changed_Metadata(access_token, dataset_id, instance_id, metadata_dict, edition, version_number):
+    '''
+    Diff mode of Update_Metadata(), Update_Dimensions() & Update_Usage_Notes()
+    Compares metadata_dict to what is already in CMD and only sends what has changed
+    Instance should already have a version number
+    Returns a dict of what was skipped
+    '''
+    current_metadata_dict = Get_Current_Metadata(access_token, dataset_id, instance_id, edition, version_number)
+    changed_metadata_dict, skipped_dict = Get_Metadata_Changes(metadata_dict, current_metadata_dict)
+    
+    if len(changed_metadata_dict['metadata']) != 0:
+        Update_Metadata(access_token, dataset_id, changed_metadata_dict)
+    if len(skipped_dict['metadata']) != 0:
+        print('Metadata unchanged, skipped - {}'.format(', '.join(skipped_dict['metadata'])))
+        
+    Update_Dimensions(access_token, dataset_id, instance_id, changed_metadata_dict)
+    if len(skipped_dict['dimension_data']) != 0:
+        print('Dimensions unchanged, skipped - {}'.format(', '.join(skipped_dict['dimension_data'])))
+        
+    Update_Usage_Notes(access_token, dataset_id, version_number, changed_metadata_dict, edition)
+    if skipped_dict['usage_notes']:
+        print('Usage notes unchanged, skipped')
+        
+    return skipped_dict
+
+
+def Upload_Metadata_To_Cmd(credentials, dataset_id, metadata_file, instance_id, edition, skip_unchanged=False):
     '''
     Uploads metadata into CMD
     Data should already be in a collection
+    skip_unchanged=True only sends metadata that is different to what is in CMD
     '''
         
     # Get access token
@@ -931,6 +2697,14 @@ def Upload_Metadata_To_Cmd(credentials, dataset_id, metadata_file, instance_id,
     # Reading in csv-w and formatting for the CMD API functions
     metadata_dict = Read_CSVW(metadata_file)
     
+    if skip_unchanged:
+        # Get version number of instance -> has to be in collection
+        version_number = Get_Version_number(access_token, dataset_id, instance_id)
+        
+        # Update only what has changed
+        Update_Changed_Metadata(access_token, dataset_id, instance_id, metadata_dict, edition, version_number)
+        return
+    
     # Updating general metadata
     Update_Metadata(access_token, dataset_id, metadata_dict)
     
@@ -947,6 +2721,225 @@ def Upload_Metadata_To_Cmd(credentials, dataset_id, metadata_file, instance_id,
     
     
 
+### Bulk metadata backfill ###
+# Re-applies csv-w metadata to many datasets/versions that are already imported
+# Every write (dataset metadata, each dimension, usage notes) is a separate task run concurrently under a rate limit
+# Each item's result is appended to a journal (one json per line), items already done are skipped on a re-run
+
+def Backfill_Metadata(credentials, items, journal_file, max_workers=8, requests_per_second=10, skip_unchanged=False, parse_processes=None):
+    '''
+    items is a list of dicts (or tuples in this order):
+        {dataset_id:'', edition:'', instance_id:'' and/or version:'', metadata_file:''}
+    csv-ws are read in parallel (parse_processes processes, 0 to read them in this process)
+    skip_unchanged=True only sends metadata that is different to what is in CMD
+    Returns a dict of results for each item, keyed as in the journal
+    '''
+    items = [Check_Backfill_Item(item) for item in items]
+    journal = Read_Backfill_Journal(journal_file)
+    items_to_do = [item for item in items if journal.get(item['key'], {}).get('state') != 'done']
+    print('Backfilling {} items, {} already done'.format(len(items_to_do), len(items) - len(items_to_do)))
+    if len(items_to_do) == 0:
+        return {item['key']:journal[item['key']] for item in items}
+    
+    access_token = Get_Access_Token(credentials)
+    metadata_dicts = Read_CSVWs(set(item['metadata_file'] for item in items_to_do), parse_processes)
+    rate_limiter = Create_Rate_Limiter(requests_per_second)
+    journal_lock = threading.Lock()
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as write_executor:
+        def backfill_item(item):
+            try:
+                if isinstance(metadata_dicts[item['metadata_file']], Exception):
+                    raise metadata_dicts[item['metadata_file']]
+                result = Backfill_Item(access_token, item, metadata_dicts[item['metadata_file']], write_executor, rate_limiter, skip_unchanged)
+            except Exception as e:
+                result = {'state':'failed', 'error':str(e)}
+            result['item'] = {key:value for key, value in item.items() if key != 'key'}
+            result['updated'] = datetime.datetime.now().isoformat(timespec='seconds')
+            with journal_lock:
+                Append_Backfill_Journal(journal_file, item['key'], result)
+            print('{} - {}'.format(item['key'], result['state']))
+            return result
+        
+        # items only wait on their writes, so they get their own threads
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as item_executor:
+            for item, result in zip(items_to_do, item_executor.map(backfill_item, items_to_do)):
+                journal[item['key']] = result
+                
+    # only this run's items, the journal can have items from other runs
+    failed = [item['key'] for item in items if journal[item['key']]['state'] != 'done']
+    if len(failed) != 0:
+        print('{} items failed, run again with the same journal_file to retry them - {}'.format(len(failed), ', '.join(failed)))
+    return {item['key']:journal[item['key']] for item in items}
+
+
+def Check_Backfill_Item(item):
+    '''
+    Returns an item as a dict with a key used in the journal
+    '''
+    if type(item) in (tuple, list):
+        assert len(item) == 4, 'backfill item tuples should be (dataset_id, edition, instance_id or version, metadata_file)'
+        dataset_id, edition, instance_or_version, metadata_file = item
+        item = {'dataset_id':dataset_id, 'edition':edition, 'metadata_file':metadata_file}
+        # version numbers are short numbers, instance ids are uuids
+        if str(instance_or_version).isdigit():
+            item['version'] = str(instance_or_version)
+        else:
+            item['instance_id'] = instance_or_version
+    else:
+        item = dict(item)
+        
+    for key in ('dataset_id', 'edition', 'metadata_file'):
+        assert key in item.keys(), 'backfill item must have key - "{}"'.format(key)
+    assert 'instance_id' in item.keys() or 'version' in item.keys(), 'backfill item must have an instance_id or version'
+    
+    item['key'] = '{}/{}/{}/{}'.format(item['dataset_id'], item['edition'], item.get('instance_id', item.get('version')), item['metadata_file'])
+    return item
+
+
+def Read_CSVWs(metadata_files, parse_processes=None):
+    '''
+    Reads every csv-w in parallel
+    Returns a dict of {metadata_file:metadata_dict}, or the exception if a file couldn't be read
+    '''
+    metadata_files = sorted(metadata_files)
+    metadata_dicts = {}
+    if parse_processes == 0 or len(metadata_files) == 1:
+        for metadata_file in metadata_files:
+            try:
+                metadata_dicts[metadata_file] = Read_CSVW(metadata_file)
+            except Exception as e:
+                metadata_dicts[metadata_file] = e
+        return metadata_dicts
+    
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parse_processes) as executor:
+        futures = {executor.submit(Read_CSVW, metadata_file):metadata_file for metadata_file in metadata_files}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                metadata_dicts[futures[future]] = future.result()
+            except Exception as e:
+                metadata_dicts[futures[future]] = e
+    return metadata_dicts
+
+
+def Backfill_Item(access_token, item, metadata_dict, write_executor, rate_limiter, skip_unchanged=False):
+    '''
+    Sends the dataset, dimension & usage note writes for one item concurrently on write_executor
+    Returns a result with the state of each write
+    '''
+    dataset_id = item['dataset_id']
+    edition = item['edition']
+    headers = {'X-Florence-Token':access_token}
+    
+    # fill in whichever of instance_id & version_number is missing
+    if 'instance_id' in item.keys():
+        instance_id = item['instance_id']
+        version_number = item.get('version')
+        if version_number is None:
+            Wait_For_Rate_Limit(rate_limiter)
+            version_number = Get_Version_number(access_token, dataset_id, instance_id)
+    else:
+        version_number = item['version']
+        Wait_For_Rate_Limit(rate_limiter)
+        instance_id = Get_Version_Info(access_token, dataset_id, edition, version_number)['id']
+    
+    skipped_dict = None
+    if skip_unchanged:
+        Wait_For_Rate_Limit(rate_limiter)
+        current_metadata_dict = Get_Current_Metadata(access_token, dataset_id, instance_id, edition, version_number)
+        metadata_dict, skipped_dict = Get_Metadata_Changes(metadata_dict, current_metadata_dict)
+    
+    writes = {}
+    if len(metadata_dict['metadata']) != 0:
+        writes['metadata'] = ('https://publishing.ons.gov.uk/dataset/datasets/' + dataset_id, metadata_dict['metadata'])
+    for dimension, dimension_info in metadata_dict['dimension_data'].items():
+        writes['dimension/' + dimension] = ('https://publishing.ons.gov.uk/dataset/instances/{}/dimensions/{}'.format(instance_id, dimension), dimension_info)
+    if len(metadata_dict['usage_notes']) != 0:
+        Check_Usage_Notes(metadata_dict['usage_notes'])
+        version_url = 'https://publishing.ons.gov.uk/dataset/datasets/{}/editions/{}/versions/{}'.format(dataset_id, edition, version_number)
+        writes['usage_notes'] = (version_url, {'usage_notes':metadata_dict['usage_notes']})
+    
+    futures = {name:write_executor.submit(Put_With_Rate_Limit, url, headers, body, rate_limiter) for name, (url, body) in writes.items()}
+    
+    result = {'state':'done', 'instance_id':instance_id, 'version':version_number, 'writes':{}, 'error':None}
+    for name, future in futures.items():
+        try:
+            future.result()
+            result['writes'][name] = 'updated'
+        except Exception as e:
+            result['writes'][name] = str(e)
+            result['state'] = 'failed'
+            result['error'] = 'some writes failed'
+    if skipped_dict is not None:
+        result['skipped'] = skipped_dict
+    return result
+
+
+def Put_With_Rate_Limit(url, headers, body, rate_limiter):
+    '''
+    PUT once the rate limiter allows it, raises if it isn't a 200
+    '''
+    Wait_For_Rate_Limit(rate_limiter)
+    r = session.put(url, headers=headers, json=body)
+    if r.status_code != 200:
+        raise Exception('{} returned a {} error'.format(url, r.status_code))
+
+
+def Create_Rate_Limiter(requests_per_second=None):
+    '''
+    Returns a dict used to space requests out to at most requests_per_second (None for no limit)
+    '''
+    rate_limiter = {}
+    rate_limiter['interval'] = None if requests_per_second is None else 1 / requests_per_second
+    rate_limiter['next_time'] = time.monotonic()
+    rate_limiter['lock'] = threading.Lock()
+    return rate_limiter
+
+
+def Wait_For_Rate_Limit(rate_limiter):
+    '''
+    Blocks until the next request is allowed
+    '''
+    if rate_limiter['interval'] is None:
+        return
+    with rate_limiter['lock']:
+        now = time.monotonic()
+        wait_seconds = rate_limiter['next_time'] - now
+        rate_limiter['next_time'] = max(now, rate_limiter['next_time']) + rate_limiter['interval']
+    if wait_seconds > 0:
+        time.sleep(wait_seconds)
+
+
+def Read_Backfill_Journal(journal_file):
+    '''
+    Returns the latest result for each item in a backfill journal, {} if there isn't one yet
+    '''
+    journal = {}
+    if not os.path.exists(journal_file):
+        return journal
+    with open(journal_file, 'r') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a line cut short if the last run was stopped mid-write
+                continue
+            journal[entry['key']] = entry['result']
+    return journal
+
+
+def Append_Backfill_Journal(journal_file, key, result):
+    '''
+    Adds the result of an item to the journal, flushed straight away so a re-run can pick up from here
+    '''
+    with open(journal_file, 'a') as f:
+        f.write(json.dumps({'key':key, 'result':result}, default=str) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        
+
 def Create_Collection(access_token, collection_name):
     '''
     Creates a collection with called 'collection name'
@@ -955,7 +2948,7 @@ def Create_Collection(access_token, collection_name):
     collection_url = 'https://publishing.ons.gov.uk/zebedee/collection'
     headers = {'X-Florence-Token':access_token}
     
-    requests.post(collection_url, headers=headers, json={'name':collection_name})
+    session.post(collection_url, headers=headers, json={'name':collection_name})
     
 def Check_Collection_Exists(access_token, collection_name):
     '''
@@ -967,7 +2960,7 @@ def Check_Collection_Exists(access_token, collection_name):
     collection_url = 'https://publishing.ons.gov.uk/zebedee/collection'
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(collection_url + '/' + collection_name_for_url, headers=headers)
+    r = session.get(collection_url + '/' + collection_name_for_url, headers=headers)
     if r.status_code != 200:
         raise Exception('Collection "{}" not created - returned a {} error'.format(collection_name, r.status_code))
     
@@ -980,7 +2973,7 @@ def Get_Collection_Id(access_token, collection_name):
     collection_url = 'https://publishing.ons.gov.uk/zebedee/collection'
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.get(collection_url + '/' + collection_name_for_url, headers=headers)
+    r = session.get(collection_url + '/' + collection_name_for_url, headers=headers)
     if r.status_code == 200:
         collection_dict = r.json()
         collection_id = collection_dict['id']
@@ -995,7 +2988,7 @@ def Add_Dataset_To_Collection(access_token, collection_id, dataset_id):
     url = 'https://publishing.ons.gov.uk/zebedee/collections/{}/datasets/{}'.format(collection_id, dataset_id)
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.put(url, headers=headers, json={"state": "Complete"})
+    r = session.put(url, headers=headers, json={"state": "Complete"})
     if r.status_code == 200:
         print('{} - Dataset landing page added to collection'.format(dataset_id))
     else:
@@ -1008,7 +3001,7 @@ def Add_Dataset_Version_To_Collection(access_token, collection_id, dataset_id, e
     url = 'https://publishing.ons.gov.uk/zebedee/collections/{}/datasets/{}/editions/{}/versions/{}'.format(collection_id, dataset_id, edition, version_number)
     headers = {'X-Florence-Token':access_token}
     
-    r = requests.put(url, headers=headers, json={"state": "Complete"})
+    r = session.put(url, headers=headers, json={"state": "Complete"})
     if r.status_code == 200:
         print('{} - Dataset version "{}" added to collection'.format(dataset_id, version_number))
     else:
@@ -1027,7 +3020,7 @@ def Create_New_Version_From_Instance(access_token, instance_id, edition):
     current_date = datetime.datetime.now()
     release_date = datetime.datetime.strftime(current_date, '%Y-%m-%dT00:00:00.000Z')
     
-    r = requests.put(instance_url, headers=headers, json={'edition':edition, 
+    r = session.put(instance_url, headers=headers, json={'edition':edition, 
                                                           'state':'edition-confirmed', 
                                                           'release_date': release_date})
     if r.status_code == 200:
@@ -1045,12 +3038,12 @@ def Create_New_Dataset(access_token, dataset_id):
     headers = {'X-Florence-Token':access_token}
     
     # Quick check to make sure it doesn't already exist
-    r = requests.get(dataset_url, headers=headers)
+    r = session.get(dataset_url, headers=headers)
     
     if r.status_code == 200: # expecting 404
         raise Exception('Dataset "{}" already exists'.format(dataset_id))
     
-    r = requests.post(dataset_url, headers=headers, json={'id':dataset_id})
+    r = session.post(dataset_url, headers=headers, json={'id':dataset_id})
     if r.status_code == 201:
         print('Dataset - "{}" successfully created in dataset api'.format(dataset_id))
     else:
@@ -1087,9 +3080,10 @@ def Add_Data_To_Collection(credentials, dataset_id, instance_id, edition, collec
     Add_Dataset_Version_To_Collection(access_token, collection_id, dataset_id, edition, version_number)
 
     
-def Upload_To_Cmd(credentials, dataset_id, edition, v4, metadata_file, collection_name):
+def Upload_To_Cmd(credentials, dataset_id, edition, v4, metadata_file, collection_name, chunk_size=None):
     '''
     Full upload process - including metadata and adding to collection
+    chunk_size is passed to Post_V4_To_S3
     '''
     
     ### Upload data into cmd ###
@@ -1100,7 +3094,7 @@ def Upload_To_Cmd(credentials, dataset_id, edition, v4, metadata_file, collectio
     Check_Recipe_Exists(access_token, dataset_id)
     
     # upload v4 into s3 bucket
-    s3_url = Post_V4_To_S3(access_token, v4)
+    s3_url = Post_V4_To_S3(access_token, v4, chunk_size=chunk_size)
     
     # create new job
     job_id, instance_id = Post_New_Job(access_token, dataset_id, s3_url)
@@ -1108,51 +3102,14 @@ def Upload_To_Cmd(credentials, dataset_id, edition, v4, metadata_file, collectio
     # update state of job
     Update_State_Of_Job(access_token, job_id)
     
-    ### Monitioring state of upload ###
-    state_of_upload = '' # updated in while loop
-    
-    # start while loop
-    while state_of_upload != 'completed':
-        time.sleep(30) # checks every 30 seconds
-        state_of_upload = Get_State_Of_Instance(access_token, instance_id)
-    # Upload now complete
-    
-    ### Create and check collection ###
-    # Create new collection
-    Create_Collection(access_token, collection_name)
-    
-    # Quick check to make sure collection was created
-    Check_Collection_Exists(access_token, collection_name)
-    
-    # Return collection_id
-    collection_id = Get_Collection_Id(access_token, collection_name)
-    
-    ### Updating metadata main page ###
-    # Reading in csv-w and formatting for the CMD API functions
-    metadata_dict = Read_CSVW(metadata_file)
-    
-    # Updating general metadata
-    Update_Metadata(access_token, dataset_id, metadata_dict)
-    
-    ### Attaching the instance to the newly created collection
-    # Assigning instance a version number
-    Create_New_Version_From_Instance(access_token, instance_id, edition)
-    
-    # Get new version number
-    version_number = Get_Version_number(access_token, dataset_id, instance_id)
-    
-    # Add landing page to collection
-    Add_Dataset_To_Collection(access_token, collection_id, dataset_id)
-    
-    # Add new version to collection
-    Add_Dataset_Version_To_Collection(access_token, collection_id, dataset_id, edition, version_number)
-    
-    ### Updating final parts of metadata ###
-    # Updating dimension metadata
-    Update_Dimensions(access_token, dataset_id, instance_id, metadata_dict)
-    
-    # Update_Usage_Notes
-    Update_Usage_Notes(access_token, dataset_id, version_number, metadata_dict, edition)
+    ### Monitioring state of upload, adding metadata, adding data to collection ###
+    upload_info = {
+            'instance_id':instance_id,
+            'collection_name':collection_name,
+            'metadata_file':metadata_file,
+            'edition':edition
+            }
+    Finalize_Upload(access_token, dataset_id, upload_info, initial_wait=0)
     
 
  
@@ -1168,7 +3125,8 @@ def Check_Upload_Dict(upload_dict):
             assert key in upload_dict[dataset].keys(), 'upload_dict[{}] must have key - "{}"'.format(dataset, key)
 
 
-def Multi_Upload_To_Cmd(credentials, upload_dict):
+def Multi_Upload_To_Cmd(credentials, upload_dict, progress_callback=None, schedule_policy=None, history_file=None, stall_policy=None, stall_window=1800, 
+                        dry_run=False, isolate_failures=False, max_retries=1, failures_file=None, finalize_workers=4):
     '''
     Full upload process 
     Works for single or multiple uploads
@@ -1178,103 +3136,2675 @@ def Multi_Upload_To_Cmd(credentials, upload_dict):
         {v4:'', 
         edition:'', 
         collection_name:'', 
-        metadata_file:''
+        metadata_file:'',
+        chunk_size:'' (optional - bytes or 'adaptive'),
+        skip_unchanged_metadata:True/False (optional - only send metadata that has changed),
+        codelist_index:'' (optional - directory of code list index, v4 codes are checked before upload),
+        deadline:'' (optional - "2021-07-08T09:30", used by schedule_policy='deadline'),
+        priority:1 (optional - share of the upload budget when uploading alongside other files, see Set_Upload_Budget()),
+        shards:1 (optional - split the v4 into this many files, uploaded at the same time and imported as one job)
         }, 
     etc}
+    progress_callback is called with upload & import progress events, ie Print_Progress
+    schedule_policy is the order datasets are uploaded in - see Schedule_Datasets()
+    history_file is where upload & import rates are recorded, used to schedule future batches
+    stall_policy is what to do with an import that has made no progress for stall_window seconds - see Create_Stall_Detector()
+    Datasets are added to their collection in the order their imports complete, 
+    up to finalize_workers at once while the other imports are still being polled
+    dry_run=True only checks the files and prints the planned requests, bytes & duration - see Plan_Upload()
+    isolate_failures=True carries on with the rest of the batch when a dataset fails, failed uploads & finalizes 
+    are retried up to max_retries times, anything still failed is written to failures_file as an upload_dict to re-run
+    Returns the outcome of each dataset - see Get_Batch_Results()
     '''
     
     # Quick check on upload_dict format
     Check_Upload_Dict(upload_dict)
     
+    if dry_run:
+        plan = Plan_Upload(upload_dict, history_file, schedule_policy)
+        Print_Upload_Plan(plan)
+        return plan
+    
     # get access_token
     access_token = Get_Access_Token(credentials)
     
+    # record rates for future scheduling, written to history_file at the end of the batch
+    history = None
+    if history_file is not None:
+        history = Read_History(history_file)
+        progress_callback = Create_History_Recorder(history, progress_callback)
+    
+    # order to upload datasets
+    dataset_order = Schedule_Datasets(upload_dict, schedule_policy, history_file)
+    
     # Upload v4's all together
-    for dataset_id in upload_dict.keys():
+    datasets_importing = []
+    for dataset_id in dataset_order:
         
-        # setting out variables
-        v4 = upload_dict[dataset_id]['v4']
+        # upload v4, create job & submit it
+        if Run_Dataset_Stage(dataset_id, upload_dict[dataset_id], 'upload', Upload_And_Submit_V4, access_token, dataset_id, 
+                             upload_dict[dataset_id], progress_callback, isolate_failures=isolate_failures):
+            datasets_importing.append(dataset_id)
         
-        # quick check to make sure recipe exists in API
-        Check_Recipe_Exists(access_token, dataset_id)
+        # small wait between uploads
+        Pipeline_Sleep(2)
         
-        # upload v4 into s3 bucket
-        s3_url = Post_V4_To_S3(access_token, v4)
+    # retry failed uploads once the rest have been submitted
+    for retry in range(max_retries):
+        failed_uploads = Get_Failed_Datasets(upload_dict, dataset_order, 'upload')
+        if len(failed_uploads) == 0:
+            break
+        Pipeline_Sleep(RETRY_WAIT)
+        for dataset_id in failed_uploads:
+            if Run_Dataset_Stage(dataset_id, upload_dict[dataset_id], 'upload', Upload_And_Submit_V4, access_token, dataset_id, 
+                                 upload_dict[dataset_id], progress_callback, isolate_failures=isolate_failures):
+                datasets_importing.append(dataset_id)
         
-        # create new job
-        job_id, instance_id = Post_New_Job(access_token, dataset_id, s3_url)
+    # Monitoring upload, adding metadata, adding data to collection
+    # whichever import finishes first is done first
+    Pipeline_Sleep(60) # gives cmd a chance to create instances
+    progress_trackers = {}
+    stall_detector = None
+    if stall_policy is not None:
+        stall_detector = Create_Stall_Detector(stall_policy, stall_window, history_file=history_file)
+    # finalizes run in the background so the other imports carry on being polled
+    with concurrent.futures.ThreadPoolExecutor(max_workers=finalize_workers) as executor:
+        finalizes = []
+        while len(datasets_importing) != 0:
+            dataset_id = Wait_For_Next_Import(access_token, upload_dict, datasets_importing, progress_callback=progress_callback, 
+                                              progress_trackers=progress_trackers, stall_detector=stall_detector, isolate_failures=isolate_failures)
+            datasets_importing.remove(dataset_id)
+            # without isolate_failures a failed finalize stops the batch
+            for future in finalizes:
+                if future.done():
+                    future.result()
+            if upload_dict[dataset_id].get('state_of_upload') in ('quarantined', 'failed'):
+                continue
+            finalizes.append(executor.submit(
+                    Run_Dataset_Stage, dataset_id, upload_dict[dataset_id], 'finalize', Finalize_Upload, access_token, dataset_id, 
+                    upload_dict[dataset_id], progress_callback, initial_wait=0, isolate_failures=isolate_failures
+                    ))
+        for future in concurrent.futures.as_completed(finalizes):
+            future.result()
         
-        # update state of job
-        Update_State_Of_Job(access_token, job_id)
+    # retry failed metadata & collection steps, the import has already completed
+    for retry in range(max_retries):
+        failed_finalizes = Get_Failed_Datasets(upload_dict, dataset_order, 'finalize')
+        if len(failed_finalizes) == 0:
+            break
+        Pipeline_Sleep(RETRY_WAIT)
+        for dataset_id in failed_finalizes:
+            Run_Dataset_Stage(dataset_id, upload_dict[dataset_id], 'finalize', Finalize_Upload, access_token, dataset_id, 
+                              upload_dict[dataset_id], progress_callback, initial_wait=0, isolate_failures=isolate_failures)
+            
+    quarantined = [dataset_id for dataset_id in dataset_order if upload_dict[dataset_id].get('state_of_upload') == 'quarantined']
+    if len(quarantined) != 0:
+        print('Imports stalled and were quarantined - {}'.format(', '.join(quarantined)))
         
-        # updating some variables
-        upload_dict[dataset_id]['s3_url'] = s3_url
-        upload_dict[dataset_id]['job_id'] = job_id
-        upload_dict[dataset_id]['instance_id'] = instance_id
+    failed = Get_Failed_Datasets(upload_dict, dataset_order)
+    if len(failed) != 0:
+        for dataset_id in failed:
+            failure = upload_dict[dataset_id]['failure']
+            print('{} - failed at {} after {} attempt(s) - {}'.format(dataset_id, failure['stage'], failure['attempts'], failure['error']))
+        if failures_file is not None:
+            with open(failures_file, 'w') as f:
+                json.dump(Get_Failed_Upload_Dict(upload_dict), f, indent=4)
+            print('Failed datasets written to {} to re-run'.format(failures_file))
+            
+    if history is not None:
+        Write_History(history_file, history)
         
-        # small wait between uploads
-        time.sleep(2)
+    return Get_Batch_Results(upload_dict, dataset_order)
         
         
-    # Monitoring upload, adding metadata, adding data to collection
-    for dataset_id in upload_dict.keys():
+def Upload_And_Submit_V4(access_token, dataset_id, upload_info, progress_callback=None, save_progress=None):
+    '''
+    Uploads the v4 for a single dataset, creates a new job and submits it
+    upload_info is upload_dict[dataset_id]
+    s3_url (and s3_urls if sharded), job_id & instance_id are added to upload_info as soon as each step is done,
+    job_submitted once the job is submitted - running it again only does the steps that haven't been done
+    save_progress is called with upload_info after each step, ie to save it somewhere a retry can pick it up
+    '''
+    # setting out variables
+    v4 = upload_info['v4']
+    chunk_size = upload_info.get('chunk_size') # optional
+    priority = upload_info.get('priority', 1) # optional
+    shards = upload_info.get('shards', 1) # optional
+    
+    def step_done(**values):
+        upload_info.update(values)
+        if save_progress is not None:
+            save_progress(upload_info)
+    
+    if upload_info.get('job_submitted'):
+        return upload_info
+    
+    if 's3_url' not in upload_info.keys():
+        # quick check to make sure recipe exists in API
+        Check_Recipe_Exists(access_token, dataset_id)
         
-        # setting out variables
-        v4 = upload_dict[dataset_id]['v4']
-        instance_id = upload_dict[dataset_id]['instance_id']
-        collection_name = upload_dict[dataset_id]['collection_name']
-        metadata_file = upload_dict[dataset_id]['metadata_file']
-        edition = upload_dict[dataset_id]['edition']
+        # check v4 codes against code lists before uploading
+        if 'codelist_index' in upload_info.keys():
+            Check_V4_Codes(access_token, dataset_id, v4, upload_info['codelist_index'])
+            
+        if shards > 1:
+            # upload shards of the v4 at the same time
+            s3_urls = Post_V4_Shards_To_S3(access_token, v4, shards, chunk_size=chunk_size, 
+                                           progress_callback=progress_callback, dataset_id=dataset_id, priority=priority)
+            step_done(s3_url=s3_urls[0], s3_urls=s3_urls)
+        else:
+            # upload v4 into s3 bucket
+            s3_url = Post_V4_To_S3(access_token, v4, chunk_size=chunk_size, progress_callback=progress_callback, dataset_id=dataset_id, priority=priority)
+            step_done(s3_url=s3_url)
+            
+    if 'job_id' not in upload_info.keys():
+        # create new job
+        job_id, instance_id = Post_New_Job(access_token, dataset_id, upload_info['s3_url'])
+        step_done(job_id=job_id, instance_id=instance_id)
         
-        # Monitioring state of upload #
-        state_of_upload = '' # updated in while loop
-        time.sleep(60) # gives cmd a chance to create instance
+    if len(upload_info.get('s3_urls', [])) > 1:
+        # attach every shard to the one job & submit it
+        Submit_Sharded_Job(access_token, dataset_id, upload_info['s3_urls'], job_id=upload_info['job_id'])
+    else:
+        # update state of job
+        Update_State_Of_Job(access_token, upload_info['job_id'])
+    step_done(job_submitted=True)
+    
+    return upload_info
+
+
+def Wait_For_Import(access_token, instance_id, initial_wait=60, poll_interval=30, progress_callback=None, dataset_id=None, cancel_event=None):
+    '''
+    Polls the state of an instance until the import is complete
+    initial_wait gives cmd a chance to create instance
+    progress_callback is called after each poll, events are tagged with dataset_id
+    cancel_event is checked between polls, an error is raised once it is set
+    Returns the final state
+    '''
+    state_of_upload = '' # updated in while loop
+    progress_trackers = {}
+    if Pipeline_Sleep(initial_wait, cancel_event):
+        raise Exception('Stopped waiting for import of instance {} - cancelled'.format(instance_id))
+    
+    # start while loop
+    while True:
+        import_progress = Get_Import_Progress(access_token, instance_id)
+        Print_Import_Progress(import_progress)
+        state_of_upload = import_progress['state']
+        Send_Import_Progress_Event(progress_callback, progress_trackers, dataset_id, instance_id, import_progress)
+        if state_of_upload == 'completed':
+            break
+        if Pipeline_Sleep(poll_interval, cancel_event):
+            raise Exception('Stopped waiting for import of instance {} - cancelled'.format(instance_id))
+    # Upload now complete
+    
+    return state_of_upload
+
+
+def Wait_For_Next_Import(access_token, upload_dict, dataset_ids, poll_interval=30, progress_callback=None, progress_trackers=None, stall_detector=None, isolate_failures=False):
+    '''
+    Polls the instances of every dataset in dataset_ids until one of them has completed
+    Returns the dataset_id of the first completed import
+    progress_trackers is a dict kept between calls to work out import rates
+    stall_detector (see Create_Stall_Detector) handles imports that have stopped progressing,
+    a quarantined dataset is returned as well - upload_dict[dataset_id]['state_of_upload'] is 'quarantined'
+    isolate_failures=True carries on polling the other datasets if one errors, a dataset 
+    is returned as failed (see Record_Dataset_Failure()) after MAX_POLL_ERRORS errors in a row
+    '''
+    if progress_trackers is None:
+        progress_trackers = {}
         
-        # start while loop
-        while state_of_upload != 'completed':
-            time.sleep(30) # checks every 30 seconds
-            state_of_upload = Get_State_Of_Instance(access_token, instance_id)
-        # Upload now complete
+    while True:
+        for dataset_id in dataset_ids:
+            upload_info = upload_dict[dataset_id]
+            try:
+                if Poll_Import(access_token, dataset_id, upload_info, progress_callback, progress_trackers, stall_detector):
+                    return dataset_id
+            except Exception as e:
+                if not isolate_failures:
+                    raise
+                upload_info['poll_errors'] = upload_info.get('poll_errors', 0) + 1
+                print('{} - polling import failed ({} in a row) - {}'.format(dataset_id, upload_info['poll_errors'], e))
+                if upload_info['poll_errors'] >= MAX_POLL_ERRORS:
+                    Record_Dataset_Failure(dataset_id, upload_info, 'import', e)
+                    return dataset_id
+            else:
+                upload_info['poll_errors'] = 0
+        Pipeline_Sleep(poll_interval)
         
-        # Create new collection
+
+def Poll_Import(access_token, dataset_id, upload_info, progress_callback=None, progress_trackers=None, stall_detector=None):
+    '''
+    Polls the import of one dataset for Wait_For_Next_Import()
+    Returns True if the import has completed or has stalled and been quarantined
+    '''
+    instance_id = upload_info['instance_id']
+    import_progress = Get_Import_Progress(access_token, instance_id)
+    Print_Import_Progress(import_progress, dataset_id)
+    Send_Import_Progress_Event(progress_callback, progress_trackers, dataset_id, instance_id, import_progress)
+    if import_progress['state'] == 'completed':
+        upload_info['state_of_upload'] = 'completed' # so Finalize_Upload() doesn't poll it again
+        return True
+    if stall_detector is not None and Check_For_Stall(stall_detector, dataset_id, instance_id, import_progress):
+        if Handle_Stalled_Import(access_token, stall_detector, dataset_id, upload_info) == 'quarantined':
+            return True
+    return False
+
+
+def Send_Import_Progress_Event(progress_callback, progress_trackers, dataset_id, instance_id, import_progress):
+    '''
+    Calls progress_callback with an import_progress event
+    progress_trackers is a dict of trackers for each instance_id
+    '''
+    if progress_callback is None or import_progress['total_inserted_observations'] is None:
+        return
+    
+    if instance_id not in progress_trackers.keys():
+        progress_trackers[instance_id] = Create_Progress_Tracker(import_progress['total_observations'], done=import_progress['total_inserted_observations'])
+    seconds_elapsed, observations_per_second, eta_seconds = Update_Progress_Tracker(progress_trackers[instance_id], import_progress['total_inserted_observations'])
+    progress_callback({
+            'event':'import_progress',
+            'dataset_id':dataset_id,
+            'instance_id':instance_id,
+            'state':import_progress['state'],
+            'inserted_observations':import_progress['total_inserted_observations'],
+            'total_observations':import_progress['total_observations'],
+            'seconds_elapsed':seconds_elapsed,
+            'observations_per_second':observations_per_second,
+            'eta_seconds':eta_seconds
+            })
+
+
+def Finalize_Upload(access_token, dataset_id, upload_info, progress_callback=None, initial_wait=60, cancel_event=None):
+    '''
+    Monitors the import of a single dataset, then adds metadata and adds data to collection
+    upload_info is upload_dict[dataset_id] after Upload_And_Submit_V4()
+    upload_info['skip_unchanged_metadata'] = True only sends metadata that has changed
+    Steps are run by Run_Stages() - collection & csv-w are done while the import is running
+    If upload_info['state_of_upload'] is already 'completed' (ie seen by Wait_For_Next_Import()) the import isn't polled again
+    Outputs of the stages that finished are kept in upload_info['finalize_values'], 
+    running it again carries on from the stage that failed
+    Setting cancel_event stops the steps early, an error is raised
+    state_of_upload, collection_id & version_number are added to upload_info
+    '''
+    # setting out variables
+    skip_unchanged = upload_info.get('skip_unchanged_metadata', False) # optional
+    stop_stages = threading.Event() # set by Run_Stages() when it stops, ends Wait_For_Import()
+    
+    stages = Get_Finalize_Stages(access_token, dataset_id, skip_unchanged, progress_callback, initial_wait, stop_stages)
+    values = {
+            'instance_id':upload_info['instance_id'],
+            'collection_name':upload_info['collection_name'],
+            'metadata_file':upload_info['metadata_file'],
+            'edition':upload_info['edition']
+            }
+    starting_keys = set(values.keys())
+    if upload_info.get('state_of_upload') == 'completed':
+        values['state_of_upload'] = 'completed' # wait_for_import is skipped
+    values.update(upload_info.get('finalize_values', {}))
+    try:
+        values = Run_Stages(stages, values, stop_event=stop_stages, cancel_event=cancel_event)
+    finally:
+        # metadata_dict is left out, the csv-w is quick to read again
+        upload_info['finalize_values'] = {key:value for key, value in values.items() if key not in starting_keys and key != 'metadata_dict'}
+    
+    # updating some variables
+    upload_info['state_of_upload'] = values['state_of_upload']
+    upload_info['collection_id'] = values['collection_id']
+    upload_info['version_number'] = values['version_number']
+    
+    return upload_info
+
+
+def Get_Finalize_Stages(access_token, dataset_id, skip_unchanged=False, progress_callback=None, initial_wait=60, stop_event=None):
+    '''
+    Returns the steps after a job is submitted as stages for Run_Stages()
+    Starting values needed - instance_id, collection_name, metadata_file, edition
+    
+    wait_for_import -> create_version -> get_version_number -> add_version_to_collection
+                                                            -> update_usage_notes
+                    -> update_metadata
+                    -> update_dimensions
+                    -> add_dataset_to_collection
+    create_collection -> add_dataset_to_collection, add_version_to_collection
+    read_csvw -> update_metadata, update_dimensions, update_usage_notes
+    
+    With skip_unchanged, update_metadata, update_dimensions & update_usage_notes 
+    are replaced by update_changed_metadata which needs the version number
+    Nothing is written to the dataset until the import has completed
+    wait_for_import stops polling once stop_event is set - pass the same event to Run_Stages()
+    '''
+    def wait_for_import(instance_id):
+        state_of_upload = Wait_For_Import(access_token, instance_id, initial_wait=initial_wait, progress_callback=progress_callback, dataset_id=dataset_id, cancel_event=stop_event)
+        return {'state_of_upload':state_of_upload}
+    
+    def create_collection(collection_name):
         Create_Collection(access_token, collection_name)
-        
-        # Quick check to make sure collection was created
         Check_Collection_Exists(access_token, collection_name)
-        
-        # Return collection_id
         collection_id = Get_Collection_Id(access_token, collection_name)
-        
-        # Reading in csv-w and formatting for the CMD API functions
-        metadata_dict = Read_CSVW(metadata_file)
-        
-        # Updating general metadata
+        return {'collection_id':collection_id}
+    
+    def read_csvw(metadata_file):
+        return {'metadata_dict':Read_CSVW(metadata_file)}
+    
+    def update_metadata(metadata_dict, state_of_upload):
         Update_Metadata(access_token, dataset_id, metadata_dict)
-        
-        # Assigning instance a version number
+        return {'metadata_updated':True}
+    
+    def create_version(instance_id, edition, state_of_upload):
         Create_New_Version_From_Instance(access_token, instance_id, edition)
-        
-        # Get new version number
-        version_number = Get_Version_number(access_token, dataset_id, instance_id)
-        
-        # Add landing page to collection
+        return {'version_created':True}
+    
+    def get_version_number(instance_id, version_created):
+        return {'version_number':Get_Version_number(access_token, dataset_id, instance_id)}
+    
+    def add_dataset_to_collection(collection_id, state_of_upload):
         Add_Dataset_To_Collection(access_token, collection_id, dataset_id)
-        
-        # Add new version to collection
+        return {'dataset_in_collection':True}
+    
+    def add_version_to_collection(collection_id, edition, version_number):
         Add_Dataset_Version_To_Collection(access_token, collection_id, dataset_id, edition, version_number)
-        
-        # Updating dimension metadata
+        return {'version_in_collection':True}
+    
+    def update_dimensions(instance_id, metadata_dict, state_of_upload):
         Update_Dimensions(access_token, dataset_id, instance_id, metadata_dict)
-        
-        # Update_Usage_Notes
+        return {'dimensions_updated':True}
+    
+    def update_usage_notes(metadata_dict, edition, version_number):
         Update_Usage_Notes(access_token, dataset_id, version_number, metadata_dict, edition)
-        
-        # updating some variables
-        upload_dict[dataset_id]['state_of_upload'] = state_of_upload
-        upload_dict[dataset_id]['collection_id'] = collection_id 
-        upload_dict[dataset_id]['version_number'] = version_number 
-        
-        
+        return {'usage_notes_updated':True}
+    
+    def update_changed_metadata(instance_id, metadata_dict, edition, version_number):
+        skipped_dict = Update_Changed_Metadata(access_token, dataset_id, instance_id, metadata_dict, edition, version_number)
+        return {'skipped_metadata':skipped_dict}
+    
+    stages = {}
+    stages['wait_for_import'] = {'function':wait_for_import, 'inputs':['instance_id'], 'outputs':['state_of_upload']}
+    stages['create_collection'] = {'function':create_collection, 'inputs':['collection_name'], 'outputs':['collection_id']}
+    stages['read_csvw'] = {'function':read_csvw, 'inputs':['metadata_file'], 'outputs':['metadata_dict']}
+    stages['create_version'] = {'function':create_version, 'inputs':['instance_id', 'edition', 'state_of_upload'], 'outputs':['version_created']}
+    stages['get_version_number'] = {'function':get_version_number, 'inputs':['instance_id', 'version_created'], 'outputs':['version_number']}
+    stages['add_dataset_to_collection'] = {'function':add_dataset_to_collection, 'inputs':['collection_id', 'state_of_upload'], 'outputs':['dataset_in_collection']}
+    stages['add_version_to_collection'] = {'function':add_version_to_collection, 'inputs':['collection_id', 'edition', 'version_number'], 'outputs':['version_in_collection']}
+    if skip_unchanged:
+        stages['update_changed_metadata'] = {'function':update_changed_metadata, 'inputs':['instance_id', 'metadata_dict', 'edition', 'version_number'], 'outputs':['skipped_metadata']}
+    else:
+        stages['update_metadata'] = {'function':update_metadata, 'inputs':['metadata_dict', 'state_of_upload'], 'outputs':['metadata_updated']}
+        stages['update_dimensions'] = {'function':update_dimensions, 'inputs':['instance_id', 'metadata_dict', 'state_of_upload'], 'outputs':['dimensions_updated']}
+        stages['update_usage_notes'] = {'function':update_usage_notes, 'inputs':['metadata_dict', 'edition', 'version_number'], 'outputs':['usage_notes_updated']}
+    
+    return stages
+
+
+def Check_Stages(stages, values):
+    '''
+    Checks that every stage for Run_Stages() can run
+    ie every input is a starting value or the output of a stage, and there are no loops
+    '''
+    assert type(stages) == dict, 'stages must be a dict'
+    
+    available = set(values.keys())
+    remaining = set(stages.keys())
+    while len(remaining) != 0:
+        ready = [name for name in remaining if set(stages[name]['inputs']).issubset(available)]
+        if len(ready) == 0:
+            missing = {name:[item for item in stages[name]['inputs'] if item not in available] for name in remaining}
+            raise Exception('Stages can not run, inputs never available - {}'.format(missing))
+        for name in ready:
+            available.update(stages[name]['outputs'])
+            remaining.remove(name)
+
+
+STAGE_CANCEL_CHECK_INTERVAL = 1 # seconds between checks of Run_Stages() cancel_event
+
+def Run_Stages(stages, values, max_workers=4, stop_event=None, cancel_event=None):
+    '''
+    Runs a dependency graph of stages - each stage is started as soon as all of its inputs are ready
+    stages is a dict of dicts with format:
+    {
+    stage_name:
+        {function:, - called with its inputs as keyword arguments, returns a dict of its outputs
+        inputs:[],
+        outputs:[]
+        },
+    etc}
+    values is a dict of starting values, outputs of each stage are added to it
+    A stage whose outputs are all in values already is not run
+    If a stage raises an error no more stages are started and the error is raised
+    stop_event is set when Run_Stages() returns or raises, stages that wait should stop once it is set
+    Setting cancel_event stops the stages early, an error is raised
+    Returns values
+    '''
+    Check_Stages(stages, values)
+    
+    remaining = {name:stage for name, stage in stages.items() if not all(item in values.keys() for item in stage['outputs'])}
+    running = {} # future -> stage name
+    timeout = None if cancel_event is None else STAGE_CANCEL_CHECK_INTERVAL
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while len(remaining) != 0 or len(running) != 0:
+            if cancel_event is not None and cancel_event.is_set():
+                raise Exception('Stages cancelled - {} not finished'.format(sorted(list(remaining.keys()) + list(running.values()))))
+                
+            # start everything that is ready
+            for name in list(remaining.keys()):
+                stage = remaining[name]
+                if all(item in values.keys() for item in stage['inputs']):
+                    kwargs = {item:values[item] for item in stage['inputs']}
+                    running[executor.submit(stage['function'], **kwargs)] = name
+                    del remaining[name]
+                    
+            done, not_done = concurrent.futures.wait(running.keys(), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    outputs = future.result()
+                except Exception as e:
+                    raise Exception('Stage "{}" failed - {}'.format(name, e)) from e
+                for item in stages[name]['outputs']:
+                    if item not in outputs.keys():
+                        raise Exception('Stage "{}" did not return "{}"'.format(name, item))
+                values.update(outputs)
+    finally:
+        # don't wait on stages still running if something has failed, 
+        # stages that are waiting are told to stop rather than being left running
+        if stop_event is not None:
+            stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        
+    return values
+
+
+### Scheduling datasets within a batch ###
+# history_file is a json file of upload & import rates recorded by Create_History_Recorder() and written at the end of a batch
+# {upload: {bytes_per_second, samples}, 
+#  datasets: {dataset_id: {observations_per_second, bytes_per_observation, samples, updated}}}
+
+DEFAULT_UPLOAD_BYTES_PER_SECOND = 5 * 1024 * 1024 # used when there is no history
+DEFAULT_OBSERVATIONS_PER_SECOND = 1000 # used when there is no history
+
+def Read_History(history_file):
+    '''
+    Returns the history of upload & import rates, or an empty history
+    '''
+    if history_file is None or not os.path.exists(history_file):
+        return {'upload':{}, 'datasets':{}}
+    with open(history_file, 'r') as f:
+        return json.load(f)
+    
+    
+def Write_History(history_file, history):
+    '''
+    Writes the history of upload & import rates
+    Written to a temp file first so the history is never left half written
+    '''
+    with open(history_file + '.tmp', 'w') as f:
+        json.dump(history, f, indent=4)
+    os.replace(history_file + '.tmp', history_file)
+    
+    
+def Update_History_Rate(entry, key, rate):
+    '''
+    Adds a rate to a history entry, as a moving average so recent runs count more
+    '''
+    if key in entry.keys():
+        entry[key] = 0.5 * entry[key] + 0.5 * rate
+    else:
+        entry[key] = rate
+    entry['samples'] = entry.get('samples', 0) + 1
+    entry['updated'] = time.time()
+
+
+def Create_History_Recorder(history, progress_callback=None):
+    '''
+    Returns a progress_callback that records upload & import rates in history
+    history is from Read_History(), it is only updated in memory - write it with Write_History() at the end of the batch
+    Events are passed on to progress_callback if given
+    Upload rate is recorded once the last chunk is sent, import rate once an import completes
+    '''
+    lock = threading.Lock()
+    import_starts = {} # dataset_id -> (time, inserted observations) when first seen importing
+    total_bytes = {} # dataset_id -> v4 size
+    recorded = set()
+    
+    def history_recorder(event):
+        if progress_callback is not None:
+            progress_callback(event)
+        dataset_id = event['dataset_id']
+        
+        with lock:
+            if event['event'] == 'chunk_sent':
+                total_bytes[dataset_id] = event['total_bytes']
+                if event['chunk_number'] != event['total_chunks'] or event['seconds_elapsed'] <= 0:
+                    return
+                Update_History_Rate(history['upload'], 'bytes_per_second', event['total_bytes'] / event['seconds_elapsed'])
+                
+            elif event['event'] == 'import_progress':
+                if event['state'] != 'completed':
+                    if dataset_id not in import_starts.keys():
+                        import_starts[dataset_id] = (time.time(), event['inserted_observations'])
+                    return
+                if dataset_id in recorded or dataset_id not in import_starts.keys():
+                    return
+                recorded.add(dataset_id)
+                
+                start_time, start_observations = import_starts[dataset_id]
+                seconds = time.time() - start_time
+                observations = event['inserted_observations'] - start_observations
+                if seconds <= 0 or observations <= 0:
+                    return
+                entry = history['datasets'].setdefault(dataset_id, {})
+                if dataset_id in total_bytes.keys() and event['total_observations']:
+                    entry['bytes_per_observation'] = total_bytes[dataset_id] / event['total_observations']
+                Update_History_Rate(entry, 'observations_per_second', observations / seconds)
+                
+    return history_recorder
+            
+
+def Estimate_Bytes_Per_Observation(v4, sample_size=1024 * 1024):
+    '''
+    Estimates the size of each row of a v4 from the start of the file
+    '''
+    with Open_V4(v4) as f:
+        f.readline() # header
+        sample = f.read(sample_size)
+    number_of_rows = sample.count(b'\n')
+    if number_of_rows == 0:
+        return max(len(sample), 1)
+    return len(sample) / number_of_rows
+
+
+def Estimate_Dataset_Duration(dataset_id, upload_info, history):
+    '''
+    Estimates how long a dataset will take to upload and import
+    Uses the size of the v4 and the history of rates, falling back on 
+    rates of other datasets or the defaults
+    Returns a dict of v4_size, observations, upload_seconds, import_seconds
+    '''
+    v4_size = Get_V4_Size(upload_info['v4'])
+    upload_bytes_per_second = history['upload'].get('bytes_per_second', DEFAULT_UPLOAD_BYTES_PER_SECOND)
+    
+    dataset_history = history['datasets'].get(dataset_id, {})
+    if 'bytes_per_observation' in dataset_history.keys():
+        bytes_per_observation = dataset_history['bytes_per_observation']
+    else:
+        bytes_per_observation = Estimate_Bytes_Per_Observation(upload_info['v4'])
+    
+    observations_per_second = Get_Expected_Import_Rate(dataset_id, history)
+            
+    estimate = {}
+    estimate['v4_size'] = v4_size
+    estimate['observations'] = int(v4_size / bytes_per_observation)
+    estimate['upload_seconds'] = v4_size / upload_bytes_per_second
+    estimate['import_seconds'] = estimate['observations'] / observations_per_second
+    return estimate
+
+
+def Get_Expected_Import_Rate(dataset_id, history):
+    '''
+    Returns the observations/sec a dataset is expected to import at
+    From its own history, else the median of other datasets, else DEFAULT_OBSERVATIONS_PER_SECOND
+    '''
+    dataset_history = history['datasets'].get(dataset_id, {})
+    if 'observations_per_second' in dataset_history.keys():
+        return dataset_history['observations_per_second']
+    
+    # median of other datasets
+    other_rates = sorted(item['observations_per_second'] for item in history['datasets'].values() if 'observations_per_second' in item.keys())
+    if len(other_rates) != 0:
+        return other_rates[len(other_rates) // 2]
+    return DEFAULT_OBSERVATIONS_PER_SECOND
+
+
+def Schedule_Datasets(upload_dict, schedule_policy=None, history_file=None):
+    '''
+    Returns the order that datasets in upload_dict should be uploaded in
+    schedule_policy:
+        None - order of upload_dict
+        'shortest_first' - quickest to upload & import first, gives the lowest average time to collection
+        'deadline' - earliest upload_dict[dataset_id]['deadline'] first, 
+                     datasets without a deadline go last, ties are shortest first
+    Estimated durations use the v4 sizes and history_file
+    '''
+    if schedule_policy is None:
+        return list(upload_dict.keys())
+    
+    if schedule_policy not in ('shortest_first', 'deadline'):
+        raise Exception('schedule_policy must be None, "shortest_first" or "deadline", not {}'.format(schedule_policy))
+    
+    history = Read_History(history_file)
+    durations = {}
+    for dataset_id in upload_dict.keys():
+        estimate = Estimate_Dataset_Duration(dataset_id, upload_dict[dataset_id], history)
+        durations[dataset_id] = estimate['upload_seconds'] + estimate['import_seconds']
+        
+    if schedule_policy == 'shortest_first':
+        dataset_order = sorted(upload_dict.keys(), key=lambda dataset_id: durations[dataset_id])
+        
+    elif schedule_policy == 'deadline':
+        def deadline_key(dataset_id):
+            deadline = upload_dict[dataset_id].get('deadline')
+            if deadline is None:
+                return (1, 0, durations[dataset_id])
+            if type(deadline) == str:
+                deadline = datetime.datetime.fromisoformat(deadline)
+            return (0, deadline.timestamp(), durations[dataset_id])
+        dataset_order = sorted(upload_dict.keys(), key=deadline_key)
+        
+    for dataset_id in dataset_order:
+        print('{} - estimated {:.0f} seconds to upload & import'.format(dataset_id, durations[dataset_id]))
+    return dataset_order
+
+
+### Dry run - planning a batch without sending anything ###
+# Works out the requests Multi_Upload_To_Cmd() would make for an upload_dict, the bytes & chunks uploaded
+# and how long it should take from the history of upload & import rates
+# Only local files are read - nothing is sent to publishing, not even a login
+# Listings (/dataset/jobs) are counted as one page, code list downloads for codelist_index aren't counted
+
+def Read_V4_Dimensions(v4):
+    '''
+    Returns the code list ids of the dimensions in a v4, from its header
+    '''
+    with Open_V4(v4) as v4_file:
+        f = io.TextIOWrapper(v4_file, encoding='utf-8', newline='')
+        header = next(csv.reader(f))
+        
+    assert header[0].lower().startswith('v4_'), 'first column of v4 is not the obs column - {}'.format(header[0])
+    number_of_data_markings = int(header[0].split('_')[-1])
+    return header[1 + number_of_data_markings::2]
+
+
+def Get_Planned_Requests(upload_info, number_of_chunks, number_of_dimensions, has_usage_notes, import_polls):
+    '''
+    Returns a Counter of the requests Multi_Upload_To_Cmd() makes for one dataset, by endpoint
+    Endpoints are written like Get_Trace_Endpoint() with placeholders for ids & names
+    '''
+    planned_requests = collections.Counter()
+    shards = upload_info.get('shards', 1)
+    
+    # Upload_And_Submit_V4
+    planned_requests['GET /recipes'] += 1 # Check_Recipe_Exists
+    if 'codelist_index' in upload_info.keys():
+        planned_requests['GET /recipes'] += 2 # Get_Recipe
+    planned_requests['POST /upload'] += number_of_chunks
+    planned_requests['GET /recipes'] += 2 # Post_New_Job - Get_Recipe_Info
+    planned_requests['POST /dataset/jobs'] += 1
+    planned_requests['GET /dataset/jobs'] += 1 # Get_Latest_Job_Info
+    if shards > 1:
+        planned_requests['GET /recipes'] += 2 * (shards - 1) # Add_File_To_Existing_Job - Get_Recipe_Info
+        planned_requests['PUT /dataset/jobs/{id}/files'] += shards - 1
+        planned_requests['GET /dataset/jobs/{id}'] += 1 # Submit_Sharded_Job checks the files
+    planned_requests['GET /dataset/jobs/{id}'] += 1 # Update_State_Of_Job
+    planned_requests['PUT /dataset/jobs/{id}'] += 1
+    
+    # Wait_For_Next_Import & Finalize_Upload
+    planned_requests['GET /dataset/instances/{id}'] += import_polls + 1
+    planned_requests['POST /zebedee/collection'] += 1
+    planned_requests['GET /zebedee/collection/{collection_name}'] += 2
+    planned_requests['PUT /dataset/instances/{id}'] += 1 # Create_New_Version_From_Instance
+    planned_requests['GET /dataset/instances/{id}'] += 1 # Get_Version_number
+    planned_requests['PUT /zebedee/collections/{id}/datasets/{dataset_id}'] += 1
+    planned_requests['PUT /zebedee/collections/{id}/datasets/{dataset_id}/editions/{edition}/versions/{version}'] += 1
+    if upload_info.get('skip_unchanged_metadata', False):
+        # Get_Current_Metadata, then writes only what has changed - counted as if everything has
+        planned_requests['GET /dataset/datasets/{dataset_id}'] += 1
+        planned_requests['GET /dataset/instances/{id}'] += 1
+        planned_requests['GET /dataset/datasets/{dataset_id}/editions/{edition}/versions/{version}'] += 1
+    planned_requests['PUT /dataset/datasets/{dataset_id}'] += 1
+    planned_requests['PUT /dataset/instances/{id}/dimensions/{dimension}'] += number_of_dimensions
+    if has_usage_notes:
+        planned_requests['PUT /dataset/datasets/{dataset_id}/editions/{edition}/versions/{version}'] += 1
+    return planned_requests
+
+
+def Plan_Dataset(dataset_id, upload_info, history):
+    '''
+    Checks the files for one dataset in an upload_dict and works out its uploads
+    Returns a dict of the dataset's plan, problems is a list of anything that would stop it uploading
+    '''
+    plan = {'dataset_id':dataset_id, 'problems':[], 'v4_size':0, 'chunk_size':None, 'chunks':0, 
+            'dimensions':None, 'csvw_dimensions':None, 'has_usage_notes':False}
+    v4 = upload_info['v4']
+    shards = upload_info.get('shards', 1)
+    
+    if not os.path.exists(v4):
+        plan['problems'].append('v4 not found - {}'.format(v4))
+    else:
+        try:
+            plan['v4_size'] = Get_V4_Size(v4)
+            plan['dimensions'] = len(Read_V4_Dimensions(v4))
+        except Exception as e:
+            plan['problems'].append('v4 could not be read - {}'.format(e))
+        if shards > 1 and Get_V4_Compression(v4) is not None:
+            plan['problems'].append('compressed v4s can not be sharded')
+            
+    # chunks of each shard, shards are about the same size
+    shard_size = -(-plan['v4_size'] // shards)
+    chunk_size = upload_info.get('chunk_size')
+    try:
+        if chunk_size == 'adaptive':
+            chunk_size = Get_Adaptive_Chunk_Size(CHUNK_SIZE_TUNER, shard_size)
+        else:
+            chunk_size = Check_Chunk_Size(chunk_size, shard_size)
+        plan['chunk_size'] = chunk_size
+        plan['chunks'] = shards * max(-(-shard_size // chunk_size), 1)
+    except Exception as e:
+        plan['problems'].append(str(e))
+        
+    metadata_file = upload_info['metadata_file']
+    if not os.path.exists(metadata_file):
+        plan['problems'].append('metadata file not found - {}'.format(metadata_file))
+    else:
+        try:
+            metadata_dict = Read_CSVW(metadata_file)
+            plan['csvw_dimensions'] = len(metadata_dict['dimension_data'])
+            plan['has_usage_notes'] = len(metadata_dict['usage_notes']) != 0
+        except Exception as e:
+            plan['problems'].append('metadata file could not be read - {}'.format(e))
+            
+    if plan['dimensions'] is not None and plan['csvw_dimensions'] is not None and plan['dimensions'] != plan['csvw_dimensions']:
+        plan['problems'].append('v4 has {} dimensions, csv-w has {}'.format(plan['dimensions'], plan['csvw_dimensions']))
+        
+    if plan['v4_size'] != 0 and plan['dimensions'] is not None:
+        estimate = Estimate_Dataset_Duration(dataset_id, upload_info, history)
+        plan['observations'] = estimate['observations']
+        plan['upload_seconds'] = estimate['upload_seconds']
+        plan['import_seconds'] = estimate['import_seconds']
+    else:
+        plan['observations'] = 0
+        plan['upload_seconds'] = 0
+        plan['import_seconds'] = 0
+    return plan
+
+
+def Plan_Upload(upload_dict, history_file=None, schedule_policy=None, poll_interval=30):
+    '''
+    Dry run of Multi_Upload_To_Cmd() - nothing is sent to publishing
+    Checks the v4 & csv-w of every dataset and returns a plan of the batch:
+    {datasets: {dataset_id: plan from Plan_Dataset() with requests, import_polls, upload_finished & import_finished},
+     dataset_order, requests (by endpoint), total_requests, total_writes, upload_bytes, chunks, expected_seconds, problems}
+    Times are seconds from the start of the batch, from history_file (see Create_History_Recorder()) or the default rates
+    Uploads run one dataset after another, imports run at the same time once submitted - as in Multi_Upload_To_Cmd()
+    '''
+    Check_Upload_Dict(upload_dict)
+    history = Read_History(history_file)
+    
+    dataset_plans = {dataset_id:Plan_Dataset(dataset_id, upload_dict[dataset_id], history) for dataset_id in upload_dict.keys()}
+    
+    # Schedule_Datasets needs every v4 to be readable
+    if schedule_policy is not None and all(len(dataset_plan['problems']) == 0 for dataset_plan in dataset_plans.values()):
+        dataset_order = Schedule_Datasets(upload_dict, schedule_policy, history_file)
+    else:
+        dataset_order = list(upload_dict.keys())
+        
+    # timeline of the batch
+    seconds = 0
+    for dataset_id in dataset_order:
+        dataset_plan = dataset_plans[dataset_id]
+        seconds += dataset_plan['upload_seconds']
+        dataset_plan['upload_finished'] = seconds
+        dataset_plan['import_finished'] = seconds + dataset_plan['import_seconds']
+        seconds += 2 # small wait between uploads
+    monitoring_started = seconds + 60 # gives cmd a chance to create instances
+    
+    plan = {'datasets':dataset_plans, 'dataset_order':dataset_order, 'requests':collections.Counter({'POST /zebedee/login':1}), 
+            'upload_bytes':0, 'chunks':0, 'expected_seconds':monitoring_started, 'problems':{}}
+    for dataset_id in dataset_order:
+        dataset_plan = dataset_plans[dataset_id]
+        import_polls = max(-(-int(dataset_plan['import_finished'] - monitoring_started) // poll_interval), 0) + 1
+        dataset_plan['import_polls'] = import_polls
+        dataset_plan['requests'] = Get_Planned_Requests(upload_dict[dataset_id], dataset_plan['chunks'], dataset_plan['csvw_dimensions'] or 0, 
+                                                        dataset_plan['has_usage_notes'], import_polls)
+        plan['requests'].update(dataset_plan['requests'])
+        plan['upload_bytes'] += dataset_plan['v4_size']
+        plan['chunks'] += dataset_plan['chunks']
+        plan['expected_seconds'] = max(plan['expected_seconds'], monitoring_started + (import_polls - 1) * poll_interval)
+        if len(dataset_plan['problems']) != 0:
+            plan['problems'][dataset_id] = dataset_plan['problems']
+            
+    plan['requests'] = dict(plan['requests'])
+    plan['total_requests'] = sum(plan['requests'].values())
+    plan['total_writes'] = sum(count for endpoint, count in plan['requests'].items() if not endpoint.startswith('GET '))
+    return plan
+
+
+def Print_Upload_Plan(plan):
+    '''
+    Prints a plan from Plan_Upload()
+    '''
+    for dataset_id in plan['dataset_order']:
+        dataset_plan = plan['datasets'][dataset_id]
+        print('{} - {:.1f}MB in {} chunks, {} observations, upload ~{:.0f}s, import ~{:.0f}s, {} requests'.format(
+                dataset_id, dataset_plan['v4_size'] / (1024 * 1024), dataset_plan['chunks'], dataset_plan['observations'], 
+                dataset_plan['upload_seconds'], dataset_plan['import_seconds'], sum(dataset_plan['requests'].values())))
+        for problem in dataset_plan['problems']:
+            print('    problem - {}'.format(problem))
+            
+    print('Requests by endpoint:')
+    for endpoint, count in sorted(plan['requests'].items(), key=lambda item: -item[1]):
+        print('    {:>6} {}'.format(count, endpoint))
+    print('{} requests ({} writes), {:.1f}MB in {} chunks, expected to take {}'.format(
+            plan['total_requests'], plan['total_writes'], plan['upload_bytes'] / (1024 * 1024), plan['chunks'], 
+            datetime.timedelta(seconds=int(plan['expected_seconds']))))
+    if len(plan['problems']) != 0:
+        print('Datasets with problems - {}'.format(', '.join(plan['problems'].keys())))
+        
+        
+### Stalled imports ###
+# An import has stalled if total_inserted_observations hasn't moved for the stall window
+# The window is stall_window seconds, or longer for datasets expected to take a long time to import
+# (stall_fraction of the expected import time, from the history of import rates)
+# stall_policy decides what happens next:
+#   'wait' - only reported
+#   'resubmit' - a new job is made from the s3_url that was already uploaded, up to max_resubmits times, then quarantined
+#   'quarantine' - the dataset is dropped from the batch so everything else carries on
+
+STALL_POLICIES = ('wait', 'resubmit', 'quarantine')
+
+def Create_Stall_Detector(stall_policy='wait', stall_window=1800, stall_fraction=0.5, max_resubmits=1, history_file=None):
+    '''
+    Returns a dict used to track the import progress of each instance
+    '''
+    assert stall_policy in STALL_POLICIES, 'stall_policy must be one of {}'.format(STALL_POLICIES)
+    
+    stall_detector = {}
+    stall_detector['stall_policy'] = stall_policy
+    stall_detector['stall_window'] = stall_window
+    stall_detector['stall_fraction'] = stall_fraction
+    stall_detector['max_resubmits'] = max_resubmits
+    stall_detector['history'] = Read_History(history_file)
+    stall_detector['instances'] = {}
+    stall_detector['lock'] = threading.Lock()
+    return stall_detector
+
+
+def Get_Stall_Window(stall_detector, dataset_id, total_observations):
+    '''
+    Returns how long an instance of dataset_id can go without progress before it has stalled
+    '''
+    stall_window = stall_detector['stall_window']
+    if total_observations:
+        expected_seconds = total_observations / Get_Expected_Import_Rate(dataset_id, stall_detector['history'])
+        stall_window = max(stall_window, expected_seconds * stall_detector['stall_fraction'])
+    return stall_window
+
+
+def Check_For_Stall(stall_detector, dataset_id, instance_id, import_progress):
+    '''
+    Records a poll of an instance
+    The clock only starts once the import is running - state is submitted and the counts are there
+    Returns True if the import has stalled
+    '''
+    if import_progress['state'] != 'submitted' or import_progress['total_inserted_observations'] is None or import_progress['total_observations'] is None:
+        return False
+    
+    now = time.monotonic()
+    inserted_observations = import_progress['total_inserted_observations']
+    with stall_detector['lock']:
+        progress = stall_detector['instances'].get(instance_id)
+        if progress is None or inserted_observations > progress['inserted_observations']:
+            stall_detector['instances'][instance_id] = {'inserted_observations':inserted_observations, 'last_progress':now}
+            return False
+        
+    stall_window = Get_Stall_Window(stall_detector, dataset_id, import_progress['total_observations'])
+    return now - progress['last_progress'] > stall_window
+
+
+def Handle_Stalled_Import(access_token, stall_detector, dataset_id, upload_info):
+    '''
+    Applies the stall policy to a stalled import
+    Returns 'waiting', 'resubmitted' (upload_info has the new job_id & instance_id) or 'quarantined'
+    '''
+    stall_policy = stall_detector['stall_policy']
+    old_instance_id = upload_info['instance_id']
+    print('{} - import of instance {} has stalled'.format(dataset_id, old_instance_id))
+    
+    if stall_policy == 'wait':
+        with stall_detector['lock']:
+            # don't report it again until another window has passed
+            stall_detector['instances'][old_instance_id]['last_progress'] = time.monotonic()
+        return 'waiting'
+    
+    # instances of this upload that have already stalled
+    resubmits = len(upload_info.get('stalled_instance_ids', []))
+    if stall_policy == 'resubmit' and resubmits < stall_detector['max_resubmits']:
+        # the v4 is already in s3, it only needs a new job
+        if len(upload_info.get('s3_urls', [])) > 1:
+            job_id, instance_id = Submit_Sharded_Job(access_token, dataset_id, upload_info['s3_urls'])
+        else:
+            job_id, instance_id = Post_New_Job(access_token, dataset_id, upload_info['s3_url'])
+            Update_State_Of_Job(access_token, job_id)
+        upload_info.setdefault('stalled_job_ids', []).append(upload_info['job_id'])
+        upload_info.setdefault('stalled_instance_ids', []).append(old_instance_id)
+        upload_info['job_id'] = job_id
+        upload_info['instance_id'] = instance_id
+        print('{} - resubmitted as job {}, instance {}'.format(dataset_id, job_id, instance_id))
+        return 'resubmitted'
+    
+    upload_info['state_of_upload'] = 'quarantined'
+    print('{} - quarantined, the rest of the batch will carry on without it'.format(dataset_id))
+    return 'quarantined'
+
+
+### Failure isolation ###
+# With isolate_failures=True an error for one dataset in Multi_Upload_To_Cmd() doesn't stop the rest of the batch
+# The error is kept in upload_dict[dataset_id]['failure'] = {stage, error, error_type, attempts, failed_at}
+# and state_of_upload is 'failed' - stage is 'upload', 'import' or 'finalize'
+# Failed uploads & finalizes are retried later in the same run, what still fails can be re-run with Get_Failed_Upload_Dict()
+
+MAX_POLL_ERRORS = 5 # polls of an instance that can fail in a row before its dataset is marked as failed
+RETRY_WAIT = 60 # seconds before failed datasets are retried
+
+# keys added to upload_dict[dataset_id] during a run
+UPLOAD_RUN_KEYS = ('s3_url', 's3_urls', 'job_id', 'instance_id', 'job_submitted', 'state_of_upload', 'finalize_values', 'collection_id', 'version_number', 
+                   'stalled_job_ids', 'stalled_instance_ids', 'poll_errors', 'failure')
+
+def Record_Dataset_Failure(dataset_id, upload_info, stage, error):
+    '''
+    Records an error for a dataset in upload_info['failure'] and marks it as failed
+    attempts counts how many times in a row the stage has failed
+    '''
+    failure = upload_info.get('failure')
+    if failure is not None and failure['stage'] == stage:
+        attempts = failure['attempts'] + 1
+    else:
+        attempts = 1
+    upload_info['failure'] = {
+            'stage':stage,
+            'error':str(error),
+            'error_type':type(error).__name__,
+            'attempts':attempts,
+            'failed_at':datetime.datetime.now().isoformat(timespec='seconds')
+            }
+    upload_info['state_of_upload'] = 'failed'
+    print('{} - {} failed (attempt {}), the rest of the batch will carry on - {}'.format(dataset_id, stage, attempts, error))
+    
+    
+def Run_Dataset_Stage(dataset_id, upload_info, stage, function, *args, isolate_failures=True, **kwargs):
+    '''
+    Calls function(*args, **kwargs) for one dataset of a batch
+    With isolate_failures an error is recorded by Record_Dataset_Failure() instead of being raised
+    Returns True if it succeeded
+    '''
+    if not isolate_failures:
+        function(*args, **kwargs)
+        return True
+    
+    try:
+        function(*args, **kwargs)
+    except Exception as e:
+        Record_Dataset_Failure(dataset_id, upload_info, stage, e)
+        return False
+    
+    if upload_info.get('failure') is not None:
+        print('{} - {} succeeded on retry'.format(dataset_id, stage))
+        del upload_info['failure']
+        if upload_info.get('state_of_upload') == 'failed':
+            del upload_info['state_of_upload']
+    return True
+
+
+def Get_Failed_Datasets(upload_dict, dataset_ids, stage=None):
+    '''
+    Returns the datasets in dataset_ids that have failed, only ones that failed at stage if given
+    '''
+    failed_datasets = []
+    for dataset_id in dataset_ids:
+        failure = upload_dict[dataset_id].get('failure')
+        if failure is not None and (stage is None or failure['stage'] == stage):
+            failed_datasets.append(dataset_id)
+    return failed_datasets
+
+
+def Get_Failed_Upload_Dict(upload_dict):
+    '''
+    Returns an upload_dict of only the datasets that failed, without anything added during the run
+    Can be passed straight back to Multi_Upload_To_Cmd() to re-run them
+    '''
+    failed_upload_dict = {}
+    for dataset_id in Get_Failed_Datasets(upload_dict, upload_dict.keys()):
+        failed_upload_dict[dataset_id] = {key:value for key, value in upload_dict[dataset_id].items() if key not in UPLOAD_RUN_KEYS}
+    return failed_upload_dict
+
+
+def Get_Batch_Results(upload_dict, dataset_ids):
+    '''
+    Returns the outcome of each dataset in a batch
+    {dataset_id: {state, instance_id, version_number, stalled_job_ids, stalled_instance_ids, failure}}
+    stalled_job_ids & stalled_instance_ids are the jobs & instances replaced by a resubmit
+    '''
+    results = {}
+    for dataset_id in dataset_ids:
+        upload_info = upload_dict[dataset_id]
+        results[dataset_id] = {
+                'state':upload_info.get('state_of_upload'),
+                'instance_id':upload_info.get('instance_id'),
+                'version_number':upload_info.get('version_number'),
+                'stalled_job_ids':upload_info.get('stalled_job_ids', []),
+                'stalled_instance_ids':upload_info.get('stalled_instance_ids', []),
+                'failure':upload_info.get('failure')
+                }
+    return results
+
+
+### Work queue - splits an upload_dict across multiple workers ###
+# The queue is a single sqlite file, so workers on other machines need it on a shared drive
+# Items are leased to a worker - if a worker stops heartbeating its items are taken over
+
+def Create_Work_Queue(queue_file, upload_dict):
+    '''
+    Splits upload_dict into one work item per dataset and adds them to the queue in queue_file
+    queue_file is created if it doesn't exist
+    Datasets already in the queue are left as they are
+    '''
+    # Quick check on upload_dict format
+    Check_Upload_Dict(upload_dict)
+    
+    conn = Connect_To_Work_Queue(queue_file)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        for dataset_id in upload_dict.keys():
+            conn.execute(
+                    'INSERT OR IGNORE INTO work_items (dataset_id, upload_info, state, attempts, updated) VALUES (?, ?, ?, 0, ?)',
+                    (dataset_id, json.dumps(upload_dict[dataset_id]), 'pending', time.time())
+                    )
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    print('{} datasets added to work queue {}'.format(len(upload_dict), queue_file))
+    
+
+def Connect_To_Work_Queue(queue_file):
+    '''
+    Returns a connection to the work queue, creating the table if needed
+    Transactions are handled explicitly - BEGIN IMMEDIATE locks the queue for writing
+    '''
+    conn = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS work_items (
+            dataset_id TEXT PRIMARY KEY,
+            upload_info TEXT NOT NULL,
+            state TEXT NOT NULL,
+            worker_id TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            updated REAL NOT NULL
+            )""")
+    return conn
+
+
+def Claim_Work_Item(queue_file, worker_id, lease_seconds=300, max_attempts=3):
+    '''
+    Claims the next pending dataset, or one whose lease has run out
+    Returns dataset_id, upload_info - or None, None if there is nothing to claim
+    '''
+    conn = Connect_To_Work_Queue(queue_file)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        now = time.time()
+        
+        # abandoned datasets that have run out of attempts
+        conn.execute(
+                """UPDATE work_items SET state = 'failed', error = 'lease expired', updated = ?
+                WHERE state = 'claimed' AND lease_expires < ? AND attempts >= ?""",
+                (now, now, max_attempts)
+                )
+        
+        row = conn.execute(
+                """SELECT dataset_id, upload_info, state, worker_id FROM work_items 
+                WHERE (state = 'pending' OR (state = 'claimed' AND lease_expires < ?)) AND attempts < ?
+                ORDER BY state DESC, updated LIMIT 1""",
+                (now, max_attempts)
+                ).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None, None
+        
+        dataset_id, upload_info, state, previous_worker_id = row
+        conn.execute(
+                """UPDATE work_items SET state = 'claimed', worker_id = ?, lease_expires = ?, attempts = attempts + 1, updated = ?
+                WHERE dataset_id = ?""",
+                (worker_id, now + lease_seconds, now, dataset_id)
+                )
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+        
+    if state == 'claimed':
+        print('{} - taking over from {}, lease expired'.format(dataset_id, previous_worker_id))
+    return dataset_id, json.loads(upload_info)
+
+
+def Heartbeat_Work_Item(queue_file, dataset_id, worker_id, lease_seconds=300):
+    '''
+    Extends the lease on a claimed dataset
+    Returns False if the dataset is no longer leased to worker_id
+    '''
+    conn = Connect_To_Work_Queue(queue_file)
+    try:
+        cursor = conn.execute(
+                """UPDATE work_items SET lease_expires = ?, updated = ?
+                WHERE dataset_id = ? AND worker_id = ? AND state = 'claimed'""",
+                (time.time() + lease_seconds, time.time(), dataset_id, worker_id)
+                )
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+def Save_Work_Item_Progress(queue_file, dataset_id, worker_id, upload_info):
+    '''
+    Saves upload_info back to the queue so that a worker taking over
+    doesn't upload the v4 or create a job again - see Upload_And_Submit_V4()
+    Returns False if the worker no longer holds the item
+    '''
+    conn = Connect_To_Work_Queue(queue_file)
+    try:
+        cursor = conn.execute(
+                """UPDATE work_items SET upload_info = ?, updated = ?
+                WHERE dataset_id = ? AND worker_id = ? AND state = 'claimed'""",
+                (json.dumps(upload_info), time.time(), dataset_id, worker_id)
+                )
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+def Finish_Work_Item(queue_file, dataset_id, worker_id, upload_info, error=None):
+    '''
+    Marks a dataset as completed, or as failed if error is given
+    Failed datasets can be put back to pending with Retry_Failed_Work_Items()
+    '''
+    if error is None:
+        state = 'completed'
+    else:
+        state = 'failed'
+        
+    conn = Connect_To_Work_Queue(queue_file)
+    try:
+        conn.execute(
+                """UPDATE work_items SET state = ?, upload_info = ?, error = ?, lease_expires = NULL, updated = ?
+                WHERE dataset_id = ? AND worker_id = ?""",
+                (state, json.dumps(upload_info), error, time.time(), dataset_id, worker_id)
+                )
+    finally:
+        conn.close()
+
+
+def Retry_Failed_Work_Items(queue_file, max_attempts=3):
+    '''
+    Puts failed datasets that have attempts left back to pending
+    Returns number of datasets put back
+    '''
+    conn = Connect_To_Work_Queue(queue_file)
+    try:
+        cursor = conn.execute(
+                """UPDATE work_items SET state = 'pending', updated = ? 
+                WHERE state = 'failed' AND attempts < ?""",
+                (time.time(), max_attempts)
+                )
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def Get_Work_Queue_Status(queue_file):
+    '''
+    Returns a dict of each dataset in the queue with its state, worker, attempts, error & upload_info
+    '''
+    conn = Connect_To_Work_Queue(queue_file)
+    try:
+        rows = conn.execute(
+                'SELECT dataset_id, state, worker_id, lease_expires, attempts, error, upload_info FROM work_items'
+                ).fetchall()
+    finally:
+        conn.close()
+        
+    status_dict = {}
+    for dataset_id, state, worker_id, lease_expires, attempts, error, upload_info in rows:
+        status_dict[dataset_id] = {
+                'state':state,
+                'worker_id':worker_id,
+                'lease_expires':lease_expires,
+                'attempts':attempts,
+                'error':error,
+                'upload_info':json.loads(upload_info)
+                }
+    return status_dict
+
+
+def Run_Work_Queue_Worker(credentials, queue_file, worker_id=None, lease_seconds=300, max_attempts=3, progress_callback=None):
+    '''
+    Claims datasets from the work queue one at a time and runs the full upload process for each
+    upload -> monitor -> metadata & collection
+    Any number of workers can be run against the same queue_file, on one or more machines
+    Returns once every dataset in the queue is completed or has failed max_attempts times
+    '''
+    if worker_id is None:
+        worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+        
+    # get access_token
+    access_token = Get_Access_Token(credentials)
+    
+    while True:
+        dataset_id, upload_info = Claim_Work_Item(queue_file, worker_id, lease_seconds, max_attempts)
+        
+        if dataset_id is None:
+            # other workers may still be working - wait in case their leases run out
+            Retry_Failed_Work_Items(queue_file, max_attempts)
+            states = [item['state'] for item in Get_Work_Queue_Status(queue_file).values()]
+            if 'claimed' not in states and 'pending' not in states:
+                break
+            time.sleep(lease_seconds / 5)
+            continue
+        
+        print('{} - claimed by {}'.format(dataset_id, worker_id))
+        
+        # keep the lease going while the dataset is being worked on
+        stop_heartbeat = threading.Event()
+        lease_lost = threading.Event()
+        heartbeat = threading.Thread(
+                target=Keep_Work_Item_Leased, 
+                args=(queue_file, dataset_id, worker_id, lease_seconds, stop_heartbeat, lease_lost),
+                daemon=True
+                )
+        heartbeat.start()
+        
+        def save_progress(upload_info):
+            # saved after each step, so a worker taking over carries on from the same point
+            if lease_lost.is_set() or not Save_Work_Item_Progress(queue_file, dataset_id, worker_id, upload_info):
+                lease_lost.set()
+                raise Work_Item_Lease_Lost(dataset_id)
+        
+        try:
+            # steps already done by a worker this was taken over from are skipped
+            Upload_And_Submit_V4(access_token, dataset_id, upload_info, progress_callback, save_progress=save_progress)
+            if lease_lost.is_set():
+                raise Work_Item_Lease_Lost(dataset_id)
+            Finalize_Upload(access_token, dataset_id, upload_info, progress_callback, cancel_event=lease_lost)
+            if lease_lost.is_set():
+                raise Work_Item_Lease_Lost(dataset_id)
+        except Exception as e:
+            if isinstance(e, Work_Item_Lease_Lost) or lease_lost.is_set():
+                # another worker has the item now, leave it to them
+                print('{} - abandoned by {}, lease was lost'.format(dataset_id, worker_id))
+                continue
+            print('{} - failed - {}'.format(dataset_id, e))
+            Finish_Work_Item(queue_file, dataset_id, worker_id, upload_info, error=str(e))
+        else:
+            Finish_Work_Item(queue_file, dataset_id, worker_id, upload_info)
+            print('{} - completed by {}'.format(dataset_id, worker_id))
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            
+    print('Work queue {} finished'.format(queue_file))
+    return Get_Work_Queue_Status(queue_file)
+
+
+def Keep_Work_Item_Leased(queue_file, dataset_id, worker_id, lease_seconds, stop_event, lease_lost=None):
+    '''
+    Heartbeats a work item every third of lease_seconds until stop_event is set
+    Used in a thread by Run_Work_Queue_Worker()
+    lease_lost is set if the heartbeat fails, the worker stops working on the item when it sees it
+    '''
+    while not stop_event.wait(lease_seconds / 3):
+        if not Heartbeat_Work_Item(queue_file, dataset_id, worker_id, lease_seconds):
+            print('{} - lease lost by {}'.format(dataset_id, worker_id))
+            if lease_lost is not None:
+                lease_lost.set()
+            return
+            
+            
+class Work_Item_Lease_Lost(Exception):
+    '''
+    Raised in Run_Work_Queue_Worker() when another worker has taken over the item
+    '''
+    
+    
+### Post publish audit ###
+# Checks a finished batch - each instance has imported every row of its v4, and the csv-w metadata,
+# dimension labels & usage notes are in CMD
+# Datasets are audited at the same time, the documents of each dataset are fetched concurrently too
+
+AUDIT_IMPORTED_STATES = ('completed', 'edition-confirmed', 'associated', 'approved', 'published')
+ROW_COUNT_BLOCK_SIZE = 16 * 1024 * 1024
+
+def Count_V4_Rows(v4):
+    '''
+    Returns the number of rows in a v4, not including the header
+    Uncompressed v4s are memory mapped and newlines counted a block at a time, compressed ones are streamed
+    Rows are split on newlines, so a newline inside a quoted label counts as an extra row
+    '''
+    number_of_newlines = 0
+    last_byte = b'\n'
+    if Get_V4_Compression(v4) is None:
+        if os.path.getsize(v4) == 0:
+            return 0
+        with open(v4, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_v4:
+            for start in range(0, len(mapped_v4), ROW_COUNT_BLOCK_SIZE):
+                number_of_newlines += mapped_v4[start:start + ROW_COUNT_BLOCK_SIZE].count(b'\n')
+            last_byte = mapped_v4[-1:]
+    else:
+        with Open_V4(v4) as f:
+            while True:
+                block = f.read(ROW_COUNT_BLOCK_SIZE)
+                if not block:
+                    break
+                number_of_newlines += block.count(b'\n')
+                last_byte = block[-1:]
+                
+    # last row may not end with a newline
+    if last_byte != b'\n':
+        number_of_newlines += 1
+    return max(number_of_newlines - 1, 0)
+
+
+def Load_Audit_Upload_Dict(source):
+    '''
+    Returns the upload_dict of a finished batch from source, which can be
+    the upload_dict after Multi_Upload_To_Cmd(), a json file of it, or a work queue file (see Create_Work_Queue())
+    '''
+    if type(source) == dict:
+        return source
+    
+    with open(source, 'rb') as f:
+        is_sqlite = f.read(16) == b'SQLite format 3\x00'
+    if is_sqlite:
+        return {dataset_id:item['upload_info'] for dataset_id, item in Get_Work_Queue_Status(source).items()}
+    
+    with open(source, 'r') as f:
+        return json.load(f)
+    
+    
+def Add_Audit_Check(checks, check, passed, expected=None, found=None):
+    '''
+    Adds the result of one check to an audit
+    '''
+    checks.append({'check':check, 'passed':passed, 'expected':expected, 'found':found})
+    
+    
+def Audit_Dataset(access_token, dataset_id, upload_info, metadata_dict):
+    '''
+    Audits one dataset of a finished batch
+    metadata_dict is from Read_CSVW() of its metadata_file
+    Returns a list of checks - {check, passed, expected, found}
+    '''
+    checks = []
+    instance_id = upload_info['instance_id']
+    edition = upload_info['edition']
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        rows_future = executor.submit(Count_V4_Rows, upload_info['v4'])
+        version_number = upload_info.get('version_number')
+        dataset_dict, instance_dict, version_dict = Get_Metadata_Documents(access_token, dataset_id, instance_id, edition, version_number)
+
+        # version number wasn't saved in upload_info - it's in the instance once a version has been created
+        if version_number is None and instance_dict.get('version') is not None:
+            version_number = instance_dict['version']
+            version_dict = Get_Version_Info(access_token, dataset_id, edition, version_number)
+        number_of_rows = rows_future.result()
+        
+    # import
+    Add_Audit_Check(checks, 'instance state', instance_dict.get('state') in AUDIT_IMPORTED_STATES, 
+                    ' or '.join(AUDIT_IMPORTED_STATES), instance_dict.get('state'))
+    Add_Audit_Check(checks, 'instance dataset', Get_Nested(instance_dict, 'links', 'dataset', 'id') == dataset_id, 
+                    dataset_id, Get_Nested(instance_dict, 'links', 'dataset', 'id'))
+    Add_Audit_Check(checks, 'total_observations', instance_dict.get('total_observations') == number_of_rows, 
+                    number_of_rows, instance_dict.get('total_observations'))
+    inserted_observations = Get_Nested(instance_dict, 'import_tasks', 'import_observations', 'total_inserted_observations')
+    Add_Audit_Check(checks, 'total_inserted_observations', inserted_observations == number_of_rows, number_of_rows, inserted_observations)
+    Add_Audit_Check(checks, 'version', version_number is not None, 'a version number', version_number)
+    
+    # metadata
+    current_metadata_dict = Current_Metadata_From_Documents(dataset_dict, instance_dict, version_dict)
+    for key in metadata_dict['metadata'].keys():
+        Add_Audit_Check(checks, 'metadata - {}'.format(key), 
+                        Metadata_Value_Matches(metadata_dict['metadata'][key], current_metadata_dict['metadata'].get(key)), 
+                        metadata_dict['metadata'][key], current_metadata_dict['metadata'].get(key))
+    for dimension in metadata_dict['dimension_data'].keys():
+        current_dimension = current_metadata_dict['dimension_data'].get(dimension)
+        if current_dimension is not None:
+            current_dimension = {key:current_dimension.get(key) for key in metadata_dict['dimension_data'][dimension].keys()}
+        Add_Audit_Check(checks, 'dimension - {}'.format(dimension), 
+                        Metadata_Value_Matches(metadata_dict['dimension_data'][dimension], current_dimension), 
+                        metadata_dict['dimension_data'][dimension], current_dimension)
+    if len(metadata_dict['usage_notes']) != 0:
+        Add_Audit_Check(checks, 'usage notes', Metadata_Value_Matches(metadata_dict['usage_notes'], current_metadata_dict['usage_notes']), 
+                        metadata_dict['usage_notes'], current_metadata_dict['usage_notes'])
+    return checks
+
+
+def Audit_Upload(credentials, source, max_workers=16, parse_processes=None):
+    '''
+    Checks every dataset of a finished batch against its v4 & csv-w
+    source is the upload_dict after Multi_Upload_To_Cmd(), a json file of it, or a work queue file
+    Rows of each v4 are counted locally (see Count_V4_Rows()), csv-ws are read in parallel (see Read_CSVWs())
+    Returns a report {dataset_id: {passed, checks, error}} - checks are {check, passed, expected, found}
+    '''
+    upload_dict = Load_Audit_Upload_Dict(source)
+    Check_Upload_Dict(upload_dict)
+    
+    access_token = Get_Access_Token(credentials)
+    metadata_dicts = Read_CSVWs(set(upload_info['metadata_file'] for upload_info in upload_dict.values()), parse_processes)
+    
+    def audit(dataset_id):
+        upload_info = upload_dict[dataset_id]
+        if upload_info.get('instance_id') is None:
+            raise Exception('no instance_id, dataset was not uploaded')
+        metadata_dict = metadata_dicts[upload_info['metadata_file']]
+        if isinstance(metadata_dict, Exception):
+            raise Exception('csv-w could not be read - {}'.format(metadata_dict))
+        return Audit_Dataset(access_token, dataset_id, upload_info, metadata_dict)
+    
+    report = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(audit, dataset_id):dataset_id for dataset_id in upload_dict.keys()}
+        for future in concurrent.futures.as_completed(futures):
+            dataset_id = futures[future]
+            try:
+                checks = future.result()
+            except Exception as e:
+                report[dataset_id] = {'passed':False, 'checks':[], 'error':str(e)}
+            else:
+                report[dataset_id] = {'passed':all(check['passed'] for check in checks), 'checks':checks, 'error':None}
+                
+    report = {dataset_id:report[dataset_id] for dataset_id in upload_dict.keys()}
+    Print_Audit_Report(report)
+    return report
+
+
+def Print_Audit_Report(report):
+    '''
+    Prints a pass/fail line for each dataset in a report from Audit_Upload(), with the checks that failed
+    '''
+    for dataset_id, result in report.items():
+        if result['passed']:
+            print('{} - PASS ({} checks)'.format(dataset_id, len(result['checks'])))
+            continue
+        print('{} - FAIL'.format(dataset_id))
+        if result['error'] is not None:
+            print('    error - {}'.format(result['error']))
+        for check in result['checks']:
+            if not check['passed']:
+                print('    {} - expected {}, found {}'.format(check['check'], check['expected'], check['found']))
+                
+    number_passed = sum(1 for result in report.values() if result['passed'])
+    print('{} of {} datasets passed'.format(number_passed, len(report)))
+    
+    
+### Response cache ###
+# GET responses are kept in memory (LRU, bounded by size) and optionally on disk
+# Within its TTL an entry is returned without a request, after that it is revalidated
+# with If-None-Match / If-Modified-Since so an unchanged response is a 304
+# Any write through the session clears cached responses from the same API (apart from upload chunks)
+# Entries are keyed on the url and a hash of the token, as what a florence user can see depends on their permissions
+
+# (regex on url path, ttl in seconds) - first match is used, urls that don't match aren't cached
+DEFAULT_CACHE_TTL_RULES = [
+        (r'^/recipes', 300),
+        (r'^/code-lists', 3600),
+        (r'^/dataset/(instances|jobs)(/[^/]+)?$', 0), # state changes during an import, always revalidate
+        (r'^/dataset/datasets/', 0),
+        (r'^/zebedee/collection/', 0)
+        ]
+CACHE_UNCHANGED_BY_WRITES = ('upload',) # apis whose writes don't change anything cached - chunks go to s3
+
+def Create_Response_Cache(max_bytes=64 * 1024 * 1024, disk_dir=None, ttl_rules=None):
+    '''
+    Returns a dict used as a response cache by Enable_Response_Cache()
+    max_bytes is the size limit of the in memory cache
+    disk_dir is an optional directory to also keep responses in, so they last between runs
+    ttl_rules is a list of (regex on url path, ttl in seconds), defaults to DEFAULT_CACHE_TTL_RULES
+    '''
+    if ttl_rules is None:
+        ttl_rules = DEFAULT_CACHE_TTL_RULES
+    if disk_dir is not None and not os.path.exists(disk_dir):
+        os.makedirs(disk_dir)
+        
+    response_cache = {}
+    response_cache['entries'] = collections.OrderedDict() # cache key -> entry, least recently used first
+    response_cache['bytes'] = 0
+    response_cache['max_bytes'] = max_bytes
+    response_cache['disk_dir'] = disk_dir
+    response_cache['disk_index'] = Read_Cache_Disk_Index(disk_dir) # entry file name -> url, of entries on disk
+    response_cache['ttl_rules'] = [(re.compile(pattern), ttl) for pattern, ttl in ttl_rules]
+    response_cache['lock'] = threading.Lock()
+    response_cache['stats'] = {'hits':0, 'revalidated':0, 'misses':0, 'invalidated':0}
+    return response_cache
+
+
+def Read_Cache_Disk_Index(disk_dir):
+    '''
+    Returns {entry file name:url} of the entries kept in disk_dir
+    Only read when the cache is created, after that it is kept up to date as entries are stored & invalidated
+    '''
+    disk_index = {}
+    if disk_dir is None:
+        return disk_index
+    for file_name in os.listdir(disk_dir):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(disk_dir, file_name), 'r') as f:
+                disk_index[file_name[:-len('.json')]] = json.load(f)['url']
+        except (OSError, ValueError, KeyError):
+            continue
+    return disk_index
+
+
+def Get_Cache_Key(url, token=None):
+    '''
+    Returns the key a response is cached under - the url and a hash of the token
+    '''
+    if token is None:
+        return url
+    return '{} {}'.format(hashlib.sha256(token.encode('utf-8')).hexdigest()[:16], url)
+
+
+def Get_Cache_Entry_File(response_cache, cache_key):
+    '''
+    Returns the path of an entry on disk, without the .json/.body extension
+    '''
+    return os.path.join(response_cache['disk_dir'], hashlib.sha256(cache_key.encode('utf-8')).hexdigest())
+
+
+def Get_Cache_Ttl(response_cache, url):
+    '''
+    Returns the ttl for a url, or None if it shouldn't be cached
+    '''
+    path = urllib.parse.urlsplit(url).path
+    for pattern, ttl in response_cache['ttl_rules']:
+        if pattern.search(path):
+            return ttl
+    return None
+
+
+def Is_Url_Cached(url):
+    '''
+    True if GETs of url go through the response cache on session
+    '''
+    response_cache = Get_Mounted_Response_Cache()
+    return response_cache is not None and Get_Cache_Ttl(response_cache, url) is not None
+
+
+def Get_Cache_Entry(response_cache, cache_key):
+    '''
+    Returns the cached entry for a cache key (see Get_Cache_Key()) from memory or disk, or None
+    '''
+    with response_cache['lock']:
+        if cache_key in response_cache['entries'].keys():
+            response_cache['entries'].move_to_end(cache_key)
+            return response_cache['entries'][cache_key]
+        
+    if response_cache['disk_dir'] is None:
+        return None
+    
+    entry_file = Get_Cache_Entry_File(response_cache, cache_key)
+    if os.path.basename(entry_file) not in response_cache['disk_index'].keys():
+        return None
+    try:
+        with open(entry_file + '.json', 'r') as f:
+            entry = json.load(f)
+        with open(entry_file + '.body', 'rb') as f:
+            entry['content'] = f.read()
+    except (OSError, ValueError):
+        return None
+    Store_Cache_Entry(response_cache, cache_key, entry, write_to_disk=False)
+    return entry
+
+
+def Store_Cache_Entry(response_cache, cache_key, entry, write_to_disk=True):
+    '''
+    Adds an entry to the cache, removing the least recently used entries if over max_bytes
+    entry is a dict of url, status_code, headers, content, etag, last_modified, stored_at
+    '''
+    size = len(entry['content'])
+    with response_cache['lock']:
+        if cache_key in response_cache['entries'].keys():
+            response_cache['bytes'] -= len(response_cache['entries'].pop(cache_key)['content'])
+        if size <= response_cache['max_bytes']:
+            response_cache['entries'][cache_key] = entry
+            response_cache['bytes'] += size
+        while response_cache['bytes'] > response_cache['max_bytes']:
+            old_cache_key, old_entry = response_cache['entries'].popitem(last=False)
+            response_cache['bytes'] -= len(old_entry['content'])
+            
+    if write_to_disk and response_cache['disk_dir'] is not None:
+        entry_file = Get_Cache_Entry_File(response_cache, cache_key)
+        with open(entry_file + '.body.tmp', 'wb') as f:
+            f.write(entry['content'])
+        os.replace(entry_file + '.body.tmp', entry_file + '.body')
+        with open(entry_file + '.json.tmp', 'w') as f:
+            json.dump({key:value for key, value in entry.items() if key != 'content'}, f)
+        os.replace(entry_file + '.json.tmp', entry_file + '.json')
+        with response_cache['lock']:
+            response_cache['disk_index'][os.path.basename(entry_file)] = entry['url']
+
+
+def Invalidate_Response_Cache(response_cache, url_prefix=None):
+    '''
+    Removes cached responses whose url starts with url_prefix, or everything if url_prefix is None
+    Returns number of entries removed
+    '''
+    with response_cache['lock']:
+        cache_keys = [cache_key for cache_key, entry in response_cache['entries'].items() if url_prefix is None or entry['url'].startswith(url_prefix)]
+        for cache_key in cache_keys:
+            response_cache['bytes'] -= len(response_cache['entries'].pop(cache_key)['content'])
+        response_cache['stats']['invalidated'] += len(cache_keys)
+        
+        file_names = [file_name for file_name, url in response_cache['disk_index'].items() if url_prefix is None or url.startswith(url_prefix)]
+        for file_name in file_names:
+            del response_cache['disk_index'][file_name]
+            
+    for file_name in file_names:
+        for extension in ('.json', '.body'):
+            entry_file = os.path.join(response_cache['disk_dir'], file_name + extension)
+            if os.path.exists(entry_file):
+                os.remove(entry_file)
+                
+    return len(cache_keys)
+
+
+def Response_From_Cache_Entry(request, entry, cache_status):
+    '''
+    Builds a requests Response from a cache entry
+    X-Cache header is set to cache_status - HIT or REVALIDATED
+    '''
+    response = requests.models.Response()
+    response.status_code = entry['status_code']
+    response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    response.headers['X-Cache'] = cache_status
+    response._content = entry['content']
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.url = request.url
+    response.request = request
+    response.reason = 'OK'
+    return response
+
+
+class Caching_Adapter(requests.adapters.BaseAdapter):
+    '''
+    Transport adapter that caches GET responses in response_cache
+    Requests are sent through inner_adapter
+    '''
+    def __init__(self, response_cache, inner_adapter):
+        super().__init__()
+        self.response_cache = response_cache
+        self.inner_adapter = inner_adapter
+        
+    def send(self, request, **kwargs):
+        response_cache = self.response_cache
+        
+        if request.method != 'GET':
+            response = self.inner_adapter.send(request, **kwargs)
+            # clear anything cached from the same api - ie /recipes, /dataset, /zebedee
+            split_url = urllib.parse.urlsplit(request.url)
+            api_name = split_url.path.strip('/').split('/')[0]
+            if response.status_code < 400 and api_name not in CACHE_UNCHANGED_BY_WRITES:
+                Invalidate_Response_Cache(response_cache, '{}://{}/{}'.format(split_url.scheme, split_url.netloc, api_name))
+            return response
+        
+        ttl = Get_Cache_Ttl(response_cache, request.url)
+        if ttl is None or kwargs.get('stream'):
+            return self.inner_adapter.send(request, **kwargs)
+        
+        cache_key = Get_Cache_Key(request.url, request.headers.get('X-Florence-Token'))
+        entry = Get_Cache_Entry(response_cache, cache_key)
+        if entry is not None and time.time() - entry['stored_at'] < ttl:
+            Count_Cache_Stat(response_cache, 'hits')
+            return Response_From_Cache_Entry(request, entry, 'HIT')
+        
+        if entry is not None:
+            if entry['etag'] is not None:
+                request.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                request.headers['If-Modified-Since'] = entry['last_modified']
+                
+        response = self.inner_adapter.send(request, **kwargs)
+        
+        if response.status_code == 304 and entry is not None:
+            Count_Cache_Stat(response_cache, 'revalidated')
+            entry['stored_at'] = time.time()
+            Store_Cache_Entry(response_cache, cache_key, entry)
+            return Response_From_Cache_Entry(request, entry, 'REVALIDATED')
+        
+        Count_Cache_Stat(response_cache, 'misses')
+        if response.status_code == 200:
+            entry = {
+                    'url':request.url,
+                    'status_code':response.status_code,
+                    'headers':dict(response.headers),
+                    'content':response.content,
+                    'etag':response.headers.get('ETag'),
+                    'last_modified':response.headers.get('Last-Modified'),
+                    'stored_at':time.time()
+                    }
+            Store_Cache_Entry(response_cache, cache_key, entry)
+        return response
+    
+    def close(self):
+        self.inner_adapter.close()
+
+
+def Count_Cache_Stat(response_cache, stat):
+    '''
+    Adds one to a response cache stat - hits, revalidated or misses
+    '''
+    with response_cache['lock']:
+        response_cache['stats'][stat] += 1
+
+
+def Enable_Response_Cache(response_cache=None):
+    '''
+    Caches GET responses from publishing made through session
+    Uses a new Create_Response_Cache() if response_cache isn't given
+    Returns the response cache
+    '''
+    if response_cache is None:
+        response_cache = Create_Response_Cache()
+    inner_adapter = session.get_adapter(PUBLISHING_URL)
+    session.mount(PUBLISHING_URL, Caching_Adapter(response_cache, inner_adapter))
+    return response_cache
+
+
+def Disable_Response_Cache():
+    '''
+    Stops caching responses made through session
+    '''
+    Remove_Session_Adapter(Caching_Adapter)
+    
+    
+def Get_Mounted_Response_Cache():
+    '''
+    Returns the response cache in use on session, None if caching isn't enabled
+    '''
+    adapter = session.get_adapter(PUBLISHING_URL)
+    while adapter is not None:
+        if isinstance(adapter, Caching_Adapter):
+            return adapter.response_cache
+        adapter = getattr(adapter, 'inner_adapter', None)
+    return None
+
+
+def Remove_Session_Adapter(adapter_class):
+    '''
+    Removes an adapter of adapter_class from the adapters mounted on session for publishing
+    Adapters wrap each other through inner_adapter
+    '''
+    outer_adapter = None
+    adapter = session.get_adapter(PUBLISHING_URL)
+    while hasattr(adapter, 'inner_adapter'):
+        if isinstance(adapter, adapter_class):
+            if outer_adapter is None:
+                session.mount(PUBLISHING_URL, adapter.inner_adapter)
+            else:
+                outer_adapter.inner_adapter = adapter.inner_adapter
+            return
+        outer_adapter = adapter
+        adapter = adapter.inner_adapter
+        
+        
+### Single flight ###
+# Identical GETs made at the same time (ie by several upload threads) share one request
+# Keyed by method, url (including params), token and conditional headers - every caller gets its own copy of the response
+# Off unless Enable_Single_Flight() is called
+
+class Single_Flight_Adapter(requests.adapters.BaseAdapter):
+    '''
+    Transport adapter that sends one request for concurrent identical GETs
+    Requests are sent through inner_adapter
+    '''
+    def __init__(self, inner_adapter):
+        super().__init__()
+        self.inner_adapter = inner_adapter
+        self.lock = threading.Lock()
+        self.in_flight = {} # key -> {event, response, error}
+        self.stats = {'sent':0, 'shared':0}
+        
+    def send(self, request, **kwargs):
+        if request.method != 'GET' or kwargs.get('stream'):
+            return self.inner_adapter.send(request, **kwargs)
+        
+        # a conditional request (from Caching_Adapter) can get a 304 with no body, so only share it with the same conditions
+        key = (request.method, request.url, request.headers.get('X-Florence-Token'), 
+               request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since'))
+        with self.lock:
+            call = self.in_flight.get(key)
+            if call is None:
+                call = {'event':threading.Event(), 'response':None, 'error':None}
+                self.in_flight[key] = call
+                leader = True
+            else:
+                leader = False
+                
+        if leader:
+            try:
+                response = self.inner_adapter.send(request, **kwargs)
+                response.content # read it now so it can be shared
+                call['response'] = response
+                with self.lock:
+                    self.stats['sent'] += 1
+                return response
+            except Exception as e:
+                call['error'] = e
+                raise
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+                call['event'].set()
+                
+        call['event'].wait()
+        if call['error'] is not None:
+            raise call['error']
+        with self.lock:
+            self.stats['shared'] += 1
+        return Copy_Response(request, call['response'])
+    
+    def close(self):
+        self.inner_adapter.close()
+        
+        
+def Copy_Response(request, response):
+    '''
+    Returns a copy of a response that has already been read, for a different request
+    '''
+    response_copy = requests.models.Response()
+    response_copy.status_code = response.status_code
+    response_copy.headers = requests.structures.CaseInsensitiveDict(response.headers)
+    response_copy._content = response.content
+    response_copy.encoding = response.encoding
+    response_copy.url = response.url
+    response_copy.reason = response.reason
+    response_copy.elapsed = response.elapsed
+    response_copy.request = request
+    return response_copy
+
+
+def Enable_Single_Flight():
+    '''
+    Shares one request between identical GETs to publishing made at the same time through session
+    Returns the adapter - adapter.stats has counts of requests sent and shared
+    '''
+    single_flight_adapter = Get_Session_Adapter(Single_Flight_Adapter)
+    if single_flight_adapter is not None:
+        return single_flight_adapter # already enabled
+    single_flight_adapter = Single_Flight_Adapter(session.get_adapter(PUBLISHING_URL))
+    session.mount(PUBLISHING_URL, single_flight_adapter)
+    return single_flight_adapter
+
+
+def Disable_Single_Flight():
+    '''
+    Stops sharing identical GETs
+    '''
+    Remove_Session_Adapter(Single_Flight_Adapter)
+
+
+async_in_flight = {} # (event loop, key) -> asyncio future
+
+async def Async_Session_Get(url, headers=None, params=None):
+    '''
+    GET through session for asyncio code, the request is run in the default executor
+    Identical GETs from coroutines at the same time share one executor call,
+    and still go through the adapters on session (single flight, cache etc)
+    '''
+    loop = asyncio.get_running_loop()
+    full_url = requests.Request('GET', url, params=params).prepare().url
+    token = None
+    if headers is not None:
+        token = headers.get('X-Florence-Token')
+    key = (loop, full_url, token)
+    
+    future = async_in_flight.get(key)
+    if future is None:
+        future = loop.run_in_executor(None, lambda: session.get(url, headers=headers, params=params))
+        async_in_flight[key] = future
+        future.add_done_callback(lambda done_future: async_in_flight.pop(key, None))
+        
+    response = await asyncio.shield(future)
+    return Copy_Response(response.request, response)
+
+
+### Record and replay ###
+# Recording writes every request to publishing and its response to a trace file (json lines) as it goes over the network,
+# with the time it started and how long it took - tokens, credentials and cookies are redacted
+# Replaying serves a trace in place of the network, with the recorded latency or a multiple of it, 
+# so the request count & wall time of a Multi_Upload_To_Cmd run can be measured without a florence account
+# Both go underneath the other adapters (single flight, cache) so the trace is what was actually sent
+
+TRACE_REDACTED_HEADERS = ('X-Florence-Token', 'Authorization', 'Cookie', 'Set-Cookie')
+TRACE_REDACTED_FIELDS = ('email', 'password') # json body fields
+TRACE_DROPPED_HEADERS = ('Content-Length', 'Content-Encoding', 'Transfer-Encoding') # content is stored decoded
+TRACE_IGNORED_PARAMS = ('resumableIdentifier',) # made from the time of the upload, so changes every run
+
+wait_scale = 1.0 # multiplies the waits between polls in Multi_Upload_To_Cmd, see Pipeline_Sleep()
+
+def Pipeline_Sleep(seconds, cancel_event=None):
+    '''
+    time.sleep() for the pipeline's own waits (between uploads, between import polls)
+    Scaled by wait_scale, which Replay_Upload() sets to its latency_scale
+    The wait ends early if cancel_event is set, returns True if it was
+    '''
+    if cancel_event is None:
+        time.sleep(seconds * wait_scale)
+        return False
+    return cancel_event.wait(seconds * wait_scale)
+    
+    
+def Get_Trace_Key(method, url):
+    '''
+    Returns the key a request is matched on when replaying - method and url without TRACE_IGNORED_PARAMS
+    '''
+    split_url = urllib.parse.urlsplit(url)
+    params = [(key, value) for key, value in urllib.parse.parse_qsl(split_url.query, keep_blank_values=True) if key not in TRACE_IGNORED_PARAMS]
+    return '{} {}'.format(method, urllib.parse.urlunsplit(split_url._replace(query=urllib.parse.urlencode(params))))
+
+
+def Get_Trace_Endpoint(method, url):
+    '''
+    Returns the endpoint a request is counted under - ie 'GET /dataset/instances/{id}'
+    Query strings are dropped and ids (uuids & numbers) are replaced with {id}
+    '''
+    path_parts = []
+    for part in urllib.parse.urlsplit(url).path.split('/'):
+        if part.isdigit() or re.fullmatch(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', part):
+            part = '{id}'
+        path_parts.append(part)
+    return '{} {}'.format(method, '/'.join(path_parts))
+
+
+def Redact_Trace_Value(value, secrets):
+    '''
+    Returns value (a json value) with TRACE_REDACTED_FIELDS and any of secrets replaced by 'REDACTED'
+    '''
+    if isinstance(value, dict):
+        return {key:('REDACTED' if key in TRACE_REDACTED_FIELDS else Redact_Trace_Value(item, secrets)) for key, item in value.items()}
+    if isinstance(value, list):
+        return [Redact_Trace_Value(item, secrets) for item in value]
+    if isinstance(value, str):
+        for secret in secrets:
+            value = value.replace(secret, 'REDACTED')
+    return value
+
+
+def Redact_Trace_Headers(headers, secrets):
+    '''
+    Returns a dict of headers with TRACE_REDACTED_HEADERS redacted and TRACE_DROPPED_HEADERS left out
+    '''
+    redacted_headers = {}
+    for key, value in headers.items():
+        if key.lower() in [header.lower() for header in TRACE_DROPPED_HEADERS]:
+            continue
+        if key.lower() in [header.lower() for header in TRACE_REDACTED_HEADERS]:
+            value = 'REDACTED'
+        redacted_headers[key] = Redact_Trace_Value(value, secrets)
+    return redacted_headers
+
+
+def Get_Trace_Request_Body(request, secrets):
+    '''
+    Returns (json body, size of body) for a request
+    Only json bodies are kept (redacted), others (ie uploaded chunks) are recorded as a size
+    '''
+    body = request.body
+    if body is None or not isinstance(body, (bytes, str)):
+        return None, 0
+    if 'json' not in request.headers.get('Content-Type', ''):
+        return None, len(body)
+    try:
+        json_body = json.loads(body)
+    except ValueError:
+        return None, len(body)
+    return Redact_Trace_Value(json_body, secrets), len(body)
+
+
+class Recording_Adapter(requests.adapters.BaseAdapter):
+    '''
+    Transport adapter that writes every request & response to trace_file
+    Requests are sent through inner_adapter
+    '''
+    def __init__(self, trace_file, inner_adapter):
+        super().__init__()
+        self.inner_adapter = inner_adapter
+        self.trace_file = trace_file
+        self.file = open(trace_file, 'a')
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.secrets = set() # tokens seen so far, redacted wherever they turn up
+        self.stats = {'requests':0}
+        
+    def send(self, request, **kwargs):
+        token = request.headers.get('X-Florence-Token')
+        if token:
+            self.secrets.add(token)
+        if request.url.rstrip('/').endswith('/zebedee/login') and request.body is not None:
+            login = json.loads(request.body)
+            self.secrets.update(login[field] for field in TRACE_REDACTED_FIELDS if login.get(field))
+            
+        started = time.monotonic()
+        try:
+            response = self.inner_adapter.send(request, **kwargs)
+            content = response.content # read it all so elapsed includes the download
+        except requests.exceptions.RequestException as e:
+            self.Write_Entry(request, None, started, time.monotonic() - started, str(e))
+            raise
+        elapsed = time.monotonic() - started
+        if kwargs.get('stream'):
+            response.raw = io.BytesIO(content)
+            
+        if request.url.rstrip('/').endswith('/zebedee/login') and response.status_code == 200:
+            self.secrets.add(response.text.strip('"'))
+        self.Write_Entry(request, response, started, elapsed, None)
+        return response
+    
+    def Write_Entry(self, request, response, started, elapsed, error):
+        secrets = sorted(self.secrets, key=len, reverse=True)
+        request_body, request_bytes = Get_Trace_Request_Body(request, secrets)
+        entry = {
+                'started':round(started - self.started, 6),
+                'elapsed':round(elapsed, 6),
+                'method':request.method,
+                'url':Redact_Trace_Value(request.url, secrets),
+                'request_headers':Redact_Trace_Headers(request.headers, secrets),
+                'request_body':request_body,
+                'request_bytes':request_bytes,
+                'error':error
+                }
+        if response is not None:
+            try:
+                content = Redact_Trace_Value(response.content.decode('utf-8'), secrets)
+                content_encoding = 'utf-8'
+            except UnicodeDecodeError:
+                content = base64.b64encode(response.content).decode('ascii')
+                content_encoding = 'base64'
+            entry['status_code'] = response.status_code
+            entry['reason'] = response.reason
+            entry['headers'] = Redact_Trace_Headers(response.headers, secrets)
+            entry['content'] = content
+            entry['content_encoding'] = content_encoding
+            
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.stats['requests'] += 1
+            
+    def close(self):
+        self.file.close()
+        self.inner_adapter.close()
+        
+        
+class Replay_Adapter(requests.adapters.BaseAdapter):
+    '''
+    Transport adapter that serves the responses in trace_file instead of sending requests
+    Each response is delayed by its recorded elapsed time * latency_scale (0 for no delay)
+    Requests are matched on Get_Trace_Key() in the order they were recorded, 
+    once only one response is left for a request it is served every time (ie repeated polls)
+    '''
+    def __init__(self, trace_file, latency_scale=1.0):
+        super().__init__()
+        self.trace_file = trace_file
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.entries = {} # key -> deque of entries not served yet
+        with open(trace_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault(Get_Trace_Key(entry['method'], entry['url']), collections.deque()).append(entry)
+        self.stats = {'requests':0, 'repeated':0, 'unmatched':0, 'by_endpoint':collections.Counter()}
+        
+    def send(self, request, **kwargs):
+        key = Get_Trace_Key(request.method, request.url)
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['by_endpoint'][Get_Trace_Endpoint(request.method, request.url)] += 1
+            recorded_entries = self.entries.get(key)
+            if not recorded_entries:
+                self.stats['unmatched'] += 1
+                raise requests.exceptions.ConnectionError('No recorded response for {}'.format(key), request=request)
+            if len(recorded_entries) > 1:
+                entry = recorded_entries.popleft()
+            else:
+                entry = recorded_entries[0]
+                if entry.get('served'):
+                    self.stats['repeated'] += 1
+                entry['served'] = True
+                
+        if self.latency_scale:
+            time.sleep(entry['elapsed'] * self.latency_scale)
+        if entry['error'] is not None:
+            raise requests.exceptions.ConnectionError(entry['error'], request=request)
+        return Response_From_Trace_Entry(request, entry)
+    
+    def close(self):
+        pass
+    
+    
+def Response_From_Trace_Entry(request, entry):
+    '''
+    Builds a requests Response from a trace entry
+    '''
+    if entry['content_encoding'] == 'base64':
+        content = base64.b64decode(entry['content'])
+    else:
+        content = entry['content'].encode('utf-8')
+    response = requests.models.Response()
+    response.status_code = entry['status_code']
+    response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    response._content = content
+    response.raw = io.BytesIO(content) # for streamed listings
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.url = request.url
+    response.request = request
+    response.reason = entry['reason']
+    return response
+
+
+def Replace_Transport_Adapter(transport_adapter):
+    '''
+    Swaps the adapter at the bottom of the adapters mounted on session for publishing - the one that sends requests
+    Returns the adapter that was replaced
+    '''
+    outer_adapter = None
+    adapter = session.get_adapter(PUBLISHING_URL)
+    while hasattr(adapter, 'inner_adapter'):
+        outer_adapter = adapter
+        adapter = adapter.inner_adapter
+    if outer_adapter is None:
+        session.mount(PUBLISHING_URL, transport_adapter)
+    else:
+        outer_adapter.inner_adapter = transport_adapter
+    return adapter
+
+
+def Get_Session_Adapter(adapter_class):
+    '''
+    Returns the adapter of adapter_class mounted on session for publishing, None if there isn't one
+    '''
+    adapter = session.get_adapter(PUBLISHING_URL)
+    while adapter is not None:
+        if isinstance(adapter, adapter_class):
+            return adapter
+        adapter = getattr(adapter, 'inner_adapter', None)
+    return None
+
+
+def Enable_Recording(trace_file):
+    '''
+    Records every request made to publishing through session, and its response, to trace_file
+    Returns the adapter - adapter.stats has the number of requests recorded
+    '''
+    recording_adapter = Recording_Adapter(trace_file, None)
+    recording_adapter.inner_adapter = Replace_Transport_Adapter(recording_adapter)
+    return recording_adapter
+
+
+def Disable_Recording():
+    '''
+    Stops recording and closes the trace file
+    '''
+    recording_adapter = Get_Session_Adapter(Recording_Adapter)
+    if recording_adapter is not None:
+        Remove_Session_Adapter(Recording_Adapter)
+        recording_adapter.file.close()
+        
+        
+def Enable_Replay(trace_file, latency_scale=1.0):
+    '''
+    Serves requests made to publishing through session from trace_file, nothing is sent
+    Returns the adapter - adapter.stats has counts of requests by endpoint
+    '''
+    replay_adapter = Replay_Adapter(trace_file, latency_scale)
+    replay_adapter.replaced_adapter = Replace_Transport_Adapter(replay_adapter)
+    return replay_adapter
+
+
+def Disable_Replay():
+    '''
+    Stops replaying, requests go over the network again
+    '''
+    replay_adapter = Get_Session_Adapter(Replay_Adapter)
+    if replay_adapter is not None:
+        Replace_Transport_Adapter(replay_adapter.replaced_adapter)
+        
+        
+def Get_Trace_Summary(trace_file):
+    '''
+    Returns the number of requests in a trace (in total & by endpoint), 
+    how long the recorded run took and the total time spent waiting on responses
+    '''
+    summary = {'requests':0, 'by_endpoint':collections.Counter(), 'wall_seconds':0, 'network_seconds':0}
+    with open(trace_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            summary['requests'] += 1
+            summary['by_endpoint'][Get_Trace_Endpoint(entry['method'], entry['url'])] += 1
+            summary['wall_seconds'] = max(summary['wall_seconds'], entry['started'] + entry['elapsed'])
+            summary['network_seconds'] += entry['elapsed']
+    return summary
+
+
+def Record_Upload(credentials, upload_dict, trace_file, **upload_options):
+    '''
+    Runs Multi_Upload_To_Cmd() for real, recording every request to trace_file
+    upload_options are passed to Multi_Upload_To_Cmd()
+    '''
+    Enable_Recording(trace_file)
+    try:
+        Multi_Upload_To_Cmd(credentials, upload_dict, **upload_options)
+    finally:
+        Disable_Recording()
+        
+        
+def Replay_Upload(trace_file, upload_dict, latency_scale=1.0, credentials=None, **upload_options):
+    '''
+    Runs Multi_Upload_To_Cmd() against a trace from Record_Upload(), nothing is sent to publishing
+    The v4 & metadata files in upload_dict still need to be there
+    latency_scale multiplies the recorded latency and the pipeline's waits between polls, 0 to run as fast as possible
+    credentials doesn't need real login details, a placeholder is used if it isn't given
+    Returns a report of the wall time & requests made, extra_requests has the endpoints called more than when recorded
+    '''
+    global wait_scale
+    placeholder_credentials = None
+    if credentials is None:
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'email':'REDACTED', 'password':'REDACTED'}, f)
+        credentials = placeholder_credentials = f.name
+        
+    replay_adapter = Enable_Replay(trace_file, latency_scale)
+    original_wait_scale = wait_scale
+    wait_scale = latency_scale
+    started = time.monotonic()
+    try:
+        Multi_Upload_To_Cmd(credentials, upload_dict, **upload_options)
+    finally:
+        wall_seconds = time.monotonic() - started
+        wait_scale = original_wait_scale
+        Disable_Replay()
+        if placeholder_credentials is not None:
+            os.remove(placeholder_credentials)
+            
+    recorded = Get_Trace_Summary(trace_file)
+    stats = replay_adapter.stats
+    report = {
+            'wall_seconds':round(wall_seconds, 3),
+            'requests':stats['requests'],
+            'by_endpoint':dict(stats['by_endpoint']),
+            'repeated':stats['repeated'],
+            'unmatched':stats['unmatched'],
+            'recorded':{'wall_seconds':round(recorded['wall_seconds'] * latency_scale, 3), 'requests':recorded['requests'], 
+                        'by_endpoint':dict(recorded['by_endpoint'])},
+            'extra_requests':{endpoint:count - recorded['by_endpoint'][endpoint] for endpoint, count in stats['by_endpoint'].items() 
+                              if count > recorded['by_endpoint'][endpoint]}
+            }
+    return report
+
+
+### Daemon - long running service that batches are submitted to ###
+# One process keeps the access token, the pooled session and the response cache warm
+# Batches are POSTed as json in the upload_dict format and each dataset becomes a job
+# queued -> uploading -> importing -> finalizing -> completed (or failed, or quarantined if the import stalled)
+# One monitor thread polls every importing instance, no matter which batch it came from
+#
+# POST /batches         upload_dict as json, returns {"job_ids":[...]}
+# GET  /jobs            state of every job
+# GET  /jobs/<job_id>   state of one job
+# GET  /status          counts of jobs in each state
+
+DAEMON_TOKEN_SECONDS = 30 * 60 # access token is renewed after this long
+
+
+def Create_Pipeline_Daemon(credentials, upload_workers=2, finalize_workers=4, poll_interval=30, progress_callback=None, history_file=None, 
+                           stall_policy='wait', stall_window=1800):
+    '''
+    Returns a dict holding everything the daemon shares between batches
+    upload_workers is how many v4s are uploaded at once
+    finalize_workers is how many datasets have metadata & collection added at once
+    Uses whichever response cache is enabled on session (see Enable_Response_Cache), it isn't changed here
+    Jobs are only read or changed holding daemon['lock'], workers update a copy of upload_info and put it back
+    stall_policy & stall_window are for imports that stop progressing - see Create_Stall_Detector()
+    '''
+    # rates are written to history_file when the daemon is stopped
+    history = None
+    if history_file is not None:
+        history = Read_History(history_file)
+        progress_callback = Create_History_Recorder(history, progress_callback)
+    
+    daemon = {}
+    daemon['credentials'] = credentials
+    daemon['access_token'] = None
+    daemon['token_time'] = 0
+    daemon['upload_workers'] = upload_workers
+    daemon['poll_interval'] = poll_interval
+    daemon['progress_callback'] = progress_callback
+    daemon['history_file'] = history_file
+    daemon['history'] = history
+    daemon['response_cache'] = Get_Mounted_Response_Cache() # None if caching isn't enabled
+    daemon['jobs'] = collections.OrderedDict()
+    daemon['upload_queue'] = queue.Queue()
+    daemon['progress_trackers'] = {}
+    daemon['stall_detector'] = Create_Stall_Detector(stall_policy, stall_window, history_file=history_file)
+    daemon['lock'] = threading.Lock()
+    daemon['stop_event'] = threading.Event()
+    daemon['finalize_executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=finalize_workers)
+    daemon['threads'] = []
+    return daemon
+
+
+def Get_Daemon_Access_Token(daemon):
+    '''
+    Returns the daemon's access token, logging in again if it is older than DAEMON_TOKEN_SECONDS
+    '''
+    with daemon['lock']:
+        if daemon['access_token'] is None or time.time() - daemon['token_time'] > DAEMON_TOKEN_SECONDS:
+            daemon['access_token'] = Get_Access_Token(daemon['credentials'])
+            daemon['token_time'] = time.time()
+        return daemon['access_token']
+
+
+def Start_Pipeline_Daemon(daemon):
+    '''
+    Logs in and starts the upload workers and the import monitor
+    '''
+    Get_Daemon_Access_Token(daemon)
+    targets = [Run_Daemon_Upload_Worker] * daemon['upload_workers'] + [Run_Daemon_Monitor]
+    for target in targets:
+        thread = threading.Thread(target=target, args=(daemon,), daemon=True)
+        thread.start()
+        daemon['threads'].append(thread)
+
+
+def Stop_Pipeline_Daemon(daemon):
+    '''
+    Stops the workers once they finish what they are doing
+    Jobs still queued or importing are left as they are, recorded rates are written to history_file
+    '''
+    daemon['stop_event'].set()
+    for thread in daemon['threads']:
+        thread.join()
+    daemon['finalize_executor'].shutdown(wait=True)
+    if daemon['history'] is not None:
+        Write_History(daemon['history_file'], daemon['history'])
+
+
+def Submit_Upload_Dict(daemon, upload_dict):
+    '''
+    Queues every dataset in upload_dict (same format as Multi_Upload_To_Cmd)
+    Returns the job_ids
+    '''
+    Check_Upload_Dict(upload_dict)
+    
+    job_ids = []
+    with daemon['lock']:
+        for dataset_id in upload_dict.keys():
+            job_id = '{}-{}'.format(dataset_id, len(daemon['jobs']) + 1)
+            daemon['jobs'][job_id] = {
+                    'job_id':job_id,
+                    'dataset_id':dataset_id,
+                    'upload_info':upload_dict[dataset_id],
+                    'state':'queued',
+                    'error':None,
+                    'import_progress':None,
+                    'submitted':datetime.datetime.now().isoformat(timespec='seconds'),
+                    'updated':datetime.datetime.now().isoformat(timespec='seconds')
+                    }
+            job_ids.append(job_id)
+            
+    for job_id in job_ids:
+        daemon['upload_queue'].put(job_id)
+    return job_ids
+
+
+def Set_Daemon_Job_State(daemon, job_id, state, error=None):
+    '''
+    Updates the state of a job
+    '''
+    with daemon['lock']:
+        job = daemon['jobs'][job_id]
+        job['state'] = state
+        job['error'] = error
+        job['updated'] = datetime.datetime.now().isoformat(timespec='seconds')
+    if error is None:
+        print('{} - {}'.format(job_id, state))
+    else:
+        print('{} - {} - {}'.format(job_id, state, error))
+
+
+def Set_Daemon_Job_Upload_Info(daemon, job_id, upload_info):
+    '''
+    Replaces the upload_info of a job with a copy of upload_info
+    '''
+    upload_info = copy.deepcopy(upload_info)
+    with daemon['lock']:
+        daemon['jobs'][job_id]['upload_info'] = upload_info
+
+
+def Get_Daemon_Status(daemon, job_id=None):
+    '''
+    Returns a json-able copy of one job, or of every job if job_id is None
+    '''
+    with daemon['lock']:
+        if job_id is not None:
+            return json.loads(json.dumps(daemon['jobs'][job_id], default=str))
+        return json.loads(json.dumps(list(daemon['jobs'].values()), default=str))
+
+
+def Run_Daemon_Upload_Worker(daemon):
+    '''
+    Takes jobs off the upload queue, uploads the v4 and submits the import
+    '''
+    while not daemon['stop_event'].is_set():
+        try:
+            job_id = daemon['upload_queue'].get(timeout=1)
+        except queue.Empty:
+            continue
+        
+        with daemon['lock']:
+            job = daemon['jobs'][job_id]
+            dataset_id = job['dataset_id']
+            upload_info = copy.deepcopy(job['upload_info'])
+            
+        def save_progress(upload_info):
+            # each step is put back on the job, so the status shows it
+            Set_Daemon_Job_Upload_Info(daemon, job_id, upload_info)
+            
+        Set_Daemon_Job_State(daemon, job_id, 'uploading')
+        try:
+            Upload_And_Submit_V4(Get_Daemon_Access_Token(daemon), dataset_id, upload_info, daemon['progress_callback'], save_progress=save_progress)
+        except Exception as e:
+            Set_Daemon_Job_State(daemon, job_id, 'failed', str(e))
+        else:
+            Set_Daemon_Job_State(daemon, job_id, 'importing')
+
+
+def Run_Daemon_Monitor(daemon):
+    '''
+    Polls every importing instance each poll_interval, completed imports are finalized in the background
+    A job is failed after MAX_POLL_ERRORS failed polls in a row
+    '''
+    while not daemon['stop_event'].wait(daemon['poll_interval']):
+        with daemon['lock']:
+            # job_id -> (dataset_id, instance_id)
+            importing = {job_id:(job['dataset_id'], job['upload_info']['instance_id']) for job_id, job in daemon['jobs'].items() if job['state'] == 'importing'}
+        if len(importing) == 0:
+            continue
+        
+        access_token = Get_Daemon_Access_Token(daemon)
+        def poll(job_id):
+            dataset_id, instance_id = importing[job_id]
+            import_progress = Get_Import_Progress(access_token, instance_id)
+            Send_Import_Progress_Event(daemon['progress_callback'], daemon['progress_trackers'], dataset_id, instance_id, import_progress)
+            return import_progress
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(importing), 8)) as executor:
+            futures = {executor.submit(poll, job_id):job_id for job_id in importing.keys()}
+            for future in concurrent.futures.as_completed(futures):
+                job_id = futures[future]
+                dataset_id, instance_id = importing[job_id]
+                try:
+                    import_progress = future.result()
+                except Exception as e:
+                    # a single failed poll is retried next time round, like Wait_For_Next_Import()
+                    with daemon['lock']:
+                        upload_info = daemon['jobs'][job_id]['upload_info']
+                        upload_info['poll_errors'] = upload_info.get('poll_errors', 0) + 1
+                        poll_errors = upload_info['poll_errors']
+                    print('{} - polling import failed ({} in a row) - {}'.format(job_id, poll_errors, e))
+                    if poll_errors >= MAX_POLL_ERRORS:
+                        Set_Daemon_Job_State(daemon, job_id, 'failed', str(e))
+                    continue
+                with daemon['lock']:
+                    job = daemon['jobs'][job_id]
+                    job['upload_info']['poll_errors'] = 0
+                    job['import_progress'] = import_progress
+                    if import_progress['state'] == 'completed':
+                        job['upload_info']['state_of_upload'] = 'completed' # so Finalize_Upload() doesn't poll it again
+                    upload_info = copy.deepcopy(job['upload_info'])
+                if import_progress['state'] == 'completed':
+                    Set_Daemon_Job_State(daemon, job_id, 'finalizing')
+                    daemon['finalize_executor'].submit(Finalize_Daemon_Job, daemon, job_id)
+                elif Check_For_Stall(daemon['stall_detector'], dataset_id, instance_id, import_progress):
+                    try:
+                        outcome = Handle_Stalled_Import(access_token, daemon['stall_detector'], dataset_id, upload_info)
+                    except Exception as e:
+                        Set_Daemon_Job_State(daemon, job_id, 'failed', str(e))
+                        continue
+                    Set_Daemon_Job_Upload_Info(daemon, job_id, upload_info)
+                    if outcome == 'quarantined':
+                        Set_Daemon_Job_State(daemon, job_id, 'quarantined')
+
+
+def Finalize_Daemon_Job(daemon, job_id):
+    '''
+    Adds metadata and adds the dataset to its collection once its import has completed
+    '''
+    with daemon['lock']:
+        job = daemon['jobs'][job_id]
+        dataset_id = job['dataset_id']
+        upload_info = copy.deepcopy(job['upload_info'])
+    try:
+        Finalize_Upload(Get_Daemon_Access_Token(daemon), dataset_id, upload_info, daemon['progress_callback'], initial_wait=0)
+    except Exception as e:
+        Set_Daemon_Job_Upload_Info(daemon, job_id, upload_info)
+        Set_Daemon_Job_State(daemon, job_id, 'failed', str(e))
+    else:
+        Set_Daemon_Job_Upload_Info(daemon, job_id, upload_info)
+        Set_Daemon_Job_State(daemon, job_id, 'completed')
+
+
+class Daemon_Request_Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handles requests to the daemon, self.server.daemon is the dict from Create_Pipeline_Daemon
+    '''
+    def log_message(self, format, *args):
+        pass
+    
+    def send_json(self, status_code, body):
+        body = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def do_GET(self):
+        daemon = self.server.daemon
+        path = urllib.parse.urlsplit(self.path).path.rstrip('/')
+        if path == '/jobs':
+            self.send_json(200, Get_Daemon_Status(daemon))
+        elif path.startswith('/jobs/'):
+            job_id = urllib.parse.unquote(path[len('/jobs/'):])
+            try:
+                self.send_json(200, Get_Daemon_Status(daemon, job_id))
+            except KeyError:
+                self.send_json(404, {'error':'no job {}'.format(job_id)})
+        elif path == '/status':
+            states = collections.Counter(job['state'] for job in Get_Daemon_Status(daemon))
+            cache_stats = None if daemon['response_cache'] is None else dict(daemon['response_cache']['stats'])
+            self.send_json(200, {'jobs':dict(states), 'queued_uploads':daemon['upload_queue'].qsize(), 'cache':cache_stats})
+        else:
+            self.send_json(404, {'error':'no endpoint {}'.format(path)})
+            
+    def do_POST(self):
+        daemon = self.server.daemon
+        path = urllib.parse.urlsplit(self.path).path.rstrip('/')
+        if path != '/batches':
+            self.send_json(404, {'error':'no endpoint {}'.format(path)})
+            return
+        try:
+            upload_dict = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job_ids = Submit_Upload_Dict(daemon, upload_dict)
+        except Exception as e:
+            self.send_json(400, {'error':str(e)})
+            return
+        self.send_json(202, {'job_ids':job_ids})
+
+
+class Unix_Http_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    http.server over a unix socket
+    '''
+    daemon_threads = True
+    
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, client_address = super().get_request()
+        return request, ('local', 0)
+
+
+def Serve_Pipeline_Daemon(credentials, host='127.0.0.1', port=8642, socket_path=None, response_cache=None, **daemon_options):
+    '''
+    Runs the daemon until interrupted
+    Listens on host:port, or on a unix socket at socket_path if given
+    The daemon has the process to itself, so recipe & collection reads are cached on session unless a cache 
+    is already enabled - response_cache is used, a new one is made if not given
+    daemon_options are passed to Create_Pipeline_Daemon
+    ie curl --data @upload_dict.json http://127.0.0.1:8642/batches
+    '''
+    cache_enabled_here = Get_Mounted_Response_Cache() is None
+    if cache_enabled_here:
+        Enable_Response_Cache(response_cache)
+    daemon = Create_Pipeline_Daemon(credentials, **daemon_options)
+    Start_Pipeline_Daemon(daemon)
+    
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = Unix_Http_Server(socket_path, Daemon_Request_Handler)
+        print('Pipeline daemon listening on {}'.format(socket_path))
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), Daemon_Request_Handler)
+        print('Pipeline daemon listening on http://{}:{}'.format(host, server.server_port))
+    server.daemon = daemon
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        Stop_Pipeline_Daemon(daemon)
+        if cache_enabled_here:
+            Disable_Response_Cache()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return daemon
+
+
+def Submit_To_Daemon(upload_dict, daemon_url='http://127.0.0.1:8642'):
+    '''
+    Sends upload_dict to a running daemon, returns the job_ids
+    '''
+    r = requests.post(daemon_url + '/batches', json=upload_dict)
+    if r.status_code != 202:
+        raise Exception('{} returned a {} error - {}'.format(daemon_url, r.status_code, r.text))
+    return r.json()['job_ids']
+
+
 # TODO - full upload process for new dataset        
 
 
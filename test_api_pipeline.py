@@ -0,0 +1,121 @@
+'''
+Tests for api_pipeline that don't need florence - requests go to a fake transport adapter
+Run with python -m pytest
+'''
+import io, json, threading, time
+
+import pytest
+import requests
+
+import api_pipeline
+
+
+class Fake_Recipes_Adapter(requests.adapters.BaseAdapter):
+    '''
+    Answers GET /recipes with a fixed listing and an ETag, a 304 if If-None-Match matches
+    '''
+    def __init__(self, recipes):
+        super().__init__()
+        self.body = json.dumps({'items':recipes, 'count':len(recipes), 'offset':0, 'total_count':len(recipes)}).encode('utf-8')
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = requests.models.Response()
+        response.request = request
+        response.url = request.url
+        response.headers = requests.structures.CaseInsensitiveDict({'ETag':'"recipes-1"'})
+        if request.headers.get('If-None-Match') == '"recipes-1"':
+            response.status_code = 304
+            response.raw = io.BytesIO(b'')
+        else:
+            response.status_code = 200
+            response.raw = io.BytesIO(self.body)
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_recipes():
+    recipes = [{'id':'recipe-{}'.format(i), 'format':'v4', 'output_instances':[{'dataset_id':'dataset-{}'.format(i), 'editions':['time-series'], 'code_lists':[]}]} for i in range(3)]
+    adapter = Fake_Recipes_Adapter(recipes)
+    replaced_adapter = api_pipeline.Replace_Transport_Adapter(adapter)
+    yield adapter
+    api_pipeline.Disable_Response_Cache()
+    api_pipeline.Replace_Transport_Adapter(replaced_adapter)
+
+
+@pytest.mark.parametrize('ttl', [300, 0])
+def test_second_recipes_listing_is_a_cache_hit_or_304(fake_recipes, ttl):
+    response_cache = api_pipeline.Enable_Response_Cache(api_pipeline.Create_Response_Cache(ttl_rules=[(r'^/recipes', ttl)]))
+
+    first = api_pipeline.Get_Recipe_Api('token', projected=True)
+    second = api_pipeline.Get_Recipe_Api('token', projected=True)
+
+    assert second == first
+    assert len(first['items']) == 3
+    assert response_cache['stats']['misses'] == 1
+    if ttl == 0:
+        # always revalidated - the second read is a 304
+        assert response_cache['stats']['revalidated'] == 1
+        assert len(fake_recipes.requests) == 2
+    else:
+        # within the ttl - the second read doesn't send a request
+        assert response_cache['stats']['hits'] == 1
+        assert len(fake_recipes.requests) == 1
+
+
+def test_ready_uploads_fill_every_free_slot():
+    number_of_files = 4
+    scheduler = api_pipeline.Create_Upload_Scheduler(max_in_flight_chunks=number_of_files)
+    
+    # another file has every slot to start with
+    busy_upload_id = api_pipeline.Register_Upload(scheduler)
+    for i in range(number_of_files):
+        api_pipeline.Acquire_Upload_Slot(scheduler, busy_upload_id, 100)
+        
+    upload_ids = [api_pipeline.Register_Upload(scheduler) for i in range(number_of_files)]
+    acquired = [threading.Event() for upload_id in upload_ids]
+    def send_chunk(upload_id, event):
+        api_pipeline.Acquire_Upload_Slot(scheduler, upload_id, 100)
+        event.set()
+    threads = [threading.Thread(target=send_chunk, args=(upload_id, event), daemon=True) for upload_id, event in zip(upload_ids, acquired)]
+    for thread in threads:
+        thread.start()
+    
+    # wait until every file is waiting for a slot
+    deadline = time.monotonic() + 5
+    while not all(scheduler['uploads'][upload_id]['waiting'] for upload_id in upload_ids):
+        assert time.monotonic() < deadline, 'files never started waiting'
+        time.sleep(0.01)
+        
+    # free every slot at once, nothing is released after this
+    with scheduler['condition']:
+        for i in range(number_of_files):
+            api_pipeline.Release_Upload_Slot(scheduler, busy_upload_id)
+            
+    for event in acquired:
+        assert event.wait(5), 'a ready file was left waiting with a slot free'
+    assert scheduler['in_flight_chunks'] == number_of_files
+
+
+def test_v4_values_that_are_equal_keep_their_own_text():
+    dimensions = [{'codelist':'c', 'name':'n', 'codes':[1, 1.0, True], 'labels':[True, 1, 1.0]}]
+    
+    v4 = b''.join(api_pipeline.Iterate_V4_Blocks([1, 2, 3], dimensions))
+    
+    assert v4 == b'V4_0,c,n\n1,1,True\n2,1.0,1\n3,True,1.0\n'
+    assert api_pipeline.Get_V4_Table_Size([1, 2, 3], dimensions) == len(v4)
+
+
+def test_v4_validation_keeps_a_few_examples_and_counts_the_rest(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_pipeline, 'MAX_REPORTED_EXAMPLES', 2)
+    v4_file = tmp_path / 'v4.csv'
+    v4_file.write_text('V4_0,geo,Geo\n' + ''.join('1,z{},Z\n'.format(i) for i in range(5)) + '1,a\n' * 4)
+    
+    unknown_codes_dict = api_pipeline.Validate_V4_Codes(str(v4_file), {'geo':frozenset({'a'})})
+    
+    assert unknown_codes_dict['geo'] == {'z0':1, 'z1':1, api_pipeline.OTHER_UNKNOWN_CODES:3}
+    assert unknown_codes_dict[api_pipeline.MALFORMED_ROWS] == {'number_of_rows':4, 'examples':{7:2, 8:2}}
@@ -0,0 +1,444 @@
+'''
+Benchmarks for the v4 upload path - Post_V4_To_S3, Post_V4_Shards_To_S3 and anything that replaces them
+
+Uploads go to a local resumable upload sink instead of publishing, which puts the chunks back
+together and checks they match the original file byte for byte
+Each run records MB/s, peak RSS, peak temporary disk use and read/write syscalls
+
+ie
+python upload_benchmark.py --sizes 10MB,100MB,1GB --chunk-sizes 5MB,20MB,adaptive --concurrency 1,4 --output results.json
+python upload_benchmark.py --sizes 10MB,100MB --baseline results.json
+'''
+import argparse, hashlib, itertools, json, os, shutil, subprocess, sys, tempfile, threading, time, urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import api_pipeline
+
+UPLOAD_URL = api_pipeline.PUBLISHING_URL + 'upload'
+
+# one row of a synthetic v4, repeated to make files of any size
+V4_HEADER = b'V4_1,Data Marking,mmm-yy,Time,uk-only,Geography,cpih1dim1aggid,Aggregate\n'
+V4_ROWS = b''.join(
+        '{},,{}-{},{} {},K02000001,United Kingdom,cpih1dim1A{},{:02d} Food and non-alcoholic beverages\n'.format(
+                round(100 + row * 0.1, 1), month, year, month, 2000 + year, row % 90, row % 90).encode('utf-8')
+        for row, (month, year) in enumerate((month, year) for year in range(10, 22) for month in ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'))
+        )
+
+
+### Local resumable upload sink ###
+
+def Create_Upload_Sink():
+    '''
+    Starts a local http server that accepts resumable chunk uploads like /upload on publishing
+    Chunks are hashed in order as they arrive, so nothing is written to disk
+    Returns the server - server.uploads has details of each resumableIdentifier
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Upload_Sink_Handler)
+    server.daemon_threads = True
+    server.uploads = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class Upload_Sink_Handler(BaseHTTPRequestHandler):
+    '''
+    Handles a POST of one chunk
+    Checks the resumable params are the same for every chunk of an upload
+    '''
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        data = Get_Multipart_File(body, self.headers['Content-Type'])
+
+        identifier = params['resumableIdentifier']
+        with self.server.lock:
+            upload = self.server.uploads.setdefault(identifier, {
+                    'chunk_size':params['resumableChunkSize'],
+                    'total_size':params['resumableTotalSize'],
+                    'total_chunks':params['resumableTotalChunks'],
+                    'hash':hashlib.sha256(),
+                    'bytes':0,
+                    'next_chunk':1,
+                    'waiting_chunks':{},
+                    'chunks_received':0,
+                    'errors':[],
+                    'complete':False
+                    })
+
+            for key, param in (('chunk_size', 'resumableChunkSize'), ('total_size', 'resumableTotalSize'), ('total_chunks', 'resumableTotalChunks')):
+                if upload[key] != params[param]:
+                    upload['errors'].append('chunk {} has {} {}, first chunk had {}'.format(params['resumableChunkNumber'], param, params[param], upload[key]))
+            if int(params['resumableCurrentChunkSize']) != len(data):
+                upload['errors'].append('chunk {} is {} bytes, resumableCurrentChunkSize is {}'.format(params['resumableChunkNumber'], len(data), params['resumableCurrentChunkSize']))
+
+            # chunks can arrive out of order - hash them in order
+            upload['waiting_chunks'][int(params['resumableChunkNumber'])] = data
+            upload['chunks_received'] += 1
+            while upload['next_chunk'] in upload['waiting_chunks'].keys():
+                chunk = upload['waiting_chunks'].pop(upload['next_chunk'])
+                upload['hash'].update(chunk)
+                upload['bytes'] += len(chunk)
+                upload['next_chunk'] += 1
+            if upload['chunks_received'] == int(upload['total_chunks']):
+                upload['complete'] = True
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def Get_Multipart_File(body, content_type):
+    '''
+    Returns the contents of the single file in a multipart/form-data body
+    '''
+    boundary = content_type.split('boundary=')[-1].strip('"').encode('utf-8')
+    start = body.index(b'\r\n\r\n', body.index(b'--' + boundary)) + 4
+    end = body.rindex(b'\r\n--' + boundary)
+    return body[start:end]
+
+
+class Redirect_Adapter(requests.adapters.HTTPAdapter):
+    '''
+    Sends requests for publishing /upload to the local sink instead
+    '''
+    def __init__(self, sink_url):
+        super().__init__()
+        self.sink_url = sink_url
+
+    def send(self, request, **kwargs):
+        request.url = request.url.replace(UPLOAD_URL, self.sink_url, 1)
+        return super().send(request, **kwargs)
+
+
+### Running a single benchmark - in its own process so peak RSS is just for that run ###
+
+def Run_Case(case):
+    '''
+    Uploads case['files'] at the same time to the sink at case['sink_url']
+    With case['shards'] more than 1, each file is uploaded as that many shards - see Post_V4_Shards_To_S3()
+    Returns MB/s, peak RSS, peak temporary disk use, read/write syscalls and the s3_urls of each file
+    '''
+    api_pipeline.session.mount(UPLOAD_URL, Redirect_Adapter(case['sink_url']))
+    api_pipeline.Set_Upload_Budget(api_pipeline.UPLOAD_SCHEDULER, case.get('bytes_per_second'), case.get('max_in_flight_chunks'))
+    chunk_size = case['chunk_size']
+    shards = case.get('shards', 1)
+
+    # temporary disk use is anything in the upload directories other than the v4s
+    stop_event = threading.Event()
+    peak_temp_bytes = [0]
+    def watch_temp_files():
+        while not stop_event.wait(0.02):
+            temp_bytes = 0
+            for v4 in case['files']:
+                directory = os.path.dirname(v4)
+                for file_name in os.listdir(directory):
+                    if file_name != os.path.basename(v4):
+                        try:
+                            temp_bytes += os.path.getsize(os.path.join(directory, file_name))
+                        except OSError:
+                            pass
+            peak_temp_bytes[0] = max(peak_temp_bytes[0], temp_bytes)
+    watcher = threading.Thread(target=watch_temp_files, daemon=True)
+    watcher.start()
+
+    s3_urls = [None] * len(case['files'])
+    errors = []
+    def upload(index, v4):
+        try:
+            if shards > 1:
+                s3_urls[index] = api_pipeline.Post_V4_Shards_To_S3('benchmark-token', v4, shards, chunk_size=chunk_size)
+            else:
+                s3_urls[index] = [api_pipeline.Post_V4_To_S3('benchmark-token', v4, chunk_size=chunk_size)]
+        except Exception as e:
+            errors.append(str(e))
+
+    syscalls_before = Get_Syscall_Counts()
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=upload, args=(index, v4)) for index, v4 in enumerate(case['files'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start_time
+    syscalls_after = Get_Syscall_Counts()
+    stop_event.set()
+    watcher.join()
+
+    total_bytes = sum(os.path.getsize(v4) for v4 in case['files'])
+    result = {}
+    result['seconds'] = seconds
+    result['mb_per_second'] = total_bytes / (1024 * 1024) / seconds
+    result['peak_rss_mb'] = Get_Peak_Rss_Mb()
+    result['peak_temp_disk_mb'] = peak_temp_bytes[0] / (1024 * 1024)
+    result['read_syscalls'] = syscalls_after['syscr'] - syscalls_before['syscr']
+    result['write_syscalls'] = syscalls_after['syscw'] - syscalls_before['syscw']
+    result['s3_urls'] = s3_urls
+    result['errors'] = errors
+    return result
+
+
+def Get_Peak_Rss_Mb():
+    '''
+    Returns the peak RSS of this process in MB
+    Uses VmHWM on linux as ru_maxrss is carried over from the parent process through fork & exec
+    '''
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def Get_Syscall_Counts():
+    '''
+    Returns read & write syscall counts of this process from /proc/self/io (linux only)
+    '''
+    syscall_counts = {'syscr':0, 'syscw':0}
+    if os.path.exists('/proc/self/io'):
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in syscall_counts.keys():
+                    syscall_counts[key] = int(value)
+    return syscall_counts
+
+
+### Sweeps ###
+
+def Parse_Size(size):
+    '''
+    Converts '10MB', '5GB', '512KB' or '1000' into bytes
+    '''
+    size = size.strip().upper()
+    for suffix, multiplier in (('KB', 1024), ('MB', 1024 ** 2), ('GB', 1024 ** 3)):
+        if size.endswith(suffix):
+            return int(float(size[:-len(suffix)]) * multiplier)
+    return int(size)
+
+
+def Create_Synthetic_V4(location, size):
+    '''
+    Writes a v4 of about size bytes (whole rows) and returns its path and sha256
+    '''
+    v4 = os.path.join(location, 'v4-{}.csv'.format(size))
+    file_hash = hashlib.sha256()
+    with open(v4, 'wb') as f:
+        f.write(V4_HEADER)
+        file_hash.update(V4_HEADER)
+        written = len(V4_HEADER)
+        block = V4_ROWS * max(1, (1024 * 1024) // len(V4_ROWS))
+        while written < size:
+            if size - written < len(block):
+                # finish on a whole row
+                block = block[:block.rfind(b'\n', 0, size - written) + 1]
+                if len(block) == 0:
+                    break
+            f.write(block)
+            file_hash.update(block)
+            written += len(block)
+    return v4, file_hash.hexdigest()
+
+
+def Run_Sweep(sizes, chunk_sizes, concurrency_levels, repeat=1, work_dir=None, bytes_per_second=None, max_in_flight_chunks=None, shard_counts=(1,)):
+    '''
+    Runs every combination of v4 size, chunk size, concurrency and number of shards against a local sink
+    bytes_per_second & max_in_flight_chunks are the upload budget shared by concurrent files - see Set_Upload_Budget()
+    Each v4 is checked against what the sink received
+    Returns a list of results
+    '''
+    sink = Create_Upload_Sink()
+    sink_url = 'http://127.0.0.1:{}/upload'.format(sink.server_port)
+    work_dir = tempfile.mkdtemp(prefix='upload-benchmark-', dir=work_dir)
+
+    results = []
+    try:
+        for size in sizes:
+            v4, v4_hash = Create_Synthetic_V4(work_dir, size)
+            for chunk_size, concurrency, shards in itertools.product(chunk_sizes, concurrency_levels, shard_counts):
+                expected_uploads, shard_errors = Get_Expected_Uploads(v4, v4_hash, shards)
+                for run_number in range(repeat):
+                    # each file in its own directory so temporary chunks don't clash
+                    files = []
+                    for slot in range(concurrency):
+                        slot_dir = os.path.join(work_dir, 'run-{}-{}'.format(len(results), slot))
+                        os.makedirs(slot_dir)
+                        slot_v4 = os.path.join(slot_dir, 'v4-{}-{}-{}.csv'.format(size, len(results), slot))
+                        os.link(v4, slot_v4)
+                        files.append(slot_v4)
+
+                    case = {'files':files, 'chunk_size':chunk_size, 'sink_url':sink_url, 'shards':shards,
+                            'bytes_per_second':bytes_per_second, 'max_in_flight_chunks':max_in_flight_chunks}
+                    output = subprocess.run(
+                            [sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+                            check=True, capture_output=True, text=True
+                            ).stdout
+                    result = json.loads(output.strip().split('\n')[-1])
+
+                    result['errors'] += shard_errors + Check_Sink_Uploads(sink, result['s3_urls'], expected_uploads)
+                    result['case'] = Get_Case_Name(size, chunk_size, concurrency, shards)
+                    result['size'] = size
+                    result['chunk_size'] = chunk_size
+                    result['concurrency'] = concurrency
+                    result['shards'] = shards
+                    del result['s3_urls']
+                    results.append(result)
+                    print('{} - {:.1f} MB/s, peak RSS {:.0f} MB, peak temp disk {:.0f} MB, {} read / {} write syscalls{}'.format(
+                            result['case'], result['mb_per_second'], result['peak_rss_mb'], result['peak_temp_disk_mb'],
+                            result['read_syscalls'], result['write_syscalls'],
+                            '' if len(result['errors']) == 0 else ' - ERRORS {}'.format(result['errors'])))
+
+                    for slot_v4 in files:
+                        shutil.rmtree(os.path.dirname(slot_v4))
+            os.remove(v4)
+    finally:
+        sink.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def Get_Expected_Uploads(v4, v4_hash, shards):
+    '''
+    Returns the (size, sha256) of each upload expected for a v4 - one, or one per shard
+    Shards are checked to cover every row of the v4 exactly once, with whole rows, returns a list of errors found
+    '''
+    if shards == 1:
+        return [(os.path.getsize(v4), v4_hash)], []
+
+    errors = []
+    header, shard_ranges = api_pipeline.Get_V4_Shard_Ranges(v4, shards)
+    rows_hash = hashlib.sha256(header)
+    expected_uploads = []
+    with open(v4, 'rb') as f:
+        if shard_ranges[0][0] != len(header) or shard_ranges[-1][1] != os.path.getsize(v4):
+            errors.append('shards do not cover the whole v4')
+        for (start, end), (next_start, next_end) in zip(shard_ranges, shard_ranges[1:] + [(None, None)]):
+            if next_start is not None and next_start != end:
+                errors.append('shard ending at {} is followed by one starting at {}'.format(end, next_start))
+            f.seek(start)
+            rows = f.read(end - start)
+            if not rows.endswith(b'\n'):
+                errors.append('shard {}:{} does not end on a whole row'.format(start, end))
+            rows_hash.update(rows)
+            expected_uploads.append((len(header) + len(rows), hashlib.sha256(header + rows).hexdigest()))
+    if rows_hash.hexdigest() != v4_hash:
+        errors.append('shards put back together do not match the v4')
+    return expected_uploads, errors
+
+
+def Check_Sink_Uploads(sink, s3_urls, expected_uploads):
+    '''
+    Checks every upload was received in full and matches what was expected
+    s3_urls is a list of the s3_urls of each file, expected_uploads is from Get_Expected_Uploads()
+    Returns a list of errors
+    '''
+    errors = []
+    for file_s3_urls in s3_urls:
+        if file_s3_urls is None:
+            errors.append('upload did not finish')
+            continue
+        if len(file_s3_urls) != len(expected_uploads):
+            errors.append('{} uploads, expected {}'.format(len(file_s3_urls), len(expected_uploads)))
+            continue
+        for s3_url, (size, upload_hash) in zip(file_s3_urls, expected_uploads):
+            identifier = s3_url.split('/')[-1]
+            upload = sink.uploads.get(identifier)
+            if upload is None:
+                errors.append('{} - nothing received'.format(identifier))
+                continue
+            errors += ['{} - {}'.format(identifier, error) for error in upload['errors']]
+            if not upload['complete'] or upload['bytes'] != size or upload['hash'].hexdigest() != upload_hash:
+                errors.append('{} - received {} bytes, does not match'.format(identifier, upload['bytes']))
+    return errors
+
+
+def Get_Case_Name(size, chunk_size, concurrency, shards=1):
+    '''
+    Returns a name for a benchmark case, used to compare against a baseline
+    '''
+    if type(chunk_size) == int:
+        chunk_size = '{}MB'.format(chunk_size // (1024 * 1024))
+    case_name = 'size={}MB chunk_size={} concurrency={}'.format(size // (1024 * 1024), chunk_size, concurrency)
+    if shards > 1:
+        case_name += ' shards={}'.format(shards)
+    return case_name
+
+
+def Compare_To_Baseline(results, baseline, tolerance=0.15):
+    '''
+    Compares results to a baseline from an earlier run
+    A regression is MB/s dropping, or peak RSS / temp disk rising, by more than tolerance
+    Returns a list of regressions
+    '''
+    baseline_by_case = {result['case']:result for result in baseline}
+    regressions = []
+    for result in results:
+        if result['case'] not in baseline_by_case.keys():
+            continue
+        base = baseline_by_case[result['case']]
+        if result['mb_per_second'] < base['mb_per_second'] * (1 - tolerance):
+            regressions.append('{} - {:.1f} MB/s, baseline {:.1f} MB/s'.format(result['case'], result['mb_per_second'], base['mb_per_second']))
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('{} - peak RSS {:.0f} MB, baseline {:.0f} MB'.format(result['case'], result['peak_rss_mb'], base['peak_rss_mb']))
+        if result['peak_temp_disk_mb'] > base['peak_temp_disk_mb'] * (1 + tolerance) + 1:
+            regressions.append('{} - peak temp disk {:.0f} MB, baseline {:.0f} MB'.format(result['case'], result['peak_temp_disk_mb'], base['peak_temp_disk_mb']))
+        if len(result['errors']) != 0:
+            regressions.append('{} - {}'.format(result['case'], result['errors']))
+    return regressions
+
+
+def Main():
+    parser = argparse.ArgumentParser(description='Benchmarks the v4 upload path against a local sink')
+    parser.add_argument('--sizes', default='10MB,100MB', help='v4 sizes, ie 10MB,100MB,1GB,5GB')
+    parser.add_argument('--chunk-sizes', default='5MB,20MB,adaptive', help='chunk sizes, ie 5MB,20MB,adaptive')
+    parser.add_argument('--concurrency', default='1,4', help='number of v4s uploaded at once')
+    parser.add_argument('--shards', default='1', help='number of shards each v4 is split into, ie 1,4')
+    parser.add_argument('--bytes-per-second', default=None, help='total upload rate across concurrent v4s, ie 50MB')
+    parser.add_argument('--max-in-flight-chunks', type=int, default=None, help='total chunks being sent at once')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--work-dir', default=None, help='where synthetic v4s are written')
+    parser.add_argument('--output', default=None, help='json file to save results to')
+    parser.add_argument('--baseline', default=None, help='json file of earlier results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case is not None:
+        print(json.dumps(Run_Case(json.loads(args.run_case))))
+        return
+
+    sizes = [Parse_Size(size) for size in args.sizes.split(',')]
+    chunk_sizes = [chunk_size if chunk_size == 'adaptive' else Parse_Size(chunk_size) for chunk_size in args.chunk_sizes.split(',')]
+    concurrency_levels = [int(concurrency) for concurrency in args.concurrency.split(',')]
+    shard_counts = [int(shards) for shards in args.shards.split(',')]
+
+    bytes_per_second = None if args.bytes_per_second is None else Parse_Size(args.bytes_per_second)
+
+    results = Run_Sweep(sizes, chunk_sizes, concurrency_levels, args.repeat, args.work_dir, bytes_per_second, args.max_in_flight_chunks, shard_counts)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = Compare_To_Baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION - {}'.format(regression))
+        if len(regressions) != 0:
+            sys.exit(1)
+        print('No regressions against {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    Main()